@@ -28,10 +28,15 @@ enable_logs = True
 LOGFILE = "/var/log/chef/solo.log"
 whyrun = False
 concurrency = False
+threads = False
 include_guests = False
+skip_unchanged = False
+max_age = None
 no_color = False
 
 node_work_path = "/tmp/chef-solo"
 cookbook_paths = ['site-cookbooks', 'cookbooks']
 
 CONFIGFILE = "littlechef.cfg"
+# Kitchen directory where LittleChef keeps its local caches
+CACHE_DIR = ".littlechef"
@@ -0,0 +1,130 @@
+#Copyright 2010-2015 Miquel Torres <tobami@gmail.com>
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+"""Persistent on-disk caches for parsed kitchen files"""
+import os
+import time
+import tempfile
+import threading
+import cPickle as pickle
+
+from littlechef import CACHE_DIR
+
+INDEX_VERSION = 2
+# Files modified less than this many seconds before being parsed are not
+# stored, as a later change in the same mtime tick would go unnoticed
+RACY_INTERVAL = 2
+
+
+class KitchenIndex(object):
+    """Maps kitchen file paths to their parsed contents
+
+    Each entry is invalidated by comparing the mtime, size and inode of the
+    file with the ones recorded when it was last parsed, so that unchanged
+    files are never parsed again between runs. Top-level keys are stored
+    separately, so that a few of them can be read without loading the rest.
+    It can be shared by threads
+
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._entries = None
+        self._dirty = False
+        self._lock = threading.RLock()
+
+    def _load(self):
+        """Reads the index file, starting afresh if it is missing or stale"""
+        self._entries = {}
+        try:
+            with open(self.filename, 'rb') as f:
+                version, entries = pickle.load(f)
+        except (IOError, EOFError, ValueError, TypeError,
+                pickle.UnpicklingError):
+            return
+        if version == INDEX_VERSION:
+            self._entries = entries
+
+    def get(self, path, parse, fields=None):
+        """Returns the contents of the given file
+        * parse: function called with the path when the file has to be parsed
+        * fields: when given, only these top-level keys are returned
+
+        A fresh object is returned on every call so that callers are free to
+        modify it
+
+        """
+        with self._lock:
+            return self._get(path, parse, fields)
+
+    def _get(self, path, parse, fields):
+        if self._entries is None:
+            self._load()
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Let the parser raise its usual error
+            return _project(parse(path), fields)
+        signature = (stat.st_mtime, stat.st_size, stat.st_ino)
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == signature:
+            values = entry[1]
+            if fields is not None:
+                values = dict((key, values[key])
+                              for key in fields if key in values)
+            return dict((key, pickle.loads(value))
+                        for key, value in values.items())
+        data = parse(path)
+        if (isinstance(data, dict) and
+                time.time() - stat.st_mtime > RACY_INTERVAL):
+            values = dict((key, pickle.dumps(value, 2))
+                          for key, value in data.items())
+            self._entries[path] = (signature, values)
+            self._dirty = True
+        return _project(data, fields)
+
+    def save(self):
+        """Writes the index to disk if any entry has changed"""
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        if not self._dirty:
+            return
+        # Forget about files which no longer exist
+        for path in [p for p in self._entries if not os.path.exists(p)]:
+            del self._entries[path]
+        dirname = os.path.dirname(self.filename)
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            fd, tmp_path = tempfile.mkstemp(dir=dirname)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((INDEX_VERSION, self._entries), f, 2)
+            os.rename(tmp_path, self.filename)
+        except (IOError, OSError):
+            # A read-only kitchen just means files are parsed next time
+            return
+        self._dirty = False
+
+
+def _project(data, fields):
+    """Returns only the given top-level keys of data"""
+    if fields is None:
+        return data
+    return dict((key, data[key]) for key in fields if key in data)
+
+
+kitchen_index = KitchenIndex(os.path.join(CACHE_DIR, 'index'))
+# Content hashes of the kitchen files synced to nodes
+file_digests = KitchenIndex(os.path.join(CACHE_DIR, 'digests'))
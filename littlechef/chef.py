@@ -19,18 +19,45 @@ import os
 import shutil
 import json
 import subprocess
+import hashlib
+import tempfile
+import multiprocessing
+import gzip
+import tarfile
+import fnmatch
+import stat
+import time
+import threading
+from pipes import quote
 from copy import deepcopy
 
-from fabric.api import settings, hide, env, sudo, put
-from fabric.contrib.files import exists
+from fabric.api import settings, hide, env, sudo, run, put
+from fabric.network import normalize
 from fabric.utils import abort
 from fabric.contrib.project import rsync_project
 
-from littlechef import cookbook_paths, whyrun, lib, solo, colors
-from littlechef import LOGFILE, enable_logs as ENABLE_LOGS
+import littlechef
+from littlechef import cookbook_paths, whyrun, lib, solo, colors, fleet
+from littlechef import facts
+from littlechef import LOGFILE, CACHE_DIR, enable_logs as ENABLE_LOGS
+from littlechef.cache import file_digests
+from littlechef.pullserver import PullServer
+from littlechef.remote import RemoteScript
 
 # Path to local patch
 basedir = os.path.abspath(os.path.dirname(__file__).replace('\\', '/'))
+# Attribute merger shared with the node data bag build workers
+_merger = None
+# Files and directories which are never synced to nodes
+SYNC_EXCLUDES = ('*.svn', '.bzr*', '.git*', '.hg*')
+# Files in the node's work path describing what the last sync left there
+SYNC_MARKERS = {'bundle': '.kitchen_bundle', 'manifest': '.manifest'}
+# Directory of the relay host where kitchen bundles are kept
+RELAY_PATH = '/tmp/littlechef-relay'
+# Mode of the files written by LittleChef, as open() would create them
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+FILE_MODE = 0666 & ~_UMASK
 
 
 def save_config(node, force=False):
@@ -48,39 +75,67 @@ def save_config(node, force=False):
         files_to_create.append(filepath)
     for node_file in files_to_create:
         with open(node_file, 'w') as f:
-            f.write(json.dumps(node, indent=4, sort_keys=True))
+            f.write(_serialize_node(node))
     return tmp_filename
 
 
+def _serialize_node(node):
+    """Returns the contents of the node file of the given node"""
+    return json.dumps(node, indent=4, sort_keys=True)
+
+
+class NodeFileWriter(object):
+    """Saves the node files of many nodes at once, so that they can be
+    changed by several threads, and then written in one go. A node is
+    saved with its contents at the time it is added
+
+    """
+    def __init__(self):
+        self.nodes = {}
+        self._lock = threading.Lock()
+
+    def save(self, node):
+        """Adds the given node, replacing it if it was already added"""
+        node = deepcopy(dict(node))
+        with self._lock:
+            self.nodes[node['name']] = node
+
+    def flush(self):
+        """Writes the node files of all added nodes, overwriting existing
+        ones. Returns the names of the nodes
+
+        """
+        with self._lock:
+            nodes, self.nodes = self.nodes, {}
+        for name, node in sorted(nodes.items()):
+            _write_atomically(os.path.join("nodes", name + ".json"),
+                              _serialize_node(node))
+        if nodes:
+            print("Saved the configuration of {0} node{1} to nodes/".format(
+                len(nodes), '' if len(nodes) == 1 else 's'))
+        return sorted(nodes)
+
+
 def _get_ipaddress(node):
     """Adds the ipaddress attribute to the given node object if not already
-    present and it is correctly given by ohai
+    present and it is correctly given by ohai, as found in the facts store
     Returns True if ipaddress is added, False otherwise
 
     """
     if "ipaddress" not in node:
-        with settings(hide('stdout'), warn_only=True):
-            output = sudo('ohai -l warn ipaddress')
-        if output.succeeded:
-            try:
-                node['ipaddress'] = json.loads(output)[0]
-            except ValueError:
-                abort("Could not parse ohai's output for ipaddress"
-                      ":\n  {0}".format(output))
+        ipaddress = facts.get_facts()['ipaddress']
+        if ipaddress:
+            node['ipaddress'] = ipaddress
             return True
     return False
 
 
 def chef_test():
-    """Calls chef-solo on the remote node, returns True if successful,
-    False otherwise
+    """Returns True if chef-solo is installed on the node, as found in the
+    facts store, False otherwise
 
     """
-    cmd = "chef-solo --version"
-    output = sudo(cmd, warn_only=True, quiet=True)
-    if 'chef-solo: command not found' in output:
-        return False
-    return True
+    return facts.get_facts()['chef_solo'] is not None
 
 
 def sync_node(node):
@@ -94,17 +149,20 @@ def sync_node(node):
         return False
     current_node = lib.get_node(node['name'])
     # Always configure Chef Solo
-    solo.configure(current_node)
-    ipaddress = _get_ipaddress(node)
+    with fleet.phase('configure'):
+        solo.configure(current_node)
+        ipaddress = _get_ipaddress(node)
     # Everything was configured alright, so save the node configuration
     # This is done without credentials, so that we keep the node name used
     # by the user and not the hostname or IP translated by .ssh/config
     filepath = save_config(node, ipaddress)
     try:
         # Synchronize the kitchen directory
-        _synchronize_node(filepath, node)
+        with fleet.phase('sync'):
+            _synchronize_node(filepath, node)
         # Execute Chef Solo
-        _configure_node()
+        with fleet.phase('cook'):
+            _configure_node()
     finally:
         _node_cleanup()
     return True
@@ -112,8 +170,8 @@ def sync_node(node):
 
 def _synchronize_node(configfile, node):
     """Performs the Synchronize step of a Chef run:
-    Uploads all cookbooks, all roles and all databags to a node and add the
-    patch for data bags
+    Uploads the cookbooks needed by the node's run_list, all roles and all
+    databags to a node and add the patch for data bags
 
     Returns the node object of the node which is about to be configured,
     or None if this node object cannot be found.
@@ -123,13 +181,23 @@ def _synchronize_node(configfile, node):
     if env.parallel:
         msg = "[{0}]: {1}".format(env.host_string, msg)
     print(msg)
-    # First upload node.json
-    remote_file = '/etc/chef/node.json'
-    put(configfile, remote_file, use_sudo=True, mode=400)
-    with hide('stdout'):
-        sudo('chown root:$(id -g -n root) {0}'.format(remote_file))
+    # Files are installed and the kitchen unpacked by a single remote script
+    # run once the kitchen has been transferred
+    server = None
+    if env.pull:
+        server = PullServer(None if env.pull == 'tunnel' else env.pull)
+    script = RemoteScript(server)
+    # Other sync modes can't tell what this one changes
+    script.add('rm -f {0}'.format(' '.join(
+        os.path.join(env.node_work_path, marker)
+        for mode, marker in sorted(SYNC_MARKERS.items())
+        if mode != env.kitchen_sync)))
+    script.install('/etc/chef/node.json', filename=configfile)
     # Remove local temporary node file
     os.remove(configfile)
+    if env.encrypted_data_bag_secret:
+        script.install('/etc/chef/encrypted_data_bag_secret',
+                       filename=env.encrypted_data_bag_secret, mode=0600)
     # Synchronize kitchen
     extra_opts = "-q"
     if env.follow_symlinks:
@@ -137,13 +205,59 @@ def _synchronize_node(configfile, node):
     ssh_opts = ""
     if env.ssh_config_path:
         ssh_opts += " -F %s" % os.path.expanduser(env.ssh_config_path)
-    if env.encrypted_data_bag_secret:
-        put(env.encrypted_data_bag_secret,
-            "/etc/chef/encrypted_data_bag_secret",
-            use_sudo=True,
-            mode=0600)
-        sudo('chown root:$(id -g -n root) /etc/chef/encrypted_data_bag_secret')
 
+    if env.loglevel is "debug":
+        extra_opts = ""
+
+    if env.gateway:
+        ssh_opts += " " + env.gateway + " ssh -o StrictHostKeyChecking=no"
+        ssh_opts += _get_relayed_key_option()
+
+    cookbooks = get_cookbooks_to_sync(node)
+    if env.kitchen_sync == 'bundle':
+        bundle = env.get('kitchen_bundles', {}).get(tuple(cookbooks))
+        _upload_kitchen_bundle(bundle or build_kitchen_bundle(cookbooks),
+                               script)
+    elif env.kitchen_sync == 'manifest':
+        _upload_kitchen_delta(cookbooks, script)
+    else:
+        # Cookbooks left out are also removed from the node
+        rsync_project(
+            env.node_work_path,
+            ' '.join(_get_kitchen_paths()),
+            exclude=SYNC_EXCLUDES,
+            delete=True,
+            extra_opts=extra_opts + " --delete-excluded " +
+            _get_cookbook_filters(cookbooks),
+            ssh_opts=ssh_opts
+        )
+
+    if env.sync_packages_dest_dir and env.sync_packages_local_dir:
+        print("Uploading packages from {0} to remote server {2} directory "
+              "{1}").format(env.sync_packages_local_dir,
+                            env.sync_packages_dest_dir, env.host_string)
+        if server:
+            _download_packages_bundle(
+                env.get('packages_bundle') or build_packages_bundle(), script)
+        else:
+            try:
+                rsync_project(
+                  env.sync_packages_dest_dir,
+                  env.sync_packages_local_dir+"/*",
+                  exclude=SYNC_EXCLUDES,
+                  delete=True,
+                  extra_opts=extra_opts,
+                  ssh_opts=ssh_opts
+                )
+            except:
+                print("Warning: package upload failed. Continuing cooking...")
+
+    _add_environment_lib(script)  # NOTE: Chef 10 only
+    script.execute()
+
+
+def _get_kitchen_paths():
+    """Returns the kitchen directories which are synced to nodes"""
     paths_to_sync = ['./data_bags', './roles', './environments']
     for cookbook_path in cookbook_paths:
         paths_to_sync.append('./{0}'.format(cookbook_path))
@@ -151,42 +265,498 @@ def _synchronize_node(configfile, node):
     # Add berksfile directory to sync_list
     if env.berksfile:
         paths_to_sync.append(env.berksfile_cookbooks_directory)
+    return paths_to_sync
 
-    if env.loglevel is "debug":
-        extra_opts = ""
 
-    if env.gateway:
-        ssh_key_file = '.ssh/' + os.path.basename(' '.join(env.ssh_config.lookup(
-            env.host_string)['identityfile']))
-        ssh_opts += " " + env.gateway + " ssh -o StrictHostKeyChecking=no -i "
-        ssh_opts += ssh_key_file
-
-    rsync_project(
-        env.node_work_path,
-        ' '.join(paths_to_sync),
-        exclude=('*.svn', '.bzr*', '.git*', '.hg*'),
-        delete=True,
-        extra_opts=extra_opts,
-        ssh_opts=ssh_opts
-    )
+def _get_cookbook_path_names():
+    """Returns the names cookbook paths get in the node's work path"""
+    names = []
+    for path in cookbook_paths + [env.berksfile_cookbooks_directory
+                                  if env.berksfile else None]:
+        # Directories are synced under their base name
+        if path and os.path.basename(os.path.normpath(path)) not in names:
+            names.append(os.path.basename(os.path.normpath(path)))
+    return names
 
-    if env.sync_packages_dest_dir and env.sync_packages_local_dir:
-        print("Uploading packages from {0} to remote server {2} directory "
-              "{1}").format(env.sync_packages_local_dir,
-                            env.sync_packages_dest_dir, env.host_string)
-        try:
-            rsync_project(
-              env.sync_packages_dest_dir,
-              env.sync_packages_local_dir+"/*",
-              exclude=('*.svn', '.bzr*', '.git*', '.hg*'),
-              delete=True,
-              extra_opts=extra_opts,
-              ssh_opts=ssh_opts
-            )
-        except:
-            print("Warning: package upload failed. Continuing cooking...")
 
-    _add_environment_lib()  # NOTE: Chef 10 only
+def get_cookbooks_to_sync(node):
+    """Returns the cookbooks needed by the expanded run_list of a node"""
+    return lib.get_cookbook_closure(lib.expand_run_list(node)[1])
+
+
+def _get_cookbook_filters(cookbooks):
+    """Returns rsync options which only let the given cookbooks through.
+    They are taken from every cookbook path, so that Chef applies its usual
+    precedence between site-cookbooks and cookbooks
+
+    """
+    filters = []
+    for name in _get_cookbook_path_names():
+        for cookbook in cookbooks:
+            filters.append('--include="/{0}/{1}"'.format(name, cookbook))
+        filters.append('--exclude="/{0}/*"'.format(name))
+    return ' '.join(filters)
+
+
+def _is_excluded(name):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in SYNC_EXCLUDES)
+
+
+def _add_to_bundle(tar, path, arcname, only=None):
+    """Adds a directory tree to the bundle in a reproducible way: entries
+    are sorted, and owners and modification times are not kept
+    * only: when given, only these entries of the top directory are added
+
+    """
+    info = tar.gettarinfo(path, arcname)
+    if info is None:
+        # Sockets and the like can't be archived, and are not needed
+        return
+    info.uid = info.gid = 0
+    info.uname = info.gname = ''
+    info.mtime = 0
+    if info.isreg():
+        with open(path, 'rb') as f:
+            tar.addfile(info, f)
+    else:
+        tar.addfile(info)
+    if info.isdir():
+        for name in sorted(os.listdir(path)):
+            if only is not None and name not in only:
+                continue
+            if not _is_excluded(name):
+                _add_to_bundle(tar, os.path.join(path, name),
+                               arcname + '/' + name)
+
+
+def _write_bundle(bundles_path, entries):
+    """Packs the given (path, arcname, only) entries into a compressed
+    bundle in bundles_path, named after the hash of its contents. The same
+    files always result in the same bundle.
+
+    Returns a tuple with the bundle's path and hash
+
+    """
+    if not os.path.isdir(bundles_path):
+        os.makedirs(bundles_path)
+    fd, tmp_path = tempfile.mkstemp(dir=bundles_path)
+    with os.fdopen(fd, 'wb') as f:
+        # The gzip header would otherwise contain the current time
+        compressed = gzip.GzipFile('', 'wb', 9, f, mtime=0)
+        tar = tarfile.open(fileobj=compressed, mode='w',
+                           dereference=env.follow_symlinks)
+        for path, arcname, only in entries:
+            _add_to_bundle(tar, path, arcname, only)
+        tar.close()
+        compressed.close()
+    digest = _hash_file(tmp_path)['sha1']
+    bundle_path = os.path.join(bundles_path, digest + '.tar.gz')
+    os.rename(tmp_path, bundle_path)
+    return bundle_path, digest
+
+
+def _remove_other_bundles(bundles_path, bundles):
+    """Removes the bundles left over from previous runs"""
+    current = set(os.path.basename(path) for path, digest in bundles)
+    for filename in os.listdir(bundles_path):
+        if filename not in current:
+            os.remove(os.path.join(bundles_path, filename))
+
+
+def build_kitchen_bundle(cookbooks):
+    """Packs all kitchen directories which are synced to nodes, with only the
+    given cookbooks, into a single compressed bundle named after the hash of
+    its contents, so that it can be built once per run and uploaded to every
+    node needing the same cookbooks. The same kitchen always results in the
+    same bundle.
+
+    Returns a tuple with the bundle's path and hash
+
+    """
+    entries = []
+    added = set()
+    cookbook_path_names = _get_cookbook_path_names()
+    for path in _get_kitchen_paths():
+        # Directories end up in the work path under their base name,
+        # as they do with rsync
+        arcname = os.path.basename(os.path.normpath(path))
+        if os.path.exists(path) and arcname not in added:
+            added.add(arcname)
+            entries.append((
+                path, arcname,
+                cookbooks if arcname in cookbook_path_names else None))
+    bundle_path, digest = _write_bundle(
+        os.path.join(CACHE_DIR, 'bundles'), entries)
+    env.setdefault('kitchen_bundles', {})
+    env.kitchen_bundles[tuple(cookbooks)] = (bundle_path, digest)
+    return bundle_path, digest
+
+
+def build_kitchen_bundles(nodes):
+    """Builds one kitchen bundle for every set of cookbooks the given nodes
+    need, removing bundles left over from previous runs
+
+    """
+    env.kitchen_bundles = {}
+    for node in nodes:
+        cookbooks = get_cookbooks_to_sync(node)
+        if tuple(cookbooks) not in env.kitchen_bundles:
+            build_kitchen_bundle(cookbooks)
+    if not env.kitchen_bundles:
+        return
+    _remove_other_bundles(os.path.join(CACHE_DIR, 'bundles'),
+                          env.kitchen_bundles.values())
+
+
+def _get_packages_entries():
+    """Returns the top level entries of the sync-packages local directory"""
+    return [name for name in sorted(os.listdir(env.sync_packages_local_dir))
+            if not _is_excluded(name)]
+
+
+def build_packages_bundle():
+    """Packs the sync-packages local directory into a bundle, for nodes to
+    download from the pull server, and removes the one of previous runs
+
+    Returns a tuple with the bundle's path and hash
+
+    """
+    if not os.path.isdir(env.sync_packages_local_dir):
+        abort("The sync-packages local-dir {0} does not exist".format(
+            env.sync_packages_local_dir))
+    bundles_path = os.path.join(CACHE_DIR, 'packages')
+    env.packages_bundle = _write_bundle(bundles_path, [
+        (os.path.join(env.sync_packages_local_dir, name), name, None)
+        for name in _get_packages_entries()])
+    _remove_other_bundles(bundles_path, [env.packages_bundle])
+    return env.packages_bundle
+
+
+def _download_packages_bundle(bundle, script):
+    """Adds the steps to download the packages bundle and unpack it into the
+    sync-packages destination directory to the given RemoteScript
+
+    As with rsync, the entries in the bundle replace the ones in the
+    destination directory, which are owned by the user. A failure doesn't
+    stop the run
+
+    """
+    bundle_path, digest = bundle
+    remote_bundle = '/tmp/littlechef-packages-{0}.tar.gz'.format(digest)
+    dest_dir = quote(env.sync_packages_dest_dir)
+    entries = ' '.join(quote(name) for name in _get_packages_entries())
+    commands = [
+        script.download_command(remote_bundle, bundle_path, digest),
+        'mkdir -p {0}'.format(dest_dir),
+        'cd {0}'.format(dest_dir),
+        'rm -rf {0}'.format(entries),
+        'tar -xzf {0} --no-same-owner'.format(remote_bundle),
+        'chown -R {0} {1}'.format(env.user, entries),
+    ]
+    # In a subshell, so that the change of directory doesn't last
+    script.add('({0})'.format(' && '.join(commands)),
+               warning="package upload failed. Continuing cooking...")
+    script.add('rm -f {0}'.format(remote_bundle))
+
+
+def _upload_kitchen_bundle(bundle, script):
+    """Uploads a kitchen bundle unless the node already has it, and adds the
+    steps to unpack it into the node's work path to the given RemoteScript
+
+    The bundle is first unpacked into a staging directory, which then
+    replaces each synced directory with a rename. The hash of the bundle is
+    only recorded once all of them have been replaced, so that an
+    interrupted sync is never mistaken for a complete one
+
+    """
+    bundle_path, digest = bundle
+    marker = os.path.join(env.node_work_path, SYNC_MARKERS['bundle'])
+    with settings(hide('running', 'stdout'), warn_only=True):
+        current = sudo('cat {0}'.format(marker))
+    if current.succeeded and current.strip() == digest:
+        print("Kitchen bundle {0} is already on the node".format(digest[:8]))
+        return
+    remote_bundle = '/tmp/littlechef-kitchen-{0}.tar.gz'.format(digest)
+    if script.server is not None:
+        script.add(script.download_command(remote_bundle, bundle_path, digest),
+                   "Could not download the kitchen bundle")
+    elif env.relay:
+        _relay_kitchen_bundle(bundle, remote_bundle)
+    else:
+        with hide('running', 'stdout'):
+            put(bundle_path, remote_bundle, mode=0600)
+    staging = os.path.join(env.node_work_path, '.kitchen_' + digest)
+    old = os.path.join(env.node_work_path, '.kitchen_old')
+    error = "Could not unpack the kitchen bundle"
+    commands = [
+        'rm -rf {0} {1}'.format(staging, marker),
+        'mkdir -p {0}'.format(staging),
+        'tar -xzf {0} --no-same-owner -C {1}'.format(remote_bundle, staging),
+        # The recursive chown of solo.configure is skipped on later runs
+        'chown -R {0} {1}'.format(env.user, staging),
+        'for entry in $(ls -A {0}); do '
+        'rm -rf {1}; '
+        'if [ -e {2}/$entry ]; then mv {2}/$entry {1}; fi; '
+        'mv {0}/$entry {2}/$entry || fail "{3}"; '
+        'done'.format(staging, old, env.node_work_path, error),
+        'rm -rf {0} {1} {2}'.format(staging, old, remote_bundle),
+        'echo {0} > {1}'.format(digest, marker),
+    ]
+    script.add(' && '.join(commands), error)
+
+
+def _get_relayed_key_option():
+    """Returns the ssh option for the key file a gateway or relay host uses
+    to log into the current node, which is expected to be in its .ssh
+    directory under the same name as the local one
+
+    """
+    if env.ssh_config:
+        identity = env.ssh_config.lookup(env.host_string).get('identityfile')
+    else:
+        identity = env.key_filename
+    if isinstance(identity, list):
+        identity = ' '.join(identity)
+    if not identity:
+        return ""
+    return " -i .ssh/" + os.path.basename(identity)
+
+
+def _relay_settings():
+    """Returns the settings used to run commands on the relay host, which
+    is reached directly even when it is the gateway
+
+    """
+    return settings(hide('running', 'stdout'), host_string=env.relay,
+                    gateway=None, warn_only=True)
+
+
+def _get_relay_bundle_path(digest):
+    return '{0}/{1}.tar.gz'.format(RELAY_PATH, digest)
+
+
+def upload_kitchen_bundles(bundles):
+    """Uploads the given kitchen bundles to the relay host, unless it
+    already has them, and removes any other bundles from it
+
+    The relay then copies them to each node, so that the bundles only go
+    once through the link between the workstation and the relay
+
+    """
+    with _relay_settings():
+        output = run('mkdir -p {0} && ls {0}'.format(RELAY_PATH))
+        if output.failed:
+            abort("Could not create {0} dir on relay {1}".format(
+                RELAY_PATH, env.relay))
+        present = output.split()
+        current = []
+        for path, digest in sorted(bundles):
+            current.append(digest + '.tar.gz')
+            if digest + '.tar.gz' not in present:
+                print("Uploading kitchen bundle {0} to relay {1}".format(
+                    digest[:8], env.relay))
+                put(path, _get_relay_bundle_path(digest), mode=0600)
+        stale = [name for name in present if name not in current]
+        if stale:
+            run('cd {0} && rm -f {1}'.format(RELAY_PATH, ' '.join(stale)))
+
+
+def _relay_kitchen_bundle(bundle, remote_bundle):
+    """Has the relay host copy a kitchen bundle to the current node"""
+    bundle_path, digest = bundle
+    user, host, port = normalize(env.host_string)
+    if env.ssh_config:
+        host = env.ssh_config.lookup(env.host_string).get('hostname', host)
+    command = (
+        '[ -f {0} ] || exit 100; '
+        'scp -q -o StrictHostKeyChecking=no{1} -P {2} {0} {3}@{4}:{5}'
+    ).format(_get_relay_bundle_path(digest), _get_relayed_key_option(),
+             port, user, host, remote_bundle)
+    with _relay_settings():
+        output = run(command)
+        if output.return_code == 100:
+            # Bundles built during the run itself are not on the relay yet
+            put(bundle_path, _get_relay_bundle_path(digest), mode=0600)
+            output = run(command)
+    if output.failed:
+        abort("Relay {0} could not copy the kitchen bundle to {1}:"
+              "\n{2}".format(env.relay, env.host_string, output))
+
+
+def _hash_file(path):
+    """Returns the hash of a file's contents, in a dictionary so that it can
+    be kept in a KitchenIndex
+
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            digest.update(chunk)
+    return {'sha1': digest.hexdigest()}
+
+
+def _get_kitchen_files(cookbooks):
+    """Returns a dictionary mapping the path relative to the node's work
+    path of every file synced to a node needing the given cookbooks, to its
+    local path. Symlinks are only followed with follow_symlinks, as rsync
+    does
+
+    """
+    files = {}
+    added = set()
+    cookbook_path_names = _get_cookbook_path_names()
+    for path in _get_kitchen_paths():
+        arcname = os.path.basename(os.path.normpath(path))
+        if not os.path.isdir(path) or arcname in added:
+            continue
+        added.add(arcname)
+        for dirpath, dirnames, filenames in os.walk(
+                path, followlinks=env.follow_symlinks):
+            relpath = os.path.relpath(dirpath, path)
+            if relpath == '.':
+                prefix = arcname
+                if arcname in cookbook_path_names:
+                    dirnames[:] = [d for d in dirnames if d in cookbooks]
+                    filenames = [f for f in filenames if f in cookbooks]
+            else:
+                prefix = arcname + '/' + relpath.replace(os.sep, '/')
+            dirnames[:] = [d for d in dirnames if not _is_excluded(d)]
+            for name in filenames:
+                filename = os.path.join(dirpath, name)
+                if (_is_excluded(name) or not os.path.isfile(filename) or
+                        os.path.islink(filename) and not env.follow_symlinks):
+                    continue
+                files[prefix + '/' + name] = filename
+    return files
+
+
+def _get_manifest(files):
+    """Returns the hash and permissions of the given kitchen files
+    Hashes are kept in the kitchen cache, so that only changed files are
+    read again
+
+    """
+    manifest = {}
+    for name, filename in files.items():
+        manifest[name] = [file_digests.get(filename, _hash_file)['sha1'],
+                          stat.S_IMODE(os.stat(filename).st_mode)]
+    file_digests.save()
+    return manifest
+
+
+def _get_removed_paths(old_manifest, manifest):
+    """Returns the paths to remove from the node to get rid of the files in
+    old_manifest missing in manifest. Whole directories left without files
+    are removed at once
+
+    """
+    directories = set()
+    for name in manifest:
+        parts = name.split('/')
+        for i in range(1, len(parts)):
+            directories.add('/'.join(parts[:i]))
+    removed = set()
+    for name in set(old_manifest) - set(manifest):
+        parts = name.split('/')
+        for i in range(1, len(parts) + 1):
+            # The outermost path not needed anymore
+            if '/'.join(parts[:i]) not in directories:
+                removed.add('/'.join(parts[:i]))
+                break
+    return sorted(removed)
+
+
+def _read_remote_manifest():
+    """Returns the manifest of the files last synced to the node, or None
+    when the node has no complete copy of the kitchen
+
+    """
+    manifest_path = os.path.join(env.node_work_path, SYNC_MARKERS['manifest'])
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        output = sudo('cat {0}'.format(manifest_path))
+    if output.failed:
+        return None
+    try:
+        return json.loads(output)
+    except ValueError:
+        return None
+
+
+def _upload_kitchen_delta(cookbooks, script):
+    """Uploads the kitchen files that changed since the last sync, and adds
+    the steps to put them in place and remove deleted files to the given
+    RemoteScript
+
+    A manifest with the hash and permissions of every synced file is kept in
+    the node's work path, and compared locally with the kitchen. Changed
+    files are sent as a single archive over the connection already open for
+    the other remote calls, so rsync is not needed on either end. The
+    manifest is removed while the work path is changing, so that an
+    interrupted sync causes a full one next time
+
+    """
+    files = _get_kitchen_files(cookbooks)
+    manifest = _get_manifest(files)
+    old_manifest = _read_remote_manifest()
+    manifest_path = os.path.join(env.node_work_path, SYNC_MARKERS['manifest'])
+    script.add('rm -f {0}'.format(manifest_path),
+               "Could not modify {0} dir".format(env.node_work_path))
+    if old_manifest is None:
+        # Start afresh, as files were synced by other means
+        changed = sorted(manifest)
+        removed = sorted(set(
+            os.path.basename(os.path.normpath(path))
+            for path in _get_kitchen_paths()))
+    else:
+        changed = sorted(name for name in manifest
+                         if old_manifest.get(name) != manifest[name])
+        removed = _get_removed_paths(old_manifest, manifest)
+    print("Sending {0} changed files, removing {1} paths".format(
+        len(changed), len(removed)))
+    if removed:
+        script.add('rm -rf {0}'.format(' '.join(
+            quote(os.path.join(env.node_work_path, path))
+            for path in removed)),
+            "Could not remove deleted files")
+    if changed:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        fd, delta_path = tempfile.mkstemp(dir=CACHE_DIR)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                tar = tarfile.open(fileobj=f, mode='w:gz', dereference=True)
+                for name in changed:
+                    info = tar.gettarinfo(files[name], name)
+                    # Owned by the deployment user once extracted by root,
+                    # like rsynced files
+                    info.uid = info.gid = 0
+                    info.uname, info.gname = env.user, ''
+                    with open(files[name], 'rb') as content:
+                        tar.addfile(info, content)
+                tar.close()
+            remote_delta = '/tmp/littlechef-delta-{0}.tar.gz'.format(
+                os.urandom(16).encode('hex'))
+            with hide('running', 'stdout'):
+                put(delta_path, remote_delta, mode=0600)
+        finally:
+            os.remove(delta_path)
+        # So are the directories tar creates for them
+        directories = set()
+        for name in changed:
+            name = os.path.dirname(name)
+            while name:
+                directories.add(name)
+                name = os.path.dirname(name)
+        command = 'tar -xzf {0} -C {1}'.format(
+            remote_delta, env.node_work_path)
+        if directories:
+            command += ' && chown {0} {1}'.format(env.user, ' '.join(
+                quote(os.path.join(env.node_work_path, directory))
+                for directory in sorted(directories)))
+        script.add('{0} && rm -f {1}'.format(command, remote_delta),
+                   "Could not unpack the changed files")
+    script.install(manifest_path, json.dumps(manifest, sort_keys=True),
+                   mode=0644)
 
 
 def build_dct(dic, keys, value):
@@ -229,75 +799,244 @@ def _add_automatic_attributes(node):
     node['domain'] = ".".join(node['fqdn'].split('.')[1:])
 
 
-def _add_merged_attributes(node, all_recipes, all_roles):
-    """Merges attributes from cookbooks, node and roles
-
-    Chef Attribute precedence:
-    http://docs.opscode.com/essentials_cookbook_attribute_files.html#attribute-precedence
-    LittleChef implements, in precedence order:
-        - Cookbook default
-        - Environment default
-        - Role default
-        - Node normal
-        - Role override
-        - Environment override
-
-    NOTE: In order for cookbook attributes to be read, they need to be
-        correctly defined in its metadata.json
-
-    """
-    # Get cookbooks from extended recipes
-    attributes = {}
-    for recipe in node['recipes']:
-        # Find this recipe
-        found = False
-        for r in all_recipes:
-            if recipe == r['name']:
-                found = True
-                for attr in r['attributes']:
-                    if r['attributes'][attr].get('type') == "hash":
-                        value = {}
-                    else:
-                        value = r['attributes'][attr].get('default')
-                    # Attribute dictionaries are defined as a single
-                    # compound key. Split and build proper dict
-                    build_dct(attributes, attr.split("/"), value)
-        if not found:
-            error = "Could not find recipe '{0}' while ".format(recipe)
-            error += "building node data bag for '{0}'".format(node['name'])
-            abort(error)
-
-    # Get default role attributes
-    for role in node['roles']:
-        for r in all_roles:
-            if role == r['name']:
-                update_dct(attributes, r.get('default_attributes', {}))
-
-    # Get default environment attributes
-    environment = lib.get_environment(node['chef_environment'])
-    update_dct(attributes, environment.get('default_attributes', {}))
-
-    # Get normal node attributes
-    non_attribute_fields = [
-        'id', 'name', 'role', 'roles', 'recipes', 'run_list', 'ipaddress']
-    node_attributes = {}
-    for key in node:
-        if key in non_attribute_fields:
-            continue
-        node_attributes[key] = node[key]
-    update_dct(attributes, node_attributes)
+class AttributeMerger(object):
+    """Merges node attributes out of name-keyed indexes of recipes and roles
 
-    # Get override role attributes
-    for role in node['roles']:
+    The cookbook default attributes of each recipe are only built once, and
+    each environment is only read once. Attributes coming from cookbooks,
+    roles and the environment are merged only once for all nodes sharing the
+    same expanded run_list and environment
+
+    """
+    def __init__(self, all_recipes, all_roles):
+        self.recipes = dict((r['name'], r) for r in all_recipes)
+        self.roles = {}
         for r in all_roles:
-            if role == r['name']:
-                update_dct(attributes, r.get('override_attributes', {}))
+            self.roles.setdefault(r['name'], []).append(r)
+        self._cookbook_defaults = {}
+        self._environments = {}
+        self._layers = {}
+
+    def cookbook_defaults(self, recipe):
+        """Returns the default attributes defined in the cookbook metadata of
+        the given recipe, as a list of (keys, value) pairs to be set in
+        order with build_dct, or None when the recipe does not exist
+
+        """
+        if recipe not in self._cookbook_defaults:
+            if recipe not in self.recipes:
+                return None
+            defaults = []
+            metadata = self.recipes[recipe]['attributes']
+            for attr in metadata:
+                if metadata[attr].get('type') == "hash":
+                    value = {}
+                else:
+                    value = metadata[attr].get('default')
+                # Attribute dictionaries are defined as a single
+                # compound key. Split and build proper dict
+                defaults.append((tuple(attr.split("/")), value))
+            self._cookbook_defaults[recipe] = defaults
+        return self._cookbook_defaults[recipe]
+
+    def environment(self, name):
+        """Returns the given environment, reading it only once"""
+        if name not in self._environments:
+            self._environments[name] = lib.get_environment(name)
+        return self._environments[name]
+
+    def role_attributes(self, roles, precedence):
+        """Returns the default or override attributes of the given roles"""
+        for role in roles:
+            for r in self.roles.get(role, []):
+                yield r.get(precedence, {})
+
+    def layers(self, node):
+        """Returns the attributes that have a lower and a higher precedence
+        than the node attributes, as a tuple of two dictionaries which are
+        shared between nodes and should not be modified
+
+        """
+        key = (tuple(node['recipes']), tuple(node['roles']),
+               node['chef_environment'])
+        if key in self._layers:
+            return self._layers[key]
+        # Get cookbooks from extended recipes. Attributes are set one by
+        # one, so that hash attributes replace what earlier recipes set
+        default = {}
+        for recipe in node['recipes']:
+            defaults = self.cookbook_defaults(recipe)
+            if defaults is None:
+                error = "Could not find recipe '{0}' while ".format(recipe)
+                error += "building node data bag for '{0}'".format(
+                    node['name'])
+                abort(error)
+            for keys, value in defaults:
+                build_dct(default, list(keys), value)
+
+        # Get default role attributes
+        for role_attributes in self.role_attributes(
+                node['roles'], 'default_attributes'):
+            update_dct(default, role_attributes)
+
+        # Get default environment attributes
+        environment = self.environment(node['chef_environment'])
+        update_dct(default, environment.get('default_attributes', {}))
+
+        # Get override role attributes
+        override = {}
+        for role_attributes in self.role_attributes(
+                node['roles'], 'override_attributes'):
+            update_dct(override, role_attributes)
+
+        # Get override environment attributes
+        update_dct(override, environment.get('override_attributes', {}))
+
+        self._layers[key] = default, override
+        return self._layers[key]
+
+    def merge(self, node):
+        """Merges attributes from cookbooks, node and roles
+
+        Chef Attribute precedence:
+        http://docs.opscode.com/essentials_cookbook_attribute_files.html#attribute-precedence
+        LittleChef implements, in precedence order:
+            - Cookbook default
+            - Environment default
+            - Role default
+            - Node normal
+            - Role override
+            - Environment override
+
+        NOTE: In order for cookbook attributes to be read, they need to be
+            correctly defined in its metadata.json
+
+        """
+        default, override = self.layers(node)
+        # The layers are shared with other nodes, values included
+        attributes = deepcopy(default)
+
+        # Get normal node attributes
+        non_attribute_fields = [
+            'id', 'name', 'role', 'roles', 'recipes', 'run_list', 'ipaddress']
+        node_attributes = {}
+        for key in node:
+            if key in non_attribute_fields:
+                continue
+            node_attributes[key] = node[key]
+        update_dct(attributes, node_attributes)
+
+        update_dct(attributes, deepcopy(override))
+
+        # Merge back to the original node object
+        node.update(attributes)
+
+
+def _digest(data):
+    """Returns a hash of a JSON serializable object"""
+    return hashlib.sha1(json.dumps(data, sort_keys=True)).hexdigest()
+
+
+def _get_node_fingerprint(node, recipe_digests, role_digests, env_digests):
+    """Returns a hash of all inputs a node data bag item is built from:
+    the node file, the roles it expands to, its environment and the metadata
+    of the cookbooks it uses
+
+    """
+    environment = node['chef_environment']
+    if environment not in env_digests:
+        env_digests[environment] = _digest(lib.get_environment(environment))
+    return _digest([
+        littlechef.__version__,
+        node,
+        [role_digests.get(role) for role in node['roles']],
+        [recipe_digests.get(recipe) for recipe in node['recipes']],
+        env_digests[environment],
+    ])
+
+
+def _write_atomically(path, content):
+    """Writes content to path, so that readers never see a partial file"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    # Temporary files are only readable by their owner
+    os.chmod(tmp_path, FILE_MODE)
+    os.rename(tmp_path, path)
+
+
+def _link_or_copy(src, dst):
+    """Hard links src to dst, falling back to a copy preserving the mtime"""
+    try:
+        os.link(src, dst)
+    except (AttributeError, OSError):
+        shutil.copy2(src, dst)
+
 
-    # Get override environment attributes
-    update_dct(attributes, environment.get('override_attributes', {}))
+def _init_build_worker(merger):
+    """Sets the attribute merger used to build node data bag items"""
+    global _merger
+    _merger = merger
 
-    # Merge back to the original node object
-    node.update(attributes)
+
+def _build_node_data_bag_item(task):
+    """Merges the attributes of a node and saves its data bag item"""
+    node, item_path = task
+    # Add node attributes
+    _merger.merge(node)
+    _add_automatic_attributes(node)
+
+    # Save node data bag item. Keys are sorted, as the order of a dict
+    # depends on its history, which differs once it goes through a worker
+    _write_atomically(item_path, json.dumps(node, sort_keys=True))
+
+
+def _build_node_data_bag_item_worker(task):
+    """Builds an item inside a pool worker, where aborting would kill the
+    worker instead of the run. Returns whether the item could be built
+
+    """
+    try:
+        _build_node_data_bag_item(task)
+    except SystemExit:
+        return False
+    return True
+
+
+def _build_node_data_bag_items(tasks, merger):
+    """Builds the given node data bag items, sharding them across
+    env.build_workers processes when there is more than one
+
+    """
+    workers = min(env.build_workers, len(tasks))
+    if workers <= 1:
+        _init_build_worker(merger)
+        for task in tasks:
+            _build_node_data_bag_item(task)
+        return
+    # Keep nodes sharing attribute layers together, so that each worker
+    # merges as few layers as possible
+    tasks = sorted(tasks, key=lambda task: (
+        task[0]['chef_environment'], task[0]['roles'], task[0]['recipes']))
+    pool = multiprocessing.Pool(workers, _init_build_worker, (merger,))
+    try:
+        chunksize = max(1, len(tasks) // (workers * 4))
+        results = pool.map(
+            _build_node_data_bag_item_worker, tasks, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+    if not all(results):
+        abort("Could not build the node data bag")
+
+
+def _read_fingerprints(path):
+    """Reads the fingerprints of the node data bag items kept in the cache"""
+    try:
+        with open(path, 'r') as f:
+            return json.loads(f.read())
+    except (IOError, ValueError):
+        return {}
 
 
 def build_node_data_bag():
@@ -316,40 +1055,136 @@ def build_node_data_bag():
         All attributes found in nodes/<item>.json file
         Default and override attributes from all roles
 
+    Items are kept in the kitchen's cache directory together with a
+    fingerprint of their inputs, and only rebuilt when it changes. Unchanged
+    items keep their contents and mtime, so that they are not synced again
+
     """
     nodes = lib.get_nodes()
     node_data_bag_path = os.path.join('data_bags', 'node')
     # In case there are leftovers
     remove_local_node_data_bag()
     os.makedirs(node_data_bag_path)
+    store_path = os.path.join(CACHE_DIR, 'data_bags', 'node')
+    if not os.path.isdir(store_path):
+        os.makedirs(store_path)
+    fingerprints_path = os.path.join(store_path, 'fingerprints')
+    fingerprints = _read_fingerprints(fingerprints_path)
     all_recipes = lib.get_recipes()
     all_roles = lib.get_roles()
+    recipe_digests = dict((r['name'], _digest(r)) for r in all_recipes)
+    # Roles are expanded by file name but merged by their 'name' field
+    role_digests = {}
+    for r in all_roles:
+        for name in set([r['name'], r['fullname']]):
+            role_digests.setdefault(name, []).append(_digest(r))
+    env_digests = {}
+    items = {}
+    tasks = []
     for node in nodes:
         # Dots are not allowed (only alphanumeric), substitute by underscores
         node['id'] = node['name'].replace('.', '_')
 
-        # Build extended role list
+        # Build extended role and recipe lists
         node['role'] = lib.get_roles_in_node(node)
-        node['roles'] = node['role'][:]
-        for role in node['role']:
-            node['roles'].extend(lib.get_roles_in_role(role))
-        node['roles'] = list(set(node['roles']))
+        node['roles'], node['recipes'] = lib.expand_run_list(node)
+
+        item_filename = node['id'] + '.json'
+        item_path = os.path.join(store_path, item_filename)
+        fingerprint = _get_node_fingerprint(
+            node, recipe_digests, role_digests, env_digests)
+        items[item_filename] = fingerprint
+        if (fingerprints.get(item_filename) != fingerprint or
+                not os.path.exists(item_path)):
+            tasks.append((node, item_path))
+    _build_node_data_bag_items(tasks, AttributeMerger(all_recipes, all_roles))
+
+    for item_filename in items:
+        _link_or_copy(os.path.join(store_path, item_filename),
+                      os.path.join(node_data_bag_path, item_filename))
+
+    # Forget about items of nodes that no longer exist
+    for filename in set(fingerprints) - set(items):
+        if os.path.exists(os.path.join(store_path, filename)):
+            os.remove(os.path.join(store_path, filename))
+    _write_atomically(fingerprints_path, json.dumps(items))
+
+
+def get_input_hashes(nodes):
+    """Returns a hash of everything a chef-solo run depends on for each of
+    the given nodes, which needs to be built with build_node_data_bag first:
+    the fingerprint of its node data bag item, which covers the node file,
+    its expanded roles, its environment and the LittleChef version, and the
+    contents of the kitchen files synced for its cookbooks. The data bag
+    items of other nodes are left out, so that adding a node doesn't change
+    the hash of every other one
 
-        # Build extended recipe list
-        node['recipes'] = lib.get_recipes_in_node(node)
-        # Add recipes found inside each roles in the extended role list
-        for role in node['roles']:
-            node['recipes'].extend(lib.get_recipes_in_role(role))
-        node['recipes'] = list(set(node['recipes']))
+    """
+    fingerprints = _read_fingerprints(
+        os.path.join(CACHE_DIR, 'data_bags', 'node', 'fingerprints'))
+    kitchen_digests = {}
+    hashes = {}
+    for node in nodes:
+        cookbooks = tuple(get_cookbooks_to_sync(node))
+        if cookbooks not in kitchen_digests:
+            files = dict((name, filename) for name, filename
+                         in _get_kitchen_files(cookbooks).items()
+                         if not name.startswith('data_bags/node/'))
+            kitchen_digests[cookbooks] = _digest(_get_manifest(files))
+        item_filename = node['name'].replace('.', '_') + '.json'
+        hashes[node['name']] = _digest([
+            littlechef.__version__,
+            fingerprints.get(item_filename),
+            kitchen_digests[cookbooks],
+        ])
+    return hashes
+
+
+def _get_converged_path(name):
+    return os.path.join(CACHE_DIR, 'converged', name)
+
+
+def is_unchanged(name, max_age=None):
+    """Returns whether the last run on the node was successful and had the
+    same inputs as the coming one, and when max_age is given, whether it
+    took place less than max_age hours ago
+
+    """
+    try:
+        with open(_get_converged_path(name), 'r') as f:
+            input_hash, timestamp = f.read().split()
+        timestamp = float(timestamp)
+    except (IOError, ValueError):
+        return False
+    if input_hash != env.get('input_hashes', {}).get(name):
+        return False
+    return max_age is None or time.time() - timestamp < max_age * 3600
+
+
+def forget_converged(name):
+    """Forgets about the last run on the node, before a new one"""
+    try:
+        os.remove(_get_converged_path(name))
+    except OSError:
+        pass
 
-        # Add node attributes
-        _add_merged_attributes(node, all_recipes, all_roles)
-        _add_automatic_attributes(node)
 
-        # Save node data bag item
-        with open(os.path.join(
-                  'data_bags', 'node', node['id'] + '.json'), 'w') as f:
-            f.write(json.dumps(node))
+def save_converged(name):
+    """Records the inputs of a successful run on the node. Why-run runs
+    don't change the node, so they are not recorded
+
+    """
+    input_hash = env.get('input_hashes', {}).get(name)
+    if whyrun or input_hash is None:
+        return
+    path = _get_converged_path(name)
+    if not os.path.isdir(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            # Created by another worker in the meantime
+            pass
+    _write_atomically(path, '{0} {1}\n'.format(input_hash, int(time.time())))
 
 
 def remove_local_node_data_bag():
@@ -388,31 +1223,31 @@ def ensure_berksfile_cookbooks_are_installed():
             print stdout, stderr
 
 
-def _remove_remote_node_data_bag():
-    """Removes generated 'node' data_bag from the remote node"""
-    node_data_bag_path = os.path.join(env.node_work_path, 'data_bags', 'node')
-    if exists(node_data_bag_path):
-        sudo("rm -rf {0}".format(node_data_bag_path))
+def _get_remote_data_bags():
+    """Returns the paths to remove so that remote data bags won't leak any
+    sensitive information
+
+    """
+    # What the last sync left is no longer complete either
+    return [os.path.join(env.node_work_path, path)
+            for path in ['data_bags'] + sorted(SYNC_MARKERS.values())]
 
-def _remove_remote_data_bags():
-    """Remove remote data bags, so it won't leak any sensitive information"""
-    data_bags_path = os.path.join(env.node_work_path, 'data_bags')
-    if exists(data_bags_path):
-        sudo("rm -rf {0}".format(data_bags_path))
 
 def _node_cleanup():
+    """Removes sensitive files from the node with a single remote call"""
     if env.loglevel is not "debug":
-        with hide('running', 'stdout'):
-            _remove_remote_node_data_bag()
-            if env.remove_data_bags:
-                _remove_remote_data_bags()
-            with settings(warn_only=True):
-                sudo("rm '/etc/chef/node.json'")
-                if env.encrypted_data_bag_secret:
-                    sudo("rm '/etc/chef/encrypted_data_bag_secret'")
-
-
-def _add_environment_lib():
+        paths = ['/etc/chef/node.json']
+        if env.encrypted_data_bag_secret:
+            paths.append('/etc/chef/encrypted_data_bag_secret')
+        # The node data bag is otherwise left in place, so that the next sync
+        # only transfers the items that changed
+        if env.remove_data_bags:
+            paths.extend(_get_remote_data_bags())
+        with settings(hide('running', 'stdout'), warn_only=True):
+            sudo("rm -rf {0}".format(' '.join(paths)))
+
+
+def _add_environment_lib(script):
     """Adds the chef_solo_envs cookbook, which provides a library that adds
     environment attribute compatibility for chef-solo v10
     NOTE: Chef 10 only
@@ -421,11 +1256,15 @@ def _add_environment_lib():
     # Create extra cookbook dir
     lib_path = os.path.join(env.node_work_path, cookbook_paths[0],
                             'chef_solo_envs', 'libraries')
-    with hide('running', 'stdout'):
-        sudo('mkdir -p {0}'.format(lib_path))
+    script.add('mkdir -p {0}'.format(lib_path),
+               "Could not create {0} dir".format(lib_path))
     # Add environment patch to the node's cookbooks
-    put(os.path.join(basedir, 'environment.rb'),
-        os.path.join(lib_path, 'environment.rb'), use_sudo=True)
+    script.install(os.path.join(lib_path, 'environment.rb'),
+                   filename=os.path.join(basedir, 'environment.rb'),
+                   mode=0644)
+    # So that the next rsync can remove it
+    script.add('chown -R {0} {1}'.format(
+        env.user, os.path.dirname(lib_path)))
 
 
 def _configure_node():
@@ -435,11 +1274,10 @@ def _configure_node():
     if env.parallel:
         msg = "[{0}]: {1}".format(env.host_string, msg)
     print(msg)
-    # Backup last report
-    with settings(hide('stdout', 'warnings', 'running'), warn_only=True):
-        sudo("mv {0} {0}.1".format(LOGFILE))
+    # Backup last report, in the same remote call as chef-solo
+    cmd = "mv {0} {0}.1 2>/dev/null; ".format(LOGFILE)
     # Build chef-solo command
-    cmd = "RUBYOPT=-Ku chef-solo"
+    cmd += "RUBYOPT=-Ku chef-solo"
     if whyrun:
         cmd += " --why-run"
     cmd += ' -l {0} -j /etc/chef/node.json'.format(env.loglevel)
@@ -454,6 +1292,8 @@ def _configure_node():
             ("Chef Run complete" not in output and
              "Report handlers complete" not in output)):
         if 'chef-solo: command not found' in output:
+            # So that autodeploy_chef notices next time
+            facts.forget()
             print(
                 colors.red(
                     "\nFAILED: Chef Solo is not installed on this node"))
@@ -0,0 +1,81 @@
+#Copyright 2010-2015 Miquel Torres <tobami@gmail.com>
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+"""Registry of the commands of the fix script
+
+Commands are read from the runner module without importing it, which would
+import Fabric and read the kitchen's configuration, so that listing them or
+telling about a mistyped one is quick. Nothing but the standard library may
+be imported here
+
+"""
+import os
+import sys
+import ast
+
+RUNNER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'runner.py')
+# Built on first use
+_commands = None
+
+
+def get_commands():
+    """Returns a dictionary mapping the name of every command to its
+    docstring. Commands are the public functions of the runner module, which
+    Fabric turns into tasks
+
+    """
+    global _commands
+    if _commands is None:
+        with open(RUNNER, 'r') as f:
+            tree = ast.parse(f.read(), RUNNER)
+        _commands = dict(
+            (node.name, ast.get_docstring(node, clean=False))
+            for node in tree.body
+            if isinstance(node, ast.FunctionDef)
+            and not node.name.startswith('_'))
+    return _commands
+
+
+def _get_width():
+    """Returns the width of the terminal, as Fabric finds it"""
+    if sys.platform != 'win32' and sys.stdout.isatty():
+        import fcntl
+        import struct
+        import termios
+        try:
+            return struct.unpack('HH', fcntl.ioctl(
+                sys.stdout.fileno(), termios.TIOCGWINSZ,
+                struct.pack('HH', 0, 0)))[1] or 80
+        except IOError:
+            pass
+    return 80
+
+
+def list_commands():
+    """Returns the lines listing all commands as 'fab -l' does"""
+    names = sorted(get_commands())
+    max_len = max(len(name) for name in names)
+    trail = '...'
+    size = _get_width() - 1 - 2 * len(trail) - max_len - 2
+    lines = ["Available commands:\n"]
+    for name in names:
+        docstring = get_commands()[name]
+        if docstring:
+            first_line = filter(None, docstring.splitlines())[0].strip()
+            if len(first_line) > size:
+                first_line = first_line[:size] + trail
+            lines.append('    ' + name.ljust(max_len) + '  ' + first_line)
+        else:
+            lines.append('    ' + name)
+    return lines
@@ -16,3 +16,8 @@
 
 class FileNotFoundError(Exception):
     pass
+
+
+class MetadataError(Exception):
+    """Raised when a metadata.rb file uses Ruby LittleChef can't evaluate"""
+    pass
@@ -0,0 +1,115 @@
+#Copyright 2010-2015 Miquel Torres <tobami@gmail.com>
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+"""Local store of facts about nodes, such as their IP address or whether
+chef-solo is installed, so that nodes are not asked for them on every run
+
+"""
+import os
+import json
+import time
+import tempfile
+
+from fabric.api import env, settings, hide, sudo
+from fabric.utils import abort
+
+from littlechef import CACHE_DIR
+
+FACTS_DIR = os.path.join(CACHE_DIR, 'facts')
+# Hours after which facts are gathered again when needed
+FACTS_TTL = 24
+# Attributes kept from ohai's output
+OHAI_ATTRIBUTES = ['ipaddress', 'platform', 'platform_family',
+                   'platform_version', 'virtualization']
+SEPARATOR = '--- littlechef: chef-solo version ---'
+
+
+def _get_path(name):
+    return os.path.join(FACTS_DIR, name + '.json')
+
+
+def _load(name):
+    """Returns the stored facts of the node and when they were gathered"""
+    try:
+        with open(_get_path(name), 'r') as f:
+            stored = json.loads(f.read())
+        return stored['facts'], stored['time']
+    except (IOError, ValueError, KeyError, TypeError):
+        return None, None
+
+
+def _save(name, facts):
+    if not os.path.isdir(FACTS_DIR):
+        try:
+            os.makedirs(FACTS_DIR)
+        except OSError:
+            # Created by another worker in the meantime
+            pass
+    fd, tmp_path = tempfile.mkstemp(dir=FACTS_DIR)
+    with os.fdopen(fd, 'w') as f:
+        f.write(json.dumps({'time': time.time(), 'facts': facts}))
+    os.rename(tmp_path, _get_path(name))
+
+
+def _parse(output):
+    """Returns the facts found in the output of the gathering command"""
+    ohai_output, _, chef_output = output.partition(SEPARATOR)
+    ohai = {}
+    if ohai_output.strip():
+        try:
+            ohai = json.loads(ohai_output)
+        except ValueError:
+            abort("Could not parse ohai's output:\n  {0}".format(ohai_output))
+    facts = dict((attribute, ohai.get(attribute))
+                 for attribute in OHAI_ATTRIBUTES)
+    # None when chef-solo is not installed
+    facts['chef_solo'] = chef_output.strip() or None
+    return facts
+
+
+def gather():
+    """Gathers the facts of the current node with a single remote call and
+    stores them. Nodes without Chef installed have no ohai facts
+
+    Returns the facts
+
+    """
+    with settings(hide('stdout', 'running'), warn_only=True):
+        output = sudo('ohai -l warn 2>/dev/null; echo "{0}"; '
+                      'chef-solo --version 2>/dev/null'.format(SEPARATOR))
+    facts = _parse(output)
+    _save(env.host_string, facts)
+    return facts
+
+
+def get_facts():
+    """Returns the facts of the current node, from the store unless they are
+    older than env.facts_ttl hours, in which case they are gathered again
+
+    """
+    facts, gathered = _load(env.host_string)
+    if facts is None or time.time() - gathered > env.facts_ttl * 3600:
+        facts = gather()
+    return facts
+
+
+def forget(name=None):
+    """Removes the stored facts of the given node, by default the current
+    one, so that they are gathered again when needed
+
+    """
+    try:
+        os.remove(_get_path(name or env.host_string))
+    except OSError:
+        pass
@@ -0,0 +1,525 @@
+#Copyright 2010-2015 Miquel Torres <tobami@gmail.com>
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+"""Runs a task on many hosts at once, as threads of a single process
+
+Fabric's parallel mode forks a process per host. Here, the kitchen is
+loaded once and every host gets a thread with its own SSH connection.
+Fabric keeps its settings in the global env and output dictionaries, so
+each thread gets its own view of them: what a thread changes, with
+settings() or otherwise, is only seen by that thread
+
+"""
+import os
+import sys
+import time
+import threading
+import multiprocessing
+from contextlib import contextmanager
+
+from fabric import state, operations
+from fabric.api import settings
+from fabric.network import to_dict, normalize_to_string
+from fabric.thread_handling import ThreadHandler
+from fabric.utils import abort, _AttributeDict, _AliasDict
+
+# Hosts run at once by commands which always run on all hosts together,
+# unless --concurrency is given
+WORKERS = 10
+# Stands for a key removed by a thread
+_REMOVED = object()
+# Phases of a host's task which compete for the resources of this host,
+# like the CPU and the uplink, rather than run on the host itself
+LOCAL_PHASES = ('configure', 'sync')
+# Durations of the phases of the task run by the current thread
+_phases = threading.local()
+
+
+class _ThreadOverlay(dict):
+    """Dictionary whose changes are kept apart in threads with an overlay"""
+
+    def _overlay(self):
+        return getattr(self.__dict__['_local'], 'values', None)
+
+    def __getitem__(self, key):
+        overlay = self._overlay()
+        if overlay is not None and key in overlay:
+            if overlay[key] is _REMOVED:
+                raise KeyError(key)
+            return overlay[key]
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        overlay = self._overlay()
+        if overlay is None:
+            dict.__setitem__(self, key, value)
+        else:
+            overlay[key] = value
+
+    def __delitem__(self, key):
+        overlay = self._overlay()
+        if overlay is None:
+            dict.__delitem__(self, key)
+        elif key not in self:
+            raise KeyError(key)
+        else:
+            overlay[key] = _REMOVED
+
+    def __contains__(self, key):
+        overlay = self._overlay()
+        if overlay is not None and key in overlay:
+            return overlay[key] is not _REMOVED
+        return dict.__contains__(self, key)
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key not in self and default:
+            return default[0]
+        value = self[key]
+        del self[key]
+        return value
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def keys(self):
+        overlay = self._overlay()
+        if overlay is None:
+            return dict.keys(self)
+        keys = set(dict.keys(self)) | set(overlay)
+        return [key for key in keys if key in self]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def copy(self):
+        return dict(self.items())
+
+
+class _ThreadEnv(_AttributeDict, _ThreadOverlay):
+    pass
+
+
+class _ThreadOutput(_AliasDict, _ThreadOverlay):
+    pass
+
+
+class _ViewThreadHandler(ThreadHandler):
+    """Thread handler whose thread shares the view of env and output of the
+    thread starting it, as Fabric's input and output threads need the
+    settings of the host they serve
+
+    """
+    def __init__(self, name, callable, *args, **kwargs):
+        views = _get_views()
+
+        def run(*args, **kwargs):
+            with _host_view(views):
+                callable(*args, **kwargs)
+        super(_ViewThreadHandler, self).__init__(name, run, *args, **kwargs)
+
+
+@contextmanager
+def _thread_settings():
+    """Gives Fabric's env and output a view of their own in every thread
+    started while the context lasts
+
+    """
+    originals = [(state.env, state.env.__class__),
+                 (state.output, state.output.__class__)]
+    for dictionary, cls in [(state.env, _ThreadEnv),
+                            (state.output, _ThreadOutput)]:
+        # Their __setattr__ would set a key instead
+        dict.__setattr__(dictionary, '_local', threading.local())
+        dict.__setattr__(dictionary, '__class__', cls)
+    operations.ThreadHandler = _ViewThreadHandler
+    try:
+        yield
+    finally:
+        operations.ThreadHandler = ThreadHandler
+        for dictionary, cls in originals:
+            dict.__setattr__(dictionary, '__class__', cls)
+            del dictionary.__dict__['_local']
+
+
+def _get_views():
+    """Returns the changes the current thread made to env and output"""
+    return (getattr(state.env.__dict__['_local'], 'values', None),
+            getattr(state.output.__dict__['_local'], 'values', None))
+
+
+@contextmanager
+def _host_view(views=(None, None)):
+    """Keeps the changes of the current thread to env and output apart
+    * views: the changes of another thread, to share them with it
+
+    """
+    env_view, output_view = views
+    state.env.__dict__['_local'].values = (
+        {} if env_view is None else env_view)
+    state.output.__dict__['_local'].values = (
+        {} if output_view is None else output_view)
+    try:
+        yield
+    finally:
+        state.env.__dict__['_local'].values = None
+        state.output.__dict__['_local'].values = None
+
+
+def in_worker():
+    """Returns whether the current thread runs a host of the fleet"""
+    local = state.env.__dict__.get('_local')
+    return local is not None and getattr(local, 'values', None) is not None
+
+
+def _disconnect(host):
+    """Closes the connection to a host once its task is done, as Fabric
+    does with eagerly_disconnect
+
+    """
+    key = normalize_to_string(host)
+    connection = state.connections.pop(key, None)
+    if connection is not None:
+        connection.close()
+
+
+@contextmanager
+def phase(name):
+    """Records how long a phase of the task of the current host takes, for
+    AdaptiveConcurrency. Does nothing outside of the fleet
+
+    """
+    durations = getattr(_phases, 'durations', None)
+    start = time.time()
+    try:
+        yield
+    finally:
+        if durations is not None:
+            durations[name] = time.time() - start
+
+
+def _run(task, host, args, kwargs):
+    """Runs the task for one host in the current thread
+    Returns a (succeeded, result or exception, phase durations) tuple
+
+    """
+    host_settings = to_dict(host)
+    host_settings.update({'parallel': True, 'linewise': True})
+    _phases.durations = {}
+    with _host_view():
+        try:
+            with settings(**host_settings):
+                try:
+                    return True, task(*args, **kwargs), _phases.durations
+                finally:
+                    _disconnect(host)
+        except BaseException as e:
+            if not isinstance(e, SystemExit):
+                sys.stderr.write(
+                    "!!! Parallel execution exception under host {0!r}:\n"
+                    "{1}: {2}\n".format(host, e.__class__.__name__, e))
+            return False, e, _phases.durations
+        finally:
+            _phases.durations = None
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def _get_load():
+    """Returns the load average of this host per CPU, or None when it is not
+    known
+
+    """
+    try:
+        return os.getloadavg()[0] / multiprocessing.cpu_count()
+    except (AttributeError, OSError, NotImplementedError):
+        return None
+
+
+class AdaptiveConcurrency(object):
+    """Grows or shrinks the number of hosts in flight while a run goes on,
+    to get the most hosts done per minute
+
+    Every time as many hosts as are in flight are done, the rate of hosts
+    done per minute is compared with the previous one. The limit doubles
+    while the rate keeps improving, then grows or shrinks a step at a time.
+    It is cut down when this host gets congested, which shows as:
+    * the local phases of a task (see LOCAL_PHASES), where SSH handshakes
+      and transfers happen, taking much longer than they did at best
+    * hosts failing before chef-solo ran, as with timed out connections
+    * a load average above the number of CPUs
+
+    """
+    # How much slower local phases may get before backing off
+    LATENCY_FACTOR = 3
+    # Changes in the rate smaller than this are considered noise
+    TOLERANCE = 0.05
+
+    def __init__(self, initial=4, minimum=1, maximum=512, clock=time.time,
+                 load=_get_load):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self._clock = clock
+        self._load = load
+        self._growing = True
+        self._rate = None
+        self._best_latency = None
+        self._start_window()
+
+    def _start_window(self):
+        self._window_start = self._clock()
+        self._done = 0
+        self._congested = 0
+        self._latencies = []
+
+    def record(self, succeeded, phases):
+        """Takes note of a host being done
+        * phases: the durations of the phases of its task
+
+        """
+        self._done += 1
+        if not succeeded and 'cook' not in phases:
+            self._congested += 1
+        latency = sum(phases.get(name, 0) for name in LOCAL_PHASES)
+        if latency:
+            self._latencies.append(latency)
+        if self._done >= self.limit:
+            self._adjust()
+
+    def _adjust(self):
+        elapsed = max(self._clock() - self._window_start, 0.001)
+        rate = self._done * 60 / elapsed
+        latency = _median(self._latencies) if self._latencies else None
+        if latency is not None and (self._best_latency is None or
+                                    latency < self._best_latency):
+            self._best_latency = latency
+        load = self._load()
+        step = max(1, self.limit // 8)
+        previous = self.limit
+        if (self._congested or (load is not None and load > 1) or
+                (latency is not None and
+                 latency > self._best_latency * self.LATENCY_FACTOR)):
+            self._growing = False
+            self.limit = self.limit * 3 // 4
+        elif self._rate is None or rate > self._rate * (1 + self.TOLERANCE):
+            self.limit = self.limit * 2 if self._growing else self.limit + step
+        elif rate < self._rate * (1 - self.TOLERANCE):
+            self._growing = False
+            self.limit -= step
+        self.limit = min(max(self.limit, self.minimum), self.maximum)
+        if self.limit != previous and state.env.get('verbose'):
+            print("Concurrency: {0} -> {1} hosts ({2:.1f} hosts/min)".format(
+                previous, self.limit, rate))
+        self._rate = rate
+        self._start_window()
+
+
+def _dispatch(task, hosts, workers, args, kwargs, controller=None,
+              rollout=None):
+    """Runs the task on the given hosts, starting one as long as fewer than
+    workers, or the limit of the controller, are in flight and the rollout,
+    if any, allows it
+
+    Returns a dictionary with the result of the task for every host that
+    was run, and the list of hosts which failed
+
+    """
+    pending = list(hosts)
+    results = {}
+    failed = []
+    in_flight = [0]
+    done = threading.Condition()
+
+    def worker(host):
+        succeeded, result, phases = _run(task, host, args, kwargs)
+        with done:
+            results[host] = result
+            if not succeeded:
+                failed.append(host)
+            if controller is not None:
+                controller.record(succeeded, phases)
+            if rollout is not None:
+                rollout.finished(host, succeeded)
+            in_flight[0] -= 1
+            done.notify()
+
+    with done:
+        while in_flight[0] or pending and not (rollout and rollout.tripped()):
+            limit = workers if controller is None else controller.limit
+            for host in list(pending):
+                if in_flight[0] >= limit or rollout and rollout.tripped():
+                    break
+                if rollout is not None and not rollout.can_start(host):
+                    continue
+                pending.remove(host)
+                if rollout is not None:
+                    rollout.started(host)
+                thread = threading.Thread(target=worker, args=(host,))
+                thread.daemon = True
+                thread.start()
+                in_flight[0] += 1
+            # A timeout keeps the main thread responsive to Ctrl-C
+            done.wait(1)
+    return results, failed
+
+
+def _open_gateway():
+    if state.env.get('gateway'):
+        # Shared by all threads, so it is opened before any of them needs it
+        state.connections[state.env.gateway]
+
+
+def _abort_failed(task, failed):
+    if failed:
+        abort("One or more hosts failed while executing task '{0}': "
+              "{1}".format(task.__name__, ', '.join(sorted(failed))))
+
+
+def execute(task, hosts, workers, *args, **kwargs):
+    """Runs the task with the given arguments on every host, with up to
+    workers of them at a time. When workers is 'auto', AdaptiveConcurrency
+    decides how many
+
+    Returns a dictionary with the result of the task for every host.
+    Aborts once all hosts are done if any of them failed, as Fabric's
+    parallel mode does
+
+    """
+    controller = AdaptiveConcurrency() if workers == 'auto' else None
+    _open_gateway()
+    with _thread_settings():
+        results, failed = _dispatch(task, hosts, workers, args, kwargs,
+                                    controller)
+    _abort_failed(task, failed)
+    return results
+
+
+class Rollout(object):
+    """Decides which hosts of a rolling deployment may start
+
+    Hosts are run in waves: a canary wave, then waves growing by the given
+    factor, each one starting once the previous one is done. No more hosts
+    are started once the share of failed hosts goes over max_failures
+    * role_limits: the most hosts with each role which may be in flight at
+      once
+    * roles: the roles of each host
+
+    """
+    def __init__(self, canary=1, growth=2, max_failures=0, role_limits=None,
+                 roles=None):
+        self.canary = canary
+        self.growth = growth
+        self.max_failures = max_failures
+        self.role_limits = role_limits or {}
+        self.roles = roles or {}
+        self.done = 0
+        self.failed = 0
+        self._in_flight = {}
+
+    def waves(self, hosts):
+        """Splits the hosts into waves"""
+        waves = []
+        size = self.canary
+        while hosts:
+            waves.append(hosts[:size])
+            hosts = hosts[size:]
+            size = max(size + 1, int(size * self.growth))
+        return waves
+
+    def _limited_roles(self, host):
+        return [role for role in self.roles.get(host, [])
+                if role in self.role_limits]
+
+    def can_start(self, host):
+        return all(self._in_flight.get(role, 0) < self.role_limits[role]
+                   for role in self._limited_roles(host))
+
+    def started(self, host):
+        for role in self._limited_roles(host):
+            self._in_flight[role] = self._in_flight.get(role, 0) + 1
+
+    def finished(self, host, succeeded):
+        for role in self._limited_roles(host):
+            self._in_flight[role] -= 1
+        self.done += 1
+        if not succeeded:
+            self.failed += 1
+
+    def tripped(self):
+        """Returns whether too many hosts failed to go on"""
+        return self.failed > self.done * self.max_failures
+
+
+def roll_out(task, hosts, workers, rollout, *args, **kwargs):
+    """Runs the task with the given arguments on every host in the waves of
+    the given Rollout, with up to workers of them at a time, or as decided
+    by AdaptiveConcurrency when workers is 'auto'
+
+    Aborts when the rollout is stopped or once all hosts are done if any of
+    them failed
+
+    """
+    controller = AdaptiveConcurrency() if workers == 'auto' else None
+    results = {}
+    failed = []
+    waves = rollout.waves(list(hosts))
+    _open_gateway()
+    with _thread_settings():
+        for number, wave in enumerate(waves, 1):
+            print("Rollout wave {0} of {1}: {2} node{3}".format(
+                number, len(waves), len(wave), '' if len(wave) == 1 else 's'))
+            wave_results, wave_failed = _dispatch(
+                task, wave, workers, args, kwargs, controller, rollout)
+            results.update(wave_results)
+            failed.extend(wave_failed)
+            if rollout.tripped():
+                skipped = [host for host in hosts if host not in results]
+                abort("Stopping the rollout: {0} of {1} nodes failed ({2})."
+                      "\nNot configured: {3}".format(
+                          rollout.failed, rollout.done,
+                          ', '.join(sorted(failed)),
+                          ', '.join(skipped) or 'none'))
+    _abort_failed(task, failed)
+    return results
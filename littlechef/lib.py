@@ -14,18 +14,45 @@
 #
 """Library for parsing and printing role, cookbook and node information"""
 import os
+import sys
+import ast
 import json
+import marshal
+import hashlib
+import tempfile
+import time
 import subprocess
 import imp
+import collections
+import multiprocessing
+import threading
+import cPickle as pickle
+from bisect import bisect_left
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
 
 from fabric.api import env
 from fabric.contrib.console import confirm
 from fabric.utils import abort
 
-from littlechef import cookbook_paths, colors
+from littlechef import cookbook_paths, colors, metadata, CACHE_DIR
+from littlechef.cache import kitchen_index, RACY_INTERVAL
 from littlechef.exceptions import FileNotFoundError
 
 knife_installed = True
+# Guards knife_installed when knife is run by several threads
+_knife_lock = threading.Lock()
+# Modification time of the metadata.rb files whose metadata.json was already
+# regenerated, or attempted to, by this process, see _claim_metadata()
+_metadata_attempts = {}
+# Expanded run_lists of every role loaded so far, see expand_role()
+_role_expansions = {}
+# Inverted indexes over the kitchen nodes, see get_node_index()
+_node_index = None
+NODE_INDEX_PATH = os.path.join(CACHE_DIR, 'nodes')
+NODE_INDEX_VERSION = 1
+# Cookbooks each cookbook depends on, see get_cookbook_closure()
+_cookbook_dependencies = {}
 
 
 def _resolve_hostname(name):
@@ -59,19 +86,24 @@ def env_from_template(name):
     }
 
 
+def _read_json(filename):
+    """Reads and parses a JSON kitchen file, aborting on syntax errors"""
+    with open(filename, 'r') as f:
+        try:
+            return json.loads(f.read())
+        except ValueError as e:
+            msg = 'LittleChef found the following error in'
+            msg += ' "{0}":\n                {1}'.format(filename, str(e))
+            abort(msg)
+
+
 def get_environment(name):
     """Returns a JSON environment file as a dictionary"""
     if name == "_default":
         return env_from_template(name)
     filename = os.path.join("environments", name + ".json")
     try:
-        with open(filename) as f:
-            try:
-                return json.loads(f.read())
-            except ValueError as e:
-                msg = 'LittleChef found the following error in'
-                msg += ' "{0}":\n                {1}'.format(filename, str(e))
-                abort(msg)
+        return kitchen_index.get(filename, _read_json)
     except IOError:
         raise FileNotFoundError('File {0} not found'.format(filename))
 
@@ -85,24 +117,84 @@ def get_environments():
                 path = os.path.join(
                     root[len('environments'):], filename[:-len('.json')])
                 envs.append(get_environment(path))
+    kitchen_index.save()
     return sorted(envs, key=lambda x: x['name'])
 
 
-def get_node(name, merged=False):
-    """Returns a JSON node file as a dictionary"""
+class LazyNode(collections.MutableMapping):
+    """A node of which only some top-level fields have been read
+
+    The rest of the node file is only loaded the first time any other field
+    is accessed, so that the large attributes found in some node files are
+    not loaded when only the name, environment or run_list are needed. Use
+    dict(node) to get a plain dictionary
+
+    """
+    def __init__(self, name, node_path, fields):
+        self._fields = set(fields) | set(['name', 'chef_environment'])
+        self._data = kitchen_index.get(node_path, _read_json, self._fields)
+        self._data['name'] = name
+        if not self._data.get('chef_environment'):
+            self._data['chef_environment'] = '_default'
+
+    def _load(self):
+        """Reads all fields, keeping the ones that were changed"""
+        if self._fields is not None:
+            data = get_node(self._data['name'])
+            data.update(self._data)
+            self._data = data
+            self._fields = None
+
+    def __getitem__(self, key):
+        if key not in self._data and (self._fields is not None and
+                                      key not in self._fields):
+            self._load()
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        self._load()
+        del self._data[key]
+
+    def __contains__(self, key):
+        if key in self._data:
+            return True
+        if self._fields is not None and key in self._fields:
+            return False
+        self._load()
+        return key in self._data
+
+    def __iter__(self):
+        self._load()
+        return iter(self._data)
+
+    def __len__(self):
+        self._load()
+        return len(self._data)
+
+    def __repr__(self):
+        return "<LazyNode {0}>".format(self._data['name'])
+
+
+def get_node(name, merged=False, fields=None):
+    """Returns a JSON node file as a dictionary
+    * fields: when given, a LazyNode with only these fields read is returned
+
+    """
     if merged:
         node_path = os.path.join("data_bags", "node", name.replace('.', '_') + ".json")
     else:
         node_path = os.path.join("nodes", name + ".json")
     if os.path.exists(node_path):
-        # Read node.json
-        with open(node_path, 'r') as f:
-            try:
-                node = json.loads(f.read())
-            except ValueError as e:
-                msg = 'LittleChef found the following error in'
-                msg += ' "{0}":\n                {1}'.format(node_path, str(e))
-                abort(msg)
+        if fields is not None and not merged:
+            return LazyNode(name, node_path, fields)
+        # Read node.json. Generated data bag items are not worth indexing
+        if merged:
+            node = _read_json(node_path)
+        else:
+            node = kitchen_index.get(node_path, _read_json)
     else:
         print "Creating new node file '{0}.json'".format(name)
         node = {'run_list': []}
@@ -113,8 +205,11 @@ def get_node(name, merged=False):
     return node
 
 
-def get_nodes(environment=None):
-    """Gets all nodes found in the nodes/ directory"""
+def get_nodes(environment=None, fields=None):
+    """Gets all nodes found in the nodes/ directory
+    * fields: when given, LazyNodes with only these fields read are returned
+
+    """
     if not os.path.exists('nodes'):
         return []
     nodes = []
@@ -123,52 +218,194 @@ def get_nodes(environment=None):
              if (not os.path.isdir(f)
                  and f.endswith(".json") and not f.startswith('.'))]):
         fqdn = ".".join(filename.split('.')[:-1])  # Remove .json from name
-        node = get_node(fqdn)
-        if environment is None or node.get('chef_environment') == environment:
-            nodes.append(node)
+        if environment is None and fields is None:
+            nodes.append(get_node(fqdn))
+            continue
+        # Only read the environment of nodes that may be filtered out
+        node = get_node(fqdn, fields=fields or [])
+        if environment is None or node['chef_environment'] == environment:
+            nodes.append(node if fields is not None else get_node(fqdn))
+    kitchen_index.save()
     return nodes
 
 
+class NodeIndex(object):
+    """Inverted indexes mapping roles, recipes, tags and environments to the
+    nodes that have them, so that node selection is a lookup
+
+    Roles and recipes are indexed from the expanded run_list of each node.
+    Nodes are returned in the same order as get_nodes(), and are shared
+    between lookups, so they should not be modified
+
+    """
+    # Node fields needed to build the index and to walk guests
+    FIELDS = ['run_list', 'tags', 'fqdn', 'virtualization']
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.by_role = {}
+        self.by_recipe = {}
+        self.by_tag = {}
+        self.by_environment = {}
+        for position, node in enumerate(nodes):
+            roles, recipes = expand_run_list(node)
+            for role in roles:
+                self.by_role.setdefault(role, []).append(position)
+            for recipe in recipes:
+                self.by_recipe.setdefault(recipe, []).append(position)
+            for tag in set(node.get('tags', [])):
+                self.by_tag.setdefault(tag, []).append(position)
+            self.by_environment.setdefault(
+                node.get('chef_environment'), []).append(position)
+        # Sorted keys, to answer prefix searches with a binary search
+        self.role_names = sorted(self.by_role)
+        self.recipe_names = sorted(self.by_recipe)
+
+    def _positions(self, index, names, name):
+        """Returns the positions of the nodes indexed under name, or under
+        any name starting with the given prefix when it ends with '*'
+
+        """
+        if not name.endswith("*"):
+            return set(index.get(name, []))
+        prefix = name.rstrip("*")
+        positions = set()
+        for i in xrange(bisect_left(names, prefix), len(names)):
+            if not names[i].startswith(prefix):
+                break
+            positions.update(index[names[i]])
+        return positions
+
+    def _select(self, positions, environment):
+        """Returns the nodes in the given positions and environment"""
+        if environment is not None:
+            positions &= set(self.by_environment.get(environment, []))
+        return [self.nodes[i] for i in sorted(positions)]
+
+    def with_role(self, name, environment=None):
+        return self._select(
+            self._positions(self.by_role, self.role_names, name), environment)
+
+    def with_recipe(self, name, environment=None):
+        return self._select(
+            self._positions(self.by_recipe, self.recipe_names, name),
+            environment)
+
+    def with_tag(self, tag, environment=None):
+        return self._select(set(self.by_tag.get(tag, [])), environment)
+
+    def in_environment(self, environment=None):
+        return self._select(set(xrange(len(self.nodes))), environment)
+
+
+def _get_files_signature(dirname):
+    """Returns the path, mtime and size of every JSON file in dirname and
+    its subdirectories
+
+    """
+    signature = []
+    for root, subfolders, files in os.walk(dirname):
+        subfolders.sort()
+        for filename in sorted(files):
+            if filename.endswith(".json") and not filename.startswith('.'):
+                path = os.path.join(root, filename)
+                stat = os.stat(path)
+                signature.append((path, stat.st_mtime, stat.st_size))
+    return tuple(signature)
+
+
+def _get_nodes_signature():
+    """Returns the signature of the node files and of the role files, which
+    change the expanded run_lists of nodes
+
+    """
+    return _get_files_signature('nodes'), _get_files_signature('roles')
+
+
+def _load_node_index():
+    """Returns the signature and node index stored by an earlier run"""
+    try:
+        with open(NODE_INDEX_PATH, 'rb') as f:
+            version, signature, index = pickle.load(f)
+    except (IOError, EOFError, ValueError, TypeError, AttributeError,
+            ImportError, pickle.UnpicklingError):
+        return None
+    if version != NODE_INDEX_VERSION:
+        return None
+    return signature, index
+
+
+def _save_node_index(signature, index):
+    """Stores the node index for later runs, unless a file was modified so
+    recently that a later change could go unnoticed
+
+    """
+    now = time.time()
+    for files in signature:
+        if any(now - mtime <= RACY_INTERVAL for _, mtime, _ in files):
+            return
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((NODE_INDEX_VERSION, signature, index), f, 2)
+        os.rename(tmp_path, NODE_INDEX_PATH)
+    except (IOError, OSError):
+        # A read-only kitchen just means the index is built next time
+        pass
+
+
+def get_node_index():
+    """Returns the node index, which is kept in the kitchen's cache directory
+    and only built again when a node or role file has been added, removed or
+    modified
+
+    """
+    global _node_index
+    signature = _get_nodes_signature()
+    if _node_index is None:
+        _node_index = _load_node_index()
+    if _node_index is None or _node_index[0] != signature:
+        _node_index = (
+            signature, NodeIndex(get_nodes(fields=NodeIndex.FIELDS)))
+        _save_node_index(*_node_index)
+    return _node_index[1]
+
+
 def get_nodes_with_role(role_name, environment=None):
     """Get all nodes which include a given role,
     prefix-searches are also supported
 
     """
-    prefix_search = role_name.endswith("*")
-    if prefix_search:
-        role_name = role_name.rstrip("*")
-    for n in get_nodes(environment):
-        roles = get_roles_in_node(n, recursive=True)
-        if prefix_search:
-            if any(role.startswith(role_name) for role in roles):
-                yield n
-        else:
-            if role_name in roles:
-                yield n
+    for n in get_node_index().with_role(role_name, environment):
+        yield n
 
 
 def get_nodes_with_tag(tag, environment=None, include_guests=False):
     """Get all nodes which include a given tag"""
-    nodes = get_nodes(environment)
-    nodes_mapping = dict((n['name'], n) for n in nodes)
-    for n in nodes:
-        if tag in n.get('tags', []):
-            # Remove from node mapping so it doesn't get added twice by
-            # guest walking below
-            try:
-                del nodes_mapping[n['fqdn']]
-            except KeyError:
-                pass
-            yield n
-            # Walk guest if it is a host
-            if include_guests and n.get('virtualization', {}).get('role') == 'host':
-                for guest in n['virtualization'].get('guests', []):
-                    try:
-                        yield nodes_mapping[guest['fqdn']]
-                    except KeyError:
-                        # we ignore guests which are not in the same
-                        # chef environments than their hosts for now
-                        pass
+    index = get_node_index()
+    nodes_mapping = {}
+    if include_guests:
+        nodes_mapping = dict(
+            (n['name'], n) for n in index.in_environment(environment))
+    for n in index.with_tag(tag, environment):
+        # Remove from node mapping so it doesn't get added twice by
+        # guest walking below
+        try:
+            del nodes_mapping[n['fqdn']]
+        except KeyError:
+            pass
+        yield n
+        # Walk guest if it is a host
+        if include_guests and n.get('virtualization', {}).get('role') == 'host':
+            for guest in n['virtualization'].get('guests', []):
+                try:
+                    yield nodes_mapping[guest['fqdn']]
+                except KeyError:
+                    # we ignore guests which are not in the same
+                    # chef environments than their hosts for now
+                    pass
 
 
 def get_nodes_with_recipe(recipe_name, environment=None):
@@ -176,19 +413,8 @@ def get_nodes_with_recipe(recipe_name, environment=None):
     prefix-searches are also supported
 
     """
-    prefix_search = recipe_name.endswith("*")
-    if prefix_search:
-        recipe_name = recipe_name.rstrip("*")
-    for n in get_nodes(environment):
-        recipes = get_recipes_in_node(n)
-        for role in get_roles_in_node(n, recursive=True):
-            recipes.extend(get_recipes_in_role(role))
-        if prefix_search:
-            if any(recipe.startswith(recipe_name) for recipe in recipes):
-                yield n
-        else:
-            if recipe_name in recipes:
-                yield n
+    for n in get_node_index().with_recipe(recipe_name, environment):
+        yield n
 
 
 def print_node(node, detailed=False):
@@ -225,47 +451,126 @@ def print_nodes(nodes, detailed=False):
     print("\nFound {0} node{1}".format(found, "s" if found != 1 else ""))
 
 
-def _generate_metadata(path, cookbook_path, name):
-    """Checks whether metadata.rb has changed and regenerate metadata.json"""
-    global knife_installed
-    if not knife_installed:
-        return
+def _metadata_is_outdated(path):
+    """Returns True when a cookbook's metadata.rb is newer than its
+    metadata.json, or there is no metadata.json
+
+    """
     metadata_path_rb = os.path.join(path, 'metadata.rb')
     metadata_path_json = os.path.join(path, 'metadata.json')
-    if (os.path.exists(metadata_path_rb) and
+    return (os.path.exists(metadata_path_rb) and
             (not os.path.exists(metadata_path_json) or
              os.stat(metadata_path_rb).st_mtime >
-             os.stat(metadata_path_json).st_mtime)):
-        error_msg = "Warning: metadata.json for {0}".format(name)
-        error_msg += " in {0} is older that metadata.rb".format(cookbook_path)
-        error_msg += ", cookbook attributes could be out of date\n\n"
-        try:
-            proc = subprocess.Popen(
-                ['knife', 'cookbook', 'metadata', '-o', cookbook_path, name],
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            resp, error = proc.communicate()
-            if ('ERROR:' in resp or 'FATAL:' in resp
-                    or 'Generating metadata for' not in resp):
-                if("No user specified, pass via -u or specifiy 'node_name'"
-                        in error):
-                    error_msg += "You need to have an up-to-date (>=0.10.x)"
-                    error_msg += " version of knife installed locally in order"
-                    error_msg += " to generate metadata.json.\nError "
-                else:
-                    error_msg += "Unkown error "
-                error_msg += "while executing knife to generate "
-                error_msg += "metadata.json for {0}".format(path)
-                print(error_msg)
-                print resp
-            if env.loglevel == 'debug':
-                print "\n".join(resp.split("\n")[:2])
-        except OSError:
+             os.stat(metadata_path_json).st_mtime))
+
+
+def _claim_metadata(path):
+    """Returns True when metadata.json of the cookbook at path is outdated
+    and no attempt was made yet at regenerating it, and records the attempt,
+    so that failures are neither retried nor reported twice
+
+    """
+    if not _metadata_is_outdated(path):
+        return False
+    mtime = os.stat(os.path.join(path, 'metadata.rb')).st_mtime
+    if _metadata_attempts.get(path) == mtime:
+        return False
+    _metadata_attempts[path] = mtime
+    return True
+
+
+def _generate_metadata(path, cookbook_path, name):
+    """Checks whether metadata.rb has changed and regenerate metadata.json
+    Knife is only used when LittleChef can't evaluate metadata.rb itself
+
+    """
+    if not _claim_metadata(path):
+        return
+    if metadata.generate(path, name):
+        if env.loglevel == 'debug':
+            print("Generated metadata.json for {0}\n".format(path))
+    else:
+        _generate_metadata_with_knife(path, cookbook_path, name)
+
+
+def _knife_warning(cookbook_path, name):
+    """Returns the start of the warnings about an outdated metadata.json"""
+    error_msg = "Warning: metadata.json for {0}".format(name)
+    error_msg += " in {0} is older that metadata.rb".format(cookbook_path)
+    error_msg += ", cookbook attributes could be out of date\n\n"
+    return error_msg
+
+
+def _knife_is_missing(error_msg):
+    """Stops using knife, telling so only once"""
+    global knife_installed
+    with _knife_lock:
+        if knife_installed:
             knife_installed = False
             error_msg += "If you locally install Chef's knife tool, LittleChef"
             error_msg += " will regenerate metadata.json files automatically\n"
             print(error_msg)
-        else:
-            print("Generated metadata.json for {0}\n".format(path))
+
+
+def _generate_metadata_with_knife(path, cookbook_path, name):
+    """Regenerates metadata.json using knife"""
+    if not knife_installed:
+        return
+    error_msg = _knife_warning(cookbook_path, name)
+    try:
+        proc = subprocess.Popen(
+            ['knife', 'cookbook', 'metadata', '-o', cookbook_path, name],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        resp, error = proc.communicate()
+        if ('ERROR:' in resp or 'FATAL:' in resp
+                or 'Generating metadata for' not in resp):
+            if("No user specified, pass via -u or specifiy 'node_name'"
+                    in error):
+                error_msg += "You need to have an up-to-date (>=0.10.x)"
+                error_msg += " version of knife installed locally in order"
+                error_msg += " to generate metadata.json.\nError "
+            else:
+                error_msg += "Unkown error "
+            error_msg += "while executing knife to generate "
+            error_msg += "metadata.json for {0}".format(path)
+            print(error_msg)
+            print resp
+        if env.loglevel == 'debug':
+            print "\n".join(resp.split("\n")[:2])
+    except OSError:
+        _knife_is_missing(error_msg)
+    else:
+        print("Generated metadata.json for {0}\n".format(path))
+
+
+def generate_all_metadata(cookbooks):
+    """Regenerates the outdated metadata.json files of the given cookbooks
+    * cookbooks: list of cookbook names
+
+    metadata.rb files that LittleChef can't evaluate are handed to knife,
+    running several knife processes at the same time
+
+    """
+    fallback = []
+    for name in cookbooks:
+        for cookbook_path in cookbook_paths:
+            path = os.path.join(cookbook_path, name)
+            if _claim_metadata(path) and not metadata.generate(path, name):
+                fallback.append((path, cookbook_path, name))
+    # Found before starting the threads, which then only read it
+    if fallback and knife_installed and find_executable('knife') is None:
+        _knife_is_missing(_knife_warning(*fallback[0][1:]))
+    if len(fallback) > 1 and knife_installed:
+        pool = ThreadPool(min(len(fallback), multiprocessing.cpu_count()))
+        try:
+            pool.map(lambda args: _generate_metadata_with_knife(*args),
+                     fallback)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for args in fallback:
+            _generate_metadata_with_knife(*args)
 
 
 def get_recipes_in_cookbook(name):
@@ -289,28 +594,22 @@ def get_recipes_in_cookbook(name):
 
         # Now try to open metadata.json
         try:
-            with open(os.path.join(path, 'metadata.json'), 'r') as f:
-                try:
-                    cookbook = json.loads(f.read())
-                except ValueError as e:
-                    msg = "Little Chef found the following error in your"
-                    msg += " {0} file:\n  {1}".format(
-                        os.path.join(path, 'metadata.json'), e)
-                    abort(msg)
-                # Add each recipe defined in the cookbook
-                metadata_exists = True
-                recipe_defaults = {
-                    'description': '',
-                    'version': cookbook.get('version'),
-                    'dependencies': cookbook.get('dependencies', {}).keys(),
-                    'attributes': cookbook.get('attributes', {})
-                }
-                for recipe in cookbook.get('recipes', []):
-                    recipes[recipe] = dict(
-                        recipe_defaults,
-                        name=recipe,
-                        description=cookbook['recipes'][recipe]
-                    )
+            cookbook = kitchen_index.get(
+                os.path.join(path, 'metadata.json'), _read_json)
+            # Add each recipe defined in the cookbook
+            metadata_exists = True
+            recipe_defaults = {
+                'description': '',
+                'version': cookbook.get('version'),
+                'dependencies': cookbook.get('dependencies', {}).keys(),
+                'attributes': cookbook.get('attributes', {})
+            }
+            for recipe in cookbook.get('recipes', []):
+                recipes[recipe] = dict(
+                    recipe_defaults,
+                    name=recipe,
+                    description=cookbook['recipes'][recipe]
+                )
             # Cookbook metadata.json was found, don't try next cookbook path
             # because metadata.json in site-cookbooks has preference
             break
@@ -370,12 +669,48 @@ def get_recipes():
     for path in cookbook_paths:
         dirnames.update([d for d in os.listdir(path) if os.path.isdir(
                             os.path.join(path, d)) and not d.startswith('.')])
+    generate_all_metadata(dirnames)
     recipes = []
     for dirname in dirnames:
         recipes.extend(get_recipes_in_cookbook(dirname))
+    kitchen_index.save()
     return sorted(recipes, key=lambda x: x['name'])
 
 
+def get_cookbook_dependencies(name):
+    """Returns the cookbooks a cookbook directly depends on, as declared in
+    its metadata, or None when the cookbook can't be found
+
+    """
+    if name not in _cookbook_dependencies:
+        if not any(os.path.isdir(os.path.join(path, name))
+                   for path in cookbook_paths):
+            return None
+        # All recipes of a cookbook share its dependencies
+        _cookbook_dependencies[name] = get_recipes_in_cookbook(
+            name)[0]['dependencies']
+    return _cookbook_dependencies[name]
+
+
+def get_cookbook_closure(recipes):
+    """Returns the sorted names of the cookbooks needed to apply the given
+    recipes: their own cookbooks and, recursively, the ones they depend on.
+    Missing dependencies are left for Chef to report
+
+    """
+    closure = set()
+    pending = [recipe.split('::')[0] for recipe in recipes]
+    while pending:
+        name = pending.pop()
+        if name in closure:
+            continue
+        dependencies = get_cookbook_dependencies(name)
+        if dependencies is not None:
+            closure.add(name)
+            pending.extend(dependencies)
+    return sorted(closure)
+
+
 def print_recipe(recipe):
     """Pretty prints the given recipe"""
     print(colors.yellow("\n{0}".format(recipe['name'])))
@@ -390,24 +725,72 @@ def get_roles_in_role(rolename):
     return get_roles_in_node(_get_role(rolename))
 
 
-def get_roles_in_node(node, recursive=False, depth=0):
+def get_roles_in_node(node, recursive=False):
     """Returns a list of roles found in the run_list of a node
     * recursive: True feches roles recursively
-    * depth: Keeps track of recursion depth
 
     """
-    LIMIT = 5
+    if recursive:
+        return expand_run_list(node)[0]
     roles = []
     for elem in node.get('run_list', []):
         if elem.startswith("role"):
             role = elem.split('[')[1].split(']')[0]
             if role not in roles:
                 roles.append(role)
-                if recursive and depth <= LIMIT:
-                    roles.extend(get_roles_in_node(_get_role(role),
-                                                   recursive=True,
-                                                   depth=depth + 1))
-    return list(set(roles))
+    return roles
+
+
+def _extend_unique(items, seen, new_items):
+    """Appends to items those elements of new_items not yet in seen"""
+    for item in new_items:
+        if item not in seen:
+            seen.add(item)
+            items.append(item)
+
+
+def _expand(run_list, parents):
+    """Expands a run_list into ordered lists of roles and recipes"""
+    roles, recipes = [], []
+    seen_roles, seen_recipes = set(), set()
+    for elem in run_list:
+        # Entries other than role[name] and recipe[name] are ignored
+        if '[' not in elem:
+            continue
+        name = elem.split('[')[1].split(']')[0]
+        if elem.startswith("role"):
+            nested_roles, nested_recipes = expand_role(name, parents)
+            _extend_unique(roles, seen_roles, [name] + nested_roles)
+            _extend_unique(recipes, seen_recipes, nested_recipes)
+        elif elem.startswith("recipe"):
+            _extend_unique(recipes, seen_recipes, [name])
+    return roles, recipes
+
+
+def expand_role(rolename, parents=()):
+    """Returns the roles and recipes a role expands to, in Chef's order
+    * parents: roles being expanded that led to this one
+
+    Every role file is only read and expanded once per process. Aborts when
+    a role ends up including itself
+
+    """
+    if rolename in parents:
+        cycle = parents[parents.index(rolename):] + (rolename,)
+        abort("Found a role cycle: {0}".format(" -> ".join(cycle)))
+    if rolename not in _role_expansions:
+        _role_expansions[rolename] = _expand(
+            _get_role(rolename).get('run_list', []), parents + (rolename,))
+    return _role_expansions[rolename]
+
+
+def expand_run_list(node):
+    """Expands the run_list of a node the way Chef does
+    Returns a tuple with the ordered list of all roles, including nested ones,
+    and the ordered list of all recipes that will be applied
+
+    """
+    return _expand(node.get('run_list', []), ())
 
 
 def _get_role(rolename):
@@ -415,15 +798,9 @@ def _get_role(rolename):
     path = os.path.join('roles', rolename + '.json')
     if not os.path.exists(path):
         abort("Couldn't read role file {0}".format(path))
-    with open(path, 'r') as f:
-        try:
-            role = json.loads(f.read())
-        except ValueError as e:
-            msg = "Little Chef found the following error in your"
-            msg += " {0}.json file:\n  {1}".format(rolename, str(e))
-            abort(msg)
-        role['fullname'] = rolename
-        return role
+    role = kitchen_index.get(path, _read_json)
+    role['fullname'] = rolename
+    return role
 
 
 def get_roles():
@@ -435,6 +812,7 @@ def get_roles():
                 path = os.path.join(
                     root[len('roles'):], filename[:-len('.json')])
                 roles.append(_get_role(path))
+    kitchen_index.save()
     return sorted(roles, key=lambda x: x['fullname'])
 
 
@@ -471,31 +849,69 @@ def get_plugins():
                 if not os.path.isdir(f) and f.endswith(".py")]):
             plugin_name = filename[:-3]
             try:
-                plugin = import_plugin(plugin_name)
-            except SystemExit as e:
+                description = kitchen_index.get(
+                    os.path.join('plugins', filename),
+                    _parse_plugin)['description']
+            except SyntaxError:
                 description = "Plugin has a syntax error"
-            else:
-                description = plugin.__doc__ or "No description found"
-            yield {plugin_name: description}
+            yield {plugin_name: description or "No description found"}
+        kitchen_index.save()
+
+
+def _parse_plugin(path):
+    """Reads the docstring of a plugin without importing it"""
+    with open(path, 'rb') as f:
+        tree = ast.parse(f.read(), path)
+    return {'description': ast.get_docstring(tree, clean=False)}
+
+
+def _compile_plugin(path):
+    """Returns the code of a plugin module. Compiled code is kept in the
+    kitchen's cache directory under the hash of the source, so that a
+    plugin is only compiled again when it changes
+
+    """
+    with open(path, 'rb') as f:
+        source = f.read()
+    cache_dir = os.path.join(CACHE_DIR, 'plugins')
+    cached = os.path.join(cache_dir, hashlib.sha1(source).hexdigest() + '.pyc')
+    try:
+        with open(cached, 'rb') as f:
+            if f.read(4) == imp.get_magic():
+                return marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+    code = compile(source, path, 'exec')
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(imp.get_magic())
+            marshal.dump(code, f)
+        os.rename(tmp_path, cached)
+    except (IOError, OSError):
+        # Compiled again next time
+        pass
+    return code
 
 
 def import_plugin(name):
     """Imports plugin python module"""
     path = os.path.join("plugins", name + ".py")
     try:
-        with open(path, 'rb') as f:
-            try:
-                plugin = imp.load_module(
-                    "p_" + name, f, name + '.py',
-                    ('.py', 'rb', imp.PY_SOURCE)
-                )
-            except SyntaxError as e:
-                error = "Found plugin '{0}', but it seems".format(name)
-                error += " to have a syntax error: {0}".format(str(e))
-                abort(error)
+        code = _compile_plugin(path)
+    except SyntaxError as e:
+        error = "Found plugin '{0}', but it seems".format(name)
+        error += " to have a syntax error: {0}".format(str(e))
+        abort(error)
     except IOError:
         abort("Sorry, could not find '{0}.py' in the plugin directory".format(
               name))
+    plugin = imp.new_module("p_" + name)
+    plugin.__file__ = path
+    sys.modules[plugin.__name__] = plugin
+    exec code in plugin.__dict__
     return plugin
 
 
@@ -527,6 +943,20 @@ def _pprint(dic):
         print("        {0}: {1}".format(key, value))
 
 
+def group_outputs(outputs):
+    """Groups nodes by their output
+    * outputs: dictionary mapping each node to its output
+    Returns a list of (sorted nodes, output) tuples, biggest groups first
+
+    """
+    groups = {}
+    for name, output in outputs.items():
+        groups.setdefault(output.rstrip(), []).append(name)
+    return sorted(((sorted(names), output)
+                   for output, names in groups.items()),
+                  key=lambda group: (-len(group[0]), group[0]))
+
+
 def print_header(string):
     """Prints a colored header"""
     print(colors.yellow("\n== {0} ==".format(string)))
@@ -0,0 +1,393 @@
+#Copyright 2010-2015 Miquel Torres <tobami@gmail.com>
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+"""Cookbook metadata.json generation without knife
+
+Evaluates the common subset of the metadata.rb DSL: plain field setters,
+depends and friends, supports, recipe, attribute and grouping, with string,
+symbol, number, array and hash arguments, as well as iterating over literal
+lists with each. Anything else raises MetadataError, so that knife can be
+used instead.
+
+"""
+import os
+import re
+import json
+import hashlib
+
+from littlechef import CACHE_DIR
+from littlechef.exceptions import MetadataError
+
+_TOKEN_RE = re.compile(r"""
+    (?P<space>[ \t\r]+|\\\n)
+   |(?P<comment>\#[^\n]*)
+   |(?P<newline>[\n;])
+   |(?P<words>%[wW](?:\{[^}]*\}|\([^)]*\)|\[[^\]]*\]|<[^>]*>))
+   |(?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+   |(?P<label>[A-Za-z_]\w*:(?!:))
+   |(?P<symbol>:[A-Za-z_]\w*[?!]?|:"(?:[^"\\]|\\.)*"|:'(?:[^'\\]|\\.)*')
+   |(?P<number>-?\d+(?:\.\d+)?)
+   |(?P<name>[A-Za-z_]\w*[?!]?)
+   |(?P<op>=>|::|[.,()\[\]{}|])
+""", re.VERBOSE | re.DOTALL)
+
+_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 's': ' ', '0': '\0'}
+
+# metadata.rb fields holding a single string
+FIELDS = [
+    'name', 'maintainer', 'maintainer_email', 'license', 'description',
+    'long_description', 'version', 'source_url', 'issues_url',
+]
+# metadata.rb methods adding a cookbook and a version constraint to a field
+CONSTRAINTS = {
+    'depends': 'dependencies',
+    'recommends': 'recommendations',
+    'suggests': 'suggestions',
+    'conflicts': 'conflicting',
+    'provides': 'providing',
+    'replaces': 'replacing',
+    'supports': 'platforms',
+}
+# Part of the cache keys, changed to ignore results cached by older releases
+CACHE_VERSION = '2'
+# metadata.rb methods which do not end up in metadata.json
+IGNORED = ['chef_version', 'ohai_version', 'gem', 'privacy']
+
+ATTRIBUTE_DEFAULTS = {
+    'required': 'optional',
+    'calculated': False,
+    'choice': [],
+    'type': 'string',
+    'recipes': [],
+}
+
+
+def _unquote(token):
+    """Returns the value of a quoted Ruby string"""
+    quote, body = token[0], token[1:-1]
+    if quote == "'":
+        return re.sub(r"\\([\\'])", r"\1", body)
+    if '#{' in body:
+        raise MetadataError("string interpolation is not supported")
+    return re.sub(r"\\(.)", lambda m: _ESCAPES.get(m.group(1), m.group(1)),
+                  body)
+
+
+def _tokenize(source):
+    """Splits Ruby source code into a list of (kind, value) tuples"""
+    tokens = []
+    position = 0
+    while position < len(source):
+        match = _TOKEN_RE.match(source, position)
+        if match is None:
+            raise MetadataError("unsupported syntax at '{0}'".format(
+                source[position:position + 20]))
+        position = match.end()
+        kind, value = match.lastgroup, match.group()
+        if kind in ('space', 'comment'):
+            continue
+        elif kind == 'string':
+            value = _unquote(value)
+        elif kind == 'symbol':
+            value = value[1:]
+            if value[0] in '"\'':
+                value = _unquote(value)
+        elif kind == 'label':
+            value = value[:-1]
+        elif kind == 'words':
+            value = value[3:-1].split()
+        elif kind == 'number':
+            value = float(value) if '.' in value else int(value)
+        elif kind == 'name' and value in ('do', 'end'):
+            kind = 'op'
+        tokens.append((kind, value))
+    tokens.append(('eof', None))
+    return tokens
+
+
+class _Evaluator(object):
+    """Walks the tokens of a metadata.rb file, filling a metadata dict"""
+    def __init__(self, source, name, filename):
+        self.tokens = _tokenize(source)
+        self.position = 0
+        self.filename = filename
+        self.variables = {}
+        # Whether the metadata depends only on the source and the name, and
+        # not on the path of the file or on other files
+        self.cacheable = True
+        self.metadata = {
+            'name': name,
+            'description': '',
+            'long_description': '',
+            'maintainer': '',
+            'maintainer_email': '',
+            'license': 'All rights reserved',
+            'version': '0.0.0',
+            'attributes': {},
+            'groupings': {},
+            'recipes': {},
+        }
+        for field in CONSTRAINTS.values():
+            self.metadata[field] = {}
+
+    def peek(self, offset=0):
+        return self.tokens[self.position + offset]
+
+    def next(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def accept(self, kind, value=None):
+        """Consumes the next token if it matches"""
+        token = self.peek()
+        if token[0] == kind and (value is None or token[1] == value):
+            self.position += 1
+            return True
+        return False
+
+    def expect(self, kind, value=None):
+        token = self.next()
+        if token[0] != kind or (value is not None and token[1] != value):
+            raise MetadataError("expected '{0}', found '{1}'".format(
+                value or kind, token[1]))
+        return token[1]
+
+    def skip_newlines(self):
+        while self.accept('newline'):
+            pass
+
+    def evaluate(self):
+        self.statements(('eof', None))
+        return self.metadata
+
+    def statements(self, terminator):
+        """Evaluates statements until the terminator token is reached"""
+        while True:
+            self.skip_newlines()
+            if self.peek() == terminator:
+                return
+            self.statement()
+
+    def statement(self):
+        kind, value = self.peek()
+        if kind == 'name' and self.peek(1) not in (('op', '.'), ('op', '::')):
+            self.next()
+            args, options = self.arguments()
+            self.call(value, args, options)
+        else:
+            # Iterating over a literal list is the only other construct
+            items = self.value()
+            self.expect('op', '.')
+            self.expect('name', 'each')
+            if not isinstance(items, list):
+                raise MetadataError("each is only supported on lists")
+            terminator = ('op', 'end') if self.accept('op', 'do') else None
+            if terminator is None:
+                self.expect('op', '{')
+                terminator = ('op', '}')
+            self.expect('op', '|')
+            variable = self.expect('name')
+            self.expect('op', '|')
+            start = self.position
+            if not items:
+                raise MetadataError("each over an empty list")
+            for item in items:
+                self.position = start
+                self.variables[variable] = item
+                self.statements(terminator)
+            del self.variables[variable]
+            self.next()
+
+    def arguments(self):
+        """Parses the arguments of a method call
+        Returns a list of positional arguments and a dict of options
+
+        """
+        args, options = [], {}
+        parenthesized = self.accept('op', '(')
+        if parenthesized:
+            closing = [('op', ')')]
+            self.skip_newlines()
+        else:
+            closing = [('newline', '\n'), ('newline', ';'), ('eof', None),
+                       ('op', 'end'), ('op', '}')]
+        while self.peek() not in closing:
+            if self.peek()[0] == 'label':
+                key = self.next()[1]
+                options[key] = self.value()
+            else:
+                arg = self.value()
+                if self.accept('op', '=>'):
+                    self.skip_newlines()
+                    options[arg] = self.value()
+                else:
+                    args.append(arg)
+            if not self.accept('op', ','):
+                break
+            self.skip_newlines()
+        if parenthesized:
+            self.skip_newlines()
+            self.expect('op', ')')
+        return args, options
+
+    def value(self):
+        """Parses and returns a literal value or a supported expression"""
+        kind, value = self.next()
+        if kind in ('string', 'symbol', 'number', 'words'):
+            return value
+        elif kind == 'op' and value == '[':
+            items = []
+            self.skip_newlines()
+            while not self.accept('op', ']'):
+                items.append(self.value())
+                self.skip_newlines()
+                self.accept('op', ',')
+                self.skip_newlines()
+            return items
+        elif kind == 'op' and value == '{':
+            self.skip_newlines()
+            args, options = self.arguments()
+            self.skip_newlines()
+            self.expect('op', '}')
+            if args:
+                raise MetadataError("malformed hash")
+            return options
+        elif kind == 'name':
+            if value in ('true', 'false', 'nil'):
+                return {'true': True, 'false': False, 'nil': None}[value]
+            elif value in self.variables:
+                return self.variables[value]
+            return self.expression(value)
+        raise MetadataError("unsupported value '{0}'".format(value))
+
+    def expression(self, name):
+        """Evaluates the file reading expressions commonly used to set
+        long_description, like IO.read(File.join(File.dirname(__FILE__),
+        'README.md'))
+
+        """
+        self.cacheable = False
+        if name == '__FILE__':
+            return self.filename
+        elif name == '__dir__':
+            return os.path.dirname(self.filename)
+        if not self.accept('op', '.') and not self.accept('op', '::'):
+            raise MetadataError("unsupported name '{0}'".format(name))
+        method = name + '.' + self.expect('name')
+        args = self.arguments()[0] if self.peek() == ('op', '(') else []
+        if not all(isinstance(arg, basestring) for arg in args):
+            raise MetadataError("unsupported arguments for " + method)
+        if method in ('IO.read', 'File.read') and len(args) == 1:
+            try:
+                with open(args[0], 'r') as f:
+                    return f.read()
+            except IOError as e:
+                raise MetadataError(str(e))
+        elif method == 'File.join' and args:
+            return os.path.join(*args)
+        elif method == 'File.dirname' and len(args) == 1:
+            return os.path.dirname(args[0])
+        elif method == 'File.expand_path' and len(args) in (1, 2):
+            return os.path.abspath(os.path.join(*reversed(args)))
+        raise MetadataError("unsupported method '{0}'".format(method))
+
+    def call(self, method, args, options):
+        """Applies a metadata.rb DSL method call"""
+        if method in IGNORED:
+            return
+        if not args or not all(isinstance(arg, basestring) for arg in args):
+            raise MetadataError("unsupported call to '{0}'".format(method))
+        if method in FIELDS and len(args) == 1 and not options:
+            self.metadata[method] = args[0]
+        elif method in CONSTRAINTS and len(args) <= 2 and not options:
+            constraint = args[1] if len(args) == 2 else ">= 0.0.0"
+            self.metadata[CONSTRAINTS[method]][args[0]] = constraint
+        elif method == 'recipe' and len(args) <= 2 and not options:
+            self.metadata['recipes'][args[0]] = (
+                args[1] if len(args) == 2 else "")
+        elif method == 'attribute' and len(args) == 1:
+            attribute = dict(ATTRIBUTE_DEFAULTS)
+            attribute.update(options)
+            self.metadata['attributes'][args[0]] = attribute
+        elif method == 'grouping' and len(args) == 1:
+            self.metadata['groupings'][args[0]] = options
+        else:
+            raise MetadataError("unsupported call to '{0}'".format(method))
+
+
+def evaluate(source, name, filename):
+    """Returns the metadata defined by the given metadata.rb source code
+    * name: cookbook name, used when the source does not define one
+    * filename: path to the metadata.rb file, for __FILE__
+
+    Raises MetadataError when the source uses unsupported Ruby
+
+    """
+    return _evaluate(source, name, filename)[0]
+
+
+def _evaluate(source, name, filename):
+    """Returns the metadata defined by the given metadata.rb source code and
+    whether it may be cached by the source code
+
+    """
+    evaluator = _Evaluator(source, name, filename)
+    try:
+        return evaluator.evaluate(), evaluator.cacheable
+    except IndexError:
+        raise MetadataError("unexpected end of file")
+
+
+def generate(path, name):
+    """Generates the metadata.json of a cookbook out of its metadata.rb
+    Results are cached by content, so that the same metadata.rb is only
+    evaluated once, unless it reads other files, which may have changed.
+    Returns False when metadata.rb uses unsupported Ruby
+
+    """
+    rb_path = os.path.join(path, 'metadata.rb')
+    with open(rb_path, 'r') as f:
+        source = f.read()
+    digest = hashlib.sha1(
+        CACHE_VERSION + '\0' + name + '\0' + source).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, 'metadata', digest + '.json')
+    try:
+        with open(cache_path, 'r') as f:
+            content = f.read()
+    except IOError:
+        try:
+            metadata, cacheable = _evaluate(source, name, rb_path)
+        except MetadataError:
+            return False
+        content = json.dumps(metadata, indent=2, sort_keys=True)
+        if cacheable:
+            _save_cached(cache_path, content)
+    with open(os.path.join(path, 'metadata.json'), 'w') as f:
+        f.write(content)
+    return True
+
+
+def _save_cached(cache_path, content):
+    """Stores generated metadata, which is only an optimization, so errors
+    are ignored
+
+    """
+    try:
+        if not os.path.isdir(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        with open(cache_path, 'w') as f:
+            f.write(content)
+    except (IOError, OSError):
+        pass
@@ -0,0 +1,150 @@
+#Copyright 2010-2015 Miquel Torres <tobami@gmail.com>
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+"""Short-lived HTTP server on the workstation which nodes download files
+from, instead of having them pushed through the SSH connection
+
+"""
+import os
+import shutil
+import hashlib
+import threading
+import BaseHTTPServer
+import SocketServer
+from contextlib import contextmanager
+
+from fabric.api import env
+from fabric.state import connections
+from fabric.utils import abort
+from paramiko import SSHException
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the files published on the server, and nothing else"""
+    def do_GET(self):
+        published = self.server.files.get(self.path)
+        if published is None:
+            self.send_error(404)
+            return
+        filename, content = published
+        if content is None:
+            size = os.path.getsize(filename)
+        else:
+            size = len(content)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        if content is None:
+            with open(filename, 'rb') as f:
+                shutil.copyfileobj(f, self.wfile)
+        else:
+            self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        # Requests would clutter the output of the run
+        pass
+
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # HTTPServer would do a reverse lookup of the address
+        SocketServer.TCPServer.server_bind(self)
+
+
+class PullServer(object):
+    """Publishes local files over HTTP for the current node to download
+
+    Files are served under a random token and the hash of their contents,
+    so that only the node being told about a file can get it, and can then
+    verify it. The server only listens while a RemoteScript runs
+
+    """
+    def __init__(self, address=None):
+        """* address: the address of the workstation the node can connect
+          to. When not given, the node reaches the server through a reverse
+          tunnel over its SSH connection
+
+        """
+        self.address = address
+        self.token = os.urandom(16).encode('hex')
+        self.files = {}
+
+    def publish(self, filename=None, content=None, digest=None):
+        """Makes a local file, or the given content, available to the node
+        * digest: the sha1 hash of the contents, when already known
+
+        Returns the hash, under which the file is served
+
+        """
+        if digest is None:
+            digest = hashlib.sha1()
+            if content is None:
+                with open(filename, 'rb') as f:
+                    for chunk in iter(lambda: f.read(65536), ''):
+                        digest.update(chunk)
+            else:
+                digest.update(content)
+            digest = digest.hexdigest()
+        self.files['/{0}/{1}'.format(self.token, digest)] = (filename, content)
+        return digest
+
+    @contextmanager
+    def serve(self):
+        """Serves the published files while the context lasts
+        Yields the url the files are found under from the node
+
+        """
+        httpd = _HTTPServer((self.address or '127.0.0.1', 0), _RequestHandler)
+        httpd.files = self.files
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            if self.address:
+                yield 'http://{0}:{1}/{2}'.format(
+                    self.address, httpd.server_address[1], self.token)
+            else:
+                with _reverse_tunnel(httpd) as port:
+                    yield 'http://127.0.0.1:{0}/{1}'.format(port, self.token)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+
+@contextmanager
+def _reverse_tunnel(httpd):
+    """Has the current node forward connections to a port on its loopback
+    interface to the given server, over its SSH connection. The SSH channel
+    of each connection is handled by the server as if it were a socket
+
+    Yields the port, which is picked by the node
+
+    """
+    transport = connections[env.host_string].get_transport()
+    try:
+        port = transport.request_port_forward(
+            '127.0.0.1', 0,
+            handler=lambda channel, origin, server: httpd.process_request(
+                channel, origin))
+    except SSHException as e:
+        abort("Could not open a reverse tunnel to {0}, check that its sshd "
+              "allows TCP forwarding, or set the address of this host as "
+              "the pull option: {1}".format(env.host_string, e))
+    try:
+        yield port
+    finally:
+        transport.cancel_port_forward('127.0.0.1', port)
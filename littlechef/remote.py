@@ -0,0 +1,188 @@
+#Copyright 2010-2015 Miquel Torres <tobami@gmail.com>
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#
+"""Batched remote operations, so that each step of a run costs a single
+round trip to the node
+
+"""
+import os
+import tarfile
+from pipes import quote
+from StringIO import StringIO
+
+from fabric.api import env, settings, hide, sudo, put
+from fabric.utils import abort
+
+# Prefix of the error messages printed by failing script steps
+ERROR_PREFIX = "littlechef: "
+# Prefix of the messages printed by failing steps which don't stop the script
+WARNING_PREFIX = "littlechef warning: "
+# Total size of the files written by the script itself instead of being
+# uploaded, well below the length limit of a single command line argument
+INLINE_SIZE = 64 * 1024
+# Downloads a file from the pull server with whatever the node has, failing
+# unless its hash matches. Arguments are the url, path and sha1 hash
+FETCH_FUNCTION = (
+    'fetch() { { curl -fsS -o "$2" "$1" || wget -q -O "$2" "$1"; } '
+    '2>/dev/null && [ "$({ sha1sum "$2" || shasum "$2"; } 2>/dev/null '
+    '| cut -c 1-40)" = "$3" ]; }')
+
+
+class RemoteScript(object):
+    """A shell script run with sudo on a node in a single round trip
+
+    Small text files readable by everyone are written by the script itself.
+    Other files are uploaded beforehand, all together in a single compressed
+    transfer, or downloaded by the node from a PullServer when one is given
+    and they are readable by everyone. Steps run in the order they are added
+
+    """
+    def __init__(self, server=None):
+        self.server = server
+        self.commands = []
+        self.files = []
+        self.inline_files = []
+        self.fetched = []
+        self._inline_size = 0
+
+    def add(self, command, error=None, warning=None):
+        """Adds a command to the script
+        * error: when given, the script stops with this message if the
+          command fails. Otherwise failures are ignored
+        * warning: when given, this message is shown if the command fails
+
+        """
+        if error is not None:
+            command = "{0} || fail {1}".format(command, quote(error))
+        elif warning is not None:
+            command = "{0} || echo {1}".format(
+                command, quote(WARNING_PREFIX + warning))
+        self.commands.append(command)
+
+    def download_command(self, remote_path, filename, digest=None):
+        """Returns a command having the node download a local file from the
+        pull server to remote_path, which fails unless the downloaded file
+        has the same hash
+        * digest: the sha1 hash of the file, when already known
+
+        """
+        digest = self.server.publish(filename, digest=digest)
+        self.fetched.append(digest)
+        return 'fetch "$pull/{0}" {1} {0}'.format(digest, quote(remote_path))
+
+    def install(self, remote_path, content=None, filename=None, mode=0400):
+        """Adds a file which the script installs owned by root
+        * content: the contents of the file
+        * filename: a local file to read the contents from instead
+
+        """
+        if filename is not None:
+            with open(filename, 'rb') as f:
+                content = f.read()
+        # Files others may not read can hold secrets, which must not end up
+        # in the command line of the script or in a download over plain HTTP
+        restricted = not mode & 04
+        # Fabric does not escape backslashes when passing the script on
+        if (not restricted and '\0' not in content and '\\' not in content
+                and self._inline_size + len(content) <= INLINE_SIZE):
+            self._inline_size += len(content)
+            name = 'inline{0}'.format(len(self.inline_files))
+            self.inline_files.append(content)
+        elif self.server is not None and not restricted:
+            name = 'fetch{0}'.format(len(self.fetched))
+            digest = self.server.publish(content=content)
+            self.fetched.append(digest)
+            self.commands.append(
+                'fetch "$pull/{0}" $staging/{1} {0} || fail {2}'.format(
+                    digest, name,
+                    quote("Could not download {0}".format(remote_path))))
+        else:
+            name = str(len(self.files))
+            self.files.append(content)
+        self.commands.append(
+            ("install -m {0:o} -o root -g $(id -g -n root) $staging/{1} {2} "
+             "|| fail {3}").format(
+                mode, name, quote(remote_path),
+                quote("Could not install {0}".format(remote_path))))
+
+    def _pack_files(self):
+        """Returns a file object with a tar.gz holding all files to install"""
+        data = StringIO()
+        tar = tarfile.open(fileobj=data, mode='w:gz')
+        for index, content in enumerate(self.files):
+            info = tarfile.TarInfo(str(index))
+            info.size = len(content)
+            info.mode = 0600
+            tar.addfile(info, StringIO(content))
+        tar.close()
+        data.seek(0)
+        return data
+
+    def render(self, staging, url=None):
+        """Returns the script, using staging as the path files are uploaded
+        to and unpacked in
+        * url: the url the node finds the files of the pull server under
+
+        """
+        lines = [
+            'fail() { echo "' + ERROR_PREFIX + '$1"; exit 1; }',
+        ]
+        if url is not None:
+            lines.extend(['pull={0}'.format(quote(url)), FETCH_FUNCTION])
+        if self.files or self.inline_files or self.fetched:
+            lines.extend([
+                'staging={0}'.format(quote(staging)),
+                "trap 'rm -rf $staging $staging.tar.gz' EXIT",
+                'mkdir -m 700 $staging || fail "Could not create $staging"',
+            ])
+        if self.files:
+            lines.append('tar -xzf $staging.tar.gz -C $staging '
+                         '|| fail "Could not unpack the uploaded files"')
+        for index, content in enumerate(self.inline_files):
+            lines.append("printf '%s' {0} > $staging/inline{1}".format(
+                quote(content), index))
+        return '\n'.join(lines + self.commands)
+
+    def execute(self):
+        """Uploads the files and runs the script, aborting with the error
+        message of the failed step, if any. Returns the output of the script
+
+        """
+        staging = '/tmp/littlechef-{0}'.format(os.urandom(16).encode('hex'))
+        if not self.fetched:
+            return self._run(staging)
+        with self.server.serve() as url:
+            return self._run(staging, url)
+
+    def _run(self, staging, url=None):
+        try:
+            if self.files:
+                with hide('running', 'stdout'):
+                    put(self._pack_files(), staging + '.tar.gz', mode=0600)
+            with settings(hide('running', 'stdout', 'warnings'),
+                          warn_only=True):
+                output = sudo(self.render(staging, url))
+        except EOFError as e:
+            # It may be the first remote call, which could go wrong
+            abort("Could not login to node, got: {0}".format(e))
+        if output.failed:
+            for line in output.splitlines():
+                if line.startswith(ERROR_PREFIX):
+                    abort(line[len(ERROR_PREFIX):])
+            abort("Failed to run the remote script on {0}:\n{1}".format(
+                env.host_string, output))
+        for line in output.splitlines():
+            if line.startswith(WARNING_PREFIX):
+                print("Warning: " + line[len(WARNING_PREFIX):])
+        return output
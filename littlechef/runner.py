@@ -14,17 +14,21 @@
 #
 """LittleChef: Configuration Management using Chef Solo"""
 import ConfigParser
+import functools
 import os
 import sys
 import json
 import tempfile
+import threading
+import time
 
 from fabric.api import *
 from fabric.contrib.console import confirm
+from multiprocessing.pool import ThreadPool as _ThreadPool
 from paramiko.config import SSHConfig as _SSHConfig
 
 import littlechef
-from littlechef import solo, lib, chef
+from littlechef import solo, lib, chef, fleet, facts
 
 # Fabric settings
 import fabric
@@ -36,13 +40,22 @@ env.chef_environment = littlechef.chef_environment
 env.node_work_path = littlechef.node_work_path
 env.eagerly_disconnect = True
 env.no_color = littlechef.no_color
+env.skip_unchanged = littlechef.skip_unchanged
+env.max_age = littlechef.max_age
 
 if littlechef.concurrency:
     env.output_prefix = True
-    env.parallel = True
-    env.pool_size = littlechef.concurrency
+    if littlechef.threads:
+        # Nodes are run by the fleet module instead of by Fabric
+        env.parallel = False
+        env.fleet_size = littlechef.concurrency
+    else:
+        env.parallel = True
+        env.pool_size = littlechef.concurrency
+        env.fleet_size = None
 else:
     env.output_prefix = False
+    env.fleet_size = None
 
 __testing__ = False
 
@@ -121,6 +134,21 @@ def nodes_with_tag(tag):
     return node(*nodes)
 
 
+def _needs_cookbooks(task):
+    """Vendors the cookbooks of the Berksfile before a task needing
+    cookbooks is first run, instead of on every fix run
+
+    """
+    @functools.wraps(task)
+    def wrapper(*args, **kwargs):
+        if env.get('berksfile') and not env.get('berksfile_vendored'):
+            chef.ensure_berksfile_cookbooks_are_installed()
+            env.berksfile_vendored = True
+        return task(*args, **kwargs)
+    return wrapper
+
+
+@_needs_cookbooks
 def node(*nodes):
     """Selects and configures a list of nodes. 'all' configures all nodes"""
     chef.build_node_data_bag()
@@ -128,7 +156,7 @@ def node(*nodes):
         abort('No node was given')
     elif nodes[0] == 'all':
         # Fetch all nodes and add them to env.hosts
-        for node in lib.get_nodes(env.chef_environment):
+        for node in lib.get_nodes(env.chef_environment, fields=[]):
             env.hosts.append(node['name'])
         if not len(env.hosts):
             abort('No nodes found in /nodes/')
@@ -153,11 +181,71 @@ def node(*nodes):
             'nodes_with_tag:' not in sys.argv[-1]):
         # If user didn't type recipe:X, role:Y or deploy_chef,
         # configure the nodes
+        hosts = set(env.hosts)
+        nodes = [node for node in lib.get_nodes(fields=['run_list'])
+                 if node['name'] in hosts]
+        # Hashed once instead of in every parallel worker, and only when
+        # runs are recorded
+        if env.skip_unchanged:
+            env.input_hashes = chef.get_input_hashes(nodes)
+        else:
+            env.input_hashes = {}
+        if env.kitchen_sync == 'bundle':
+            # Build the bundles once instead of in every parallel worker
+            chef.build_kitchen_bundles(nodes)
+            if env.relay:
+                chef.upload_kitchen_bundles(env.kitchen_bundles.values())
+            if (env.pull and env.sync_packages_dest_dir and
+                    env.sync_packages_local_dir):
+                chef.build_packages_bundle()
         with settings():
-            execute(_node_runner)
+            if env.fleet_size:
+                _execute_on_fleet(_node_runner)
+            else:
+                execute(_node_runner)
         chef.remove_local_node_data_bag()
 
 
+def _fleet_task(task):
+    """Has the fleet module run a task given after node: on all nodes at once
+    Fabric calls the task once per node, so it is only run on the first call
+
+    """
+    @functools.wraps(task)
+    def wrapper(*args, **kwargs):
+        if not env.fleet_size or fleet.in_worker():
+            return task(*args, **kwargs)
+        if env.host_string == env.hosts[0]:
+            _execute_on_fleet(task, *args, **kwargs)
+    return wrapper
+
+
+def _get_fleet_workers():
+    """Returns how many nodes commands which always run on all nodes
+    together run at once
+
+    """
+    return env.fleet_size or littlechef.concurrency or fleet.WORKERS
+
+
+def _execute_on_fleet(task, *args, **kwargs):
+    """Runs a task on all nodes with the fleet module, in waves when a
+    rollout is configured
+
+    """
+    if not env.rollout or len(env.hosts) < 2:
+        return fleet.execute(task, env.hosts, env.fleet_size, *args, **kwargs)
+    roles = {}
+    if env.rollout['role_limits']:
+        hosts = set(env.hosts)
+        for node in lib.get_nodes(fields=['run_list']):
+            if node['name'] in hosts:
+                roles[node['name']] = lib.expand_run_list(node)[0]
+    rollout = fleet.Rollout(roles=roles, **env.rollout)
+    return fleet.roll_out(task, env.hosts, env.fleet_size, rollout,
+                          *args, **kwargs)
+
+
 def _configure_fabric_for_platform(platform):
     """Configures fabric for a specific platform"""
     if platform == "freebsd":
@@ -171,17 +259,24 @@ def _node_runner():
 
     _configure_fabric_for_platform(node.get("platform"))
 
-    if __testing__:
+    if env.skip_unchanged and chef.is_unchanged(node['name'], env.max_age):
+        lib.print_header("Skipping unchanged: {0}".format(env.host_string))
+    elif __testing__:
         print "TEST: would now configure {0}".format(env.host_string)
     else:
         lib.print_header("Configuring {0}".format(env.host_string))
         if env.autodeploy_chef and not chef.chef_test():
             deploy_chef(ask="no")
-        chef.sync_node(node)
+        chef.forget_converged(node['name'])
+        if chef.sync_node(node):
+            chef.save_converged(node['name'])
+
 
+def deploy_chef(ask="yes", version="11", ohai="yes"):
+    """Install chef-solo on a node
+    The node file is filled in with facts from ohai unless ohai is "no"
 
-def deploy_chef(ask="yes", version="11"):
-    """Install chef-solo on a node"""
+    """
     env.host_string = lib.get_env_host_string()
     if ask == "no" or littlechef.noninteractive:
         print("Deploying Chef using omnibus installer version: ...".format(version))
@@ -198,23 +293,36 @@ def deploy_chef(ask="yes", version="11"):
         solo.configure()
 
         # Build a basic node file if there isn't one already
-        # with some properties from ohai
-        with settings(hide('stdout'), warn_only=True):
-            output = sudo('ohai -l warn')
-        if output.succeeded:
-            try:
-                ohai = json.loads(output)
-            except ValueError:
-                abort("Could not parse ohai's output"
-                      ":\n  {0}".format(output))
-            node = {"run_list": []}
+        # with some properties from ohai, now that it is installed
+        node = {"run_list": []}
+        if ohai == "no":
+            # Stored facts predate the installation
+            facts.forget()
+        else:
+            node_facts = facts.gather()
             for attribute in ["ipaddress", "platform", "platform_family",
                               "platform_version"]:
-                if ohai.get(attribute):
-                    node[attribute] = ohai[attribute]
-            chef.save_config(node)
+                if node_facts.get(attribute):
+                    node[attribute] = node_facts[attribute]
+        chef.save_config(node)
+
+
+@runs_once
+def gather_facts():
+    """Gathers the facts of the nodes, many at a time, into the local facts
+    store, so that configuring them doesn't have to ask for them
+
+    """
+    fleet.execute(_gather_facts, env.hosts, _get_fleet_workers())
+
 
+def _gather_facts():
+    env.host_string = lib.get_env_host_string()
+    facts.gather()
 
+
+@_needs_cookbooks
+@_fleet_task
 def recipe(recipe):
     """Apply the given recipe to a node
     Sets the run_list to the given recipe
@@ -231,9 +339,13 @@ def recipe(recipe):
     if not __testing__:
         if env.autodeploy_chef and not chef.chef_test():
             deploy_chef(ask="no")
+        # The node no longer matches its last recorded node: run
+        chef.forget_converged(data['name'])
         chef.sync_node(data)
 
 
+@_needs_cookbooks
+@_fleet_task
 def role(role):
     """Apply the given role to a node
     Sets the run_list to the given role
@@ -250,6 +362,8 @@ def role(role):
     if not __testing__:
         if env.autodeploy_chef and not chef.chef_test():
             deploy_chef(ask="no")
+        # The node no longer matches its last recorded node: run
+        chef.forget_converged(data['name'])
         chef.sync_node(data)
 
 
@@ -266,13 +380,94 @@ def ssh(name):
             run(name)
 
 
+@runs_once
+def ssh_all(name):
+    """Executes the given command on all nodes at once, printing nodes with
+    the same output together, followed by a summary
+
+    """
+    if not env.hosts:
+        abort("No nodes selected. Use node:NAME or node:all before ssh_all")
+    print("\nExecuting the command '{0}' on {1} nodes...".format(
+          name, len(env.hosts)))
+    results = fleet.execute(_ssh_captured, env.hosts, _get_fleet_workers(),
+                            name)
+    for hosts, output in lib.group_outputs(
+            dict((host, result[0]) for host, result in results.items())):
+        header = "{0} ({1})".format(', '.join(hosts), len(hosts))
+        print("\n{0}\n{1}\n{0}".format('-' * min(len(header), 79), header))
+        print(output)
+    print("\nExit codes:")
+    codes = {}
+    for host, (output, code, elapsed) in results.items():
+        codes.setdefault(code, []).append(host)
+    for code in sorted(codes):
+        print("  {0}: {1} node{2}{3}".format(
+            'unreachable' if code is None else code, len(codes[code]),
+            '' if len(codes[code]) == 1 else 's',
+            '' if code == 0 else ' ({0})'.format(', '.join(
+                sorted(codes[code])))))
+    timings = sorted((result[2], host) for host, result in results.items())
+    print("Time: min {0:.1f}s, median {1:.1f}s, max {2:.1f}s".format(
+        timings[0][0], timings[len(timings) // 2][0], timings[-1][0]))
+    print("Slowest: {0}".format(', '.join(
+        "{0} ({1:.1f}s)".format(host, elapsed)
+        for elapsed, host in reversed(timings[-5:]))))
+    failed = len(results) - len(codes.get(0, []))
+    if failed:
+        abort("The command failed on {0} of {1} nodes".format(
+            failed, len(results)))
+
+
+def _ssh_captured(name):
+    """Executes the given command on the current node without printing its
+    output. Returns the output, the exit code, or None when the node could
+    not be reached, and the time it took
+
+    """
+    start = time.time()
+    try:
+        with settings(hide('everything', 'aborts'), warn_only=True):
+            if name.startswith("sudo "):
+                output = sudo(name[5:])
+            else:
+                output = run(name)
+        output, code = output.replace('\r\n', '\n'), output.return_code
+    except (Exception, SystemExit) as e:
+        # Any failure only concerns this node
+        output, code = "Could not run the command: {0}".format(
+            _describe_error(e)), None
+    return output, code, time.time() - start
+
+
+def _describe_error(error):
+    """Returns a readable reason for an exception. Fabric's aborts are a
+    SystemExit whose only argument is the exit code, and carry the message
+    separately, when there is one
+
+    """
+    message = getattr(error, 'message', None)
+    if isinstance(message, basestring) and message.strip():
+        return message.strip()
+    if not isinstance(error, SystemExit) and str(error).strip():
+        return str(error).strip()
+    return error.__class__.__name__
+
+
 def plugin(name):
     """Executes the selected plugin
     Plugins are expected to be found in the kitchen's 'plugins' directory
 
     """
+    first = env.hosts and env.host_string == env.hosts[0]
     env.host_string = lib.get_env_host_string()
     plug = lib.import_plugin(name)
+    if hasattr(plug, 'execute_many') and env.hosts:
+        # Fabric calls the task once per node, so it is run for all nodes
+        # on the first call
+        if first:
+            _execute_plugin_many(name, plug)
+        return
     lib.print_header("Executing plugin '{0}' on "
                      "{1}".format(name, env.host_string))
     node = lib.get_node(env.host_string)
@@ -282,6 +477,28 @@ def plugin(name):
     print("Finished executing plugin")
 
 
+def _execute_plugin_many(name, plug):
+    """Calls the execute_many function of a plugin once with all nodes,
+    a pool of threads to work on them at once and a NodeFileWriter, whose
+    nodes are saved when the plugin is done
+
+    """
+    nodes = [lib.get_node(host) for host in env.hosts]
+    lib.print_header("Executing plugin '{0}' on {1} node{2}".format(
+        name, len(nodes), '' if len(nodes) == 1 else 's'))
+    workers = _get_fleet_workers()
+    pool = _ThreadPool(fleet.WORKERS if workers == 'auto' else workers)
+    writer = chef.NodeFileWriter()
+    try:
+        plug.execute_many(nodes, pool, writer)
+    finally:
+        pool.close()
+        pool.join()
+        # What was done before a failure is worth keeping
+        writer.flush()
+    print("Finished executing plugin")
+
+
 @hosts('api')
 def list_nodes():
     """List all configured nodes"""
@@ -324,6 +541,7 @@ def list_nodes_with_tag(tag):
 
 
 @hosts('api')
+@_needs_cookbooks
 def list_recipes():
     """Show a list of all available recipes"""
     for recipe in lib.get_recipes():
@@ -333,6 +551,7 @@ def list_recipes():
 
 
 @hosts('api')
+@_needs_cookbooks
 def list_recipes_detailed():
     """Show detailed information for all recipes"""
     for recipe in lib.get_recipes():
@@ -374,6 +593,33 @@ def _check_appliances():
     return (not bool(missing)), missing
 
 
+class _LazySSHConfig(_SSHConfig):
+    """An SSH config which is only read when it is first looked up, so that
+    commands which don't connect to nodes don't have to
+
+    """
+    def __init__(self, path):
+        _SSHConfig.__init__(self)
+        self.path = path
+        self._lock = threading.Lock()
+        self._read = False
+
+    def lookup(self, hostname):
+        with self._lock:
+            if not self._read:
+                try:
+                    with open(self.path) as f:
+                        self.parse(f)
+                except IOError:
+                    abort("Couldn't open the ssh-config file "
+                          "'{0}'".format(self.path))
+                except Exception:
+                    abort("Couldn't parse the ssh-config file "
+                          "'{0}'".format(self.path))
+                self._read = True
+        return _SSHConfig.lookup(self, hostname)
+
+
 def _readconfig():
     """Configures environment variables"""
     config = ConfigParser.SafeConfigParser()
@@ -413,17 +659,9 @@ def _readconfig():
         env.ssh_config_path = None
 
     if env.ssh_config_path:
-        env.ssh_config = _SSHConfig()
         env.ssh_config_path = os.path.expanduser(env.ssh_config_path)
+        env.ssh_config = _LazySSHConfig(env.ssh_config_path)
         env.use_ssh_config = True
-        try:
-            env.ssh_config.parse(open(env.ssh_config_path))
-        except IOError:
-            abort("Couldn't open the ssh-config file "
-                  "'{0}'".format(env.ssh_config_path))
-        except Exception:
-            abort("Couldn't parse the ssh-config file "
-                  "'{0}'".format(env.ssh_config_path))
     else:
         env.ssh_config = None
 
@@ -433,6 +671,17 @@ def _readconfig():
     except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
         env.gateway = None
 
+    # Host which distributes the kitchen to the nodes, which can be the
+    # gateway itself
+    try:
+        env.relay = config.get('connection', 'relay')
+    except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+        env.relay = None
+    if env.relay == 'gateway':
+        env.relay = env.gateway
+        if not env.relay:
+            abort('"relay = gateway" needs a gateway to be configured')
+
     # check for http_proxy which will be put into solo.rb
     try:
         env.http_proxy = config.get('connection', 'http_proxy')
@@ -510,6 +759,52 @@ def _readconfig():
         if not env.node_work_path:
             abort('The "node_work_path" option cannot be empty')
 
+    # Number of processes used to build the node data bag
+    try:
+        env.build_workers = config.getint('kitchen', 'build_workers')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        env.build_workers = 1
+    except ValueError:
+        abort('The "build_workers" option must be an integer')
+
+    # Hours after which facts about nodes are gathered again when needed
+    try:
+        env.facts_ttl = config.getfloat('kitchen', 'facts_ttl')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        env.facts_ttl = facts.FACTS_TTL
+    except ValueError:
+        abort('The "facts_ttl" option must be a number')
+
+    # How the kitchen is synced to nodes: rsync, bundle or manifest
+    try:
+        env.kitchen_sync = config.get('kitchen', 'sync')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        env.kitchen_sync = 'rsync'
+    if env.kitchen_sync not in ('rsync', 'bundle', 'manifest'):
+        abort('The "sync" option must be "rsync", "bundle" or "manifest"')
+    if env.relay and env.kitchen_sync != 'bundle':
+        abort('The "relay" option needs "sync = bundle"')
+
+    # Have nodes download files from a server on this host, either through
+    # a reverse tunnel or at the given address of this host
+    try:
+        env.pull = config.get('kitchen', 'pull')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        env.pull = None
+    if env.pull and env.kitchen_sync != 'bundle':
+        abort('The "pull" option needs "sync = bundle"')
+    if env.pull and env.relay:
+        abort('The "pull" and "relay" options can\'t be used together')
+
+    # Configure nodes in growing waves, stopping when too many of them fail
+    if config.has_section('rollout'):
+        env.rollout = _read_rollout(config)
+        # Rollouts are run by the fleet module
+        env.parallel = False
+        env.fleet_size = env.fleet_size or littlechef.concurrency or 1
+    else:
+        env.rollout = None
+
     # Follow symlinks
     try:
         env.follow_symlinks = config.getboolean('kitchen', 'follow_symlinks')
@@ -530,7 +825,8 @@ def _readconfig():
                 littlechef.cookbook_paths.append(env.berksfile_cookbooks_directory)
             else:
                 env.berksfile_cookbooks_directory = None
-        chef.ensure_berksfile_cookbooks_are_installed()
+        # Vendored by the commands which need cookbooks
+        env.berksfile_vendored = False
 
     # Upload Directory
     try:
@@ -551,6 +847,53 @@ def _readconfig():
     except ConfigParser.NoOptionError:
         env.autodeploy_chef = None
 
+def _read_rollout(config):
+    """Reads the rollout section of the config file"""
+    rollout = {}
+    try:
+        rollout['canary'] = config.getint('rollout', 'canary')
+    except ConfigParser.NoOptionError:
+        rollout['canary'] = 1
+    except ValueError:
+        abort('The "canary" option must be an integer')
+    try:
+        rollout['growth'] = config.getfloat('rollout', 'growth')
+    except ConfigParser.NoOptionError:
+        rollout['growth'] = 2
+    except ValueError:
+        abort('The "growth" option must be a number')
+    if rollout['canary'] < 1 or rollout['growth'] < 1:
+        abort('The "canary" and "growth" options must be at least 1')
+    # Either a fraction of the nodes done or a percentage
+    try:
+        max_failures = config.get('rollout', 'max_failures', raw=True).strip()
+    except ConfigParser.NoOptionError:
+        max_failures = '0'
+    try:
+        if max_failures.endswith('%'):
+            rollout['max_failures'] = float(max_failures[:-1]) / 100
+        else:
+            rollout['max_failures'] = float(max_failures)
+    except ValueError:
+        abort('The "max_failures" option must be a fraction or a percentage')
+    # The most nodes with each role configured at once, as "role:limit"
+    rollout['role_limits'] = {}
+    try:
+        role_limits = config.get('rollout', 'role_limits')
+    except ConfigParser.NoOptionError:
+        role_limits = ''
+    for role_limit in role_limits.replace(',', ' ').split():
+        role, _, limit = role_limit.rpartition(':')
+        try:
+            rollout['role_limits'][role] = int(limit)
+        except ValueError:
+            role = ''
+        if not role or rollout['role_limits'][role] < 1:
+            abort('Wrong role limit "{0}", it should look like '
+                  '"role:limit"'.format(role_limit))
+    return rollout
+
+
 # Only read config if fix is being used and we are not creating a new kitchen
 if littlechef.__cooking__:
     # Called from command line
@@ -566,6 +909,14 @@ else:
     # runner module has been imported
     env.ssh_config = None
     env.follow_symlinks = False
+    env.build_workers = 1
+    env.kitchen_sync = 'rsync'
+    env.relay = None
+    env.pull = None
+    env.rollout = None
+    env.facts_ttl = facts.FACTS_TTL
     env.encrypted_data_bag_secret = None
     env.sync_packages_dest_dir = None
     env.sync_packages_local_dir = None
+    env.http_proxy = None
+    env.https_proxy = None
@@ -14,13 +14,13 @@
 #
 """Chef Solo deployment"""
 import os
+import hashlib
 
 from fabric.api import *
-from fabric.contrib.files import exists, upload_template
-from fabric.utils import abort
 
 from littlechef import cookbook_paths
 from littlechef import LOGFILE
+from littlechef.remote import RemoteScript
 
 # Path to local patch
 BASEDIR = os.path.abspath(os.path.dirname(__file__).replace('\\', '/'))
@@ -39,39 +39,8 @@ def install(version):
             sudo('rm /tmp/install.sh')
 
 
-def configure(current_node=None):
-    """Deploy chef-solo specific files"""
-    current_node = current_node or {}
-    # Ensure that the /tmp/chef-solo/cache directory exist
-    cache_dir = "{0}/cache".format(env.node_work_path)
-    # First remote call, could go wrong
-    try:
-        cache_exists = exists(cache_dir)
-    except EOFError as e:
-        abort("Could not login to node, got: {0}".format(e))
-    if not cache_exists:
-        with settings(hide('running', 'stdout'), warn_only=True):
-            output = sudo('mkdir -p {0}'.format(cache_dir))
-        if output.failed:
-            error = "Could not create {0} dir. ".format(env.node_work_path)
-            error += "Do you have sudo rights?"
-            abort(error)
-    # Change ownership of /tmp/chef-solo/ so that we can rsync
-    with hide('running', 'stdout'):
-        with settings(warn_only=True):
-            output = sudo(
-                'chown -R {0} {1}'.format(env.user, env.node_work_path))
-        if output.failed:
-            error = "Could not modify {0} dir. ".format(env.node_work_path)
-            error += "Do you have sudo rights?"
-            abort(error)
-    # Set up chef solo configuration
-    logging_path = os.path.dirname(LOGFILE)
-    if not exists(logging_path):
-        sudo('mkdir -p {0}'.format(logging_path))
-    if not exists('/etc/chef'):
-        sudo('mkdir -p /etc/chef')
-    # Set parameters and upload solo.rb template
+def _render_solo_rb(current_node):
+    """Returns the contents of solo.rb for the given node"""
     reversed_cookbook_paths = cookbook_paths[:]
     reversed_cookbook_paths.reverse()
     cookbook_paths_list = '[{0}]'.format(', '.join(
@@ -85,16 +54,49 @@ def configure(current_node=None):
         'http_proxy': env.http_proxy,
         'https_proxy': env.https_proxy
     }
-    with settings(hide('everything')):
-        try:
-            upload_template('solo.rb.j2', '/etc/chef/solo.rb',
-                            context=data, use_sudo=True, backup=False,
-                            template_dir=BASEDIR, use_jinja=True, mode=0400)
-        except SystemExit:
-            error = ("Failed to upload '/etc/chef/solo.rb'\nThis "
-                     "can happen when the deployment user does not have a "
-                     "home directory, which is needed as a temporary location")
-            abort(error)
-    with hide('stdout'):
-        sudo('chown root:$(id -g -n root) {0}'.format('/etc/chef/solo.rb'))
+    # Imported here, as it is slow to import and only needed to configure
+    # nodes
+    import jinja2
+    jenv = jinja2.Environment(loader=jinja2.FileSystemLoader(BASEDIR))
+    return jenv.get_template('solo.rb.j2').render(**data)
 
+
+def configure(current_node=None):
+    """Deploy chef-solo specific files
+
+    A fingerprint of solo.rb, the work path and its owner is kept on the
+    node, and nothing more than comparing it is done while it stays the
+    same. Otherwise all steps are run by a single remote script, with
+    solo.rb uploaded together with it
+
+    """
+    current_node = current_node or {}
+    solo_rb = _render_solo_rb(current_node).encode('utf-8')
+    fingerprint = hashlib.sha1('{0}\0{1}\0{2}'.format(
+        solo_rb, env.node_work_path, env.user)).hexdigest()
+    fingerprint_path = "{0}/.configured".format(env.node_work_path)
+    # solo.rb may hold credentials, so it is uploaded rather than written by
+    # the script, and only when the node is not configured yet
+    check = RemoteScript()
+    check.add('[ "$(cat {0} 2>/dev/null)" = {1} -a -f /etc/chef/solo.rb ] '
+              '&& echo {1}; true'.format(fingerprint_path, fingerprint))
+    if fingerprint in check.execute():
+        return
+    script = RemoteScript()
+    # Ensure that the /tmp/chef-solo/cache directory exist
+    cache_dir = "{0}/cache".format(env.node_work_path)
+    script.add('mkdir -p {0}'.format(cache_dir),
+               "Could not create {0} dir. Do you have sudo rights?".format(
+                   env.node_work_path))
+    # Change ownership of /tmp/chef-solo/ so that we can rsync
+    script.add('chown -R {0} {1}'.format(env.user, env.node_work_path),
+               "Could not modify {0} dir. Do you have sudo rights?".format(
+                   env.node_work_path))
+    # Set up chef solo configuration
+    logging_path = os.path.dirname(LOGFILE)
+    script.add('mkdir -p {0} /etc/chef'.format(logging_path),
+               "Could not create {0} and /etc/chef dirs".format(logging_path))
+    script.install('/etc/chef/solo.rb', solo_rb)
+    script.add('echo {0} > {1}'.format(fingerprint, fingerprint_path),
+               "Could not modify {0} dir".format(env.node_work_path))
+    script.execute()
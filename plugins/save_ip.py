@@ -18,19 +18,45 @@ def parse_ip(text):
     return ip
 
 
-def execute(node):
+def get_ip(node):
+    """Pings the node. Returns its IP and whether its name could be resolved
+    """
     proc = subprocess.Popen(['ping', '-c', '1', node['name']],
                     stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     resp, error = proc.communicate()
-    if not error:
-        # Split output into lines and parse the first line to get the IP
-        ip = parse_ip(resp.split("\n")[0])
-        if not ip:
-            print "Warning: could not get IP address from node {0}".format(
-                node['name'])
-        print "Node {0} has IP {1}".format(node['name'], ip)
-        # Update with the ipaddress field in the corresponding node.json
-        node['ipaddress'] = ip
-        os.remove(chef.save_config(node, ip))
-    else:
+    if error:
+        return None, False
+    # Split output into lines and parse the first line to get the IP
+    return parse_ip(resp.split("\n")[0]), True
+
+
+def update_ip(node, ip, resolved):
+    """Sets the ipaddress attribute of the node. Returns whether it should
+    be saved
+
+    """
+    if not resolved:
         print "Warning: could not resolve node {0}".format(node['name'])
+        return False
+    if not ip:
+        print "Warning: could not get IP address from node {0}".format(
+            node['name'])
+    print "Node {0} has IP {1}".format(node['name'], ip)
+    # Update with the ipaddress field in the corresponding node.json
+    node['ipaddress'] = ip
+    return True
+
+
+def execute(node):
+    ip, resolved = get_ip(node)
+    if update_ip(node, ip, resolved):
+        os.remove(chef.save_config(node, ip))
+
+
+def execute_many(nodes, pool, writer):
+    """Pings all nodes at once"""
+    for node, (ip, resolved) in zip(nodes, pool.map(get_ip, nodes)):
+        # Existing node files are only overwritten when an IP was found,
+        # as execute does
+        if update_ip(node, ip, resolved) and ip:
+            writer.save(node)
@@ -1,21 +1,18 @@
 """Saves some virtualization attributes in case the node is a Xen host"""
-import subprocess
 import os
-import json
 
 from fabric.api import env, sudo, abort, hide
 
-from littlechef import chef, lib
+from littlechef import chef, facts, lib
 
 
 def execute(node):
-    """Uses ohai to get virtualization information which is then saved to then
-    node file
+    """Uses ohai's virtualization information from the facts store, which is
+    then saved to then node file
 
     """
-    with hide('everything'):
-        virt = json.loads(sudo('ohai virtualization'))
-    if not len(virt) or virt[0][1] != "host":
+    virt = facts.get_facts()['virtualization'] or {}
+    if virt.get('role') != "host":
         # It may work for virtualization solutions other than Xen
         print("This node is not a Xen host, doing nothing")
         return
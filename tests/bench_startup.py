@@ -0,0 +1,49 @@
+"""Measures how long the fix command takes for commands which don't connect
+to any node, which is mostly the time it takes to start. Run it from the
+tests directory, which is a kitchen:
+
+    python bench_startup.py [RUNS]
+
+"""
+import os
+import sys
+import time
+import subprocess
+
+FIX = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'fix')
+COMMANDS = [
+    ['--version'],
+    ['-l'],
+    ['list_roles'],
+    ['list_nodes'],
+    ['not_a_command'],
+]
+
+
+def measure(args, runs):
+    """Returns the best and the median time of running fix with the given
+    arguments
+
+    """
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.call([sys.executable, FIX] + args,
+                            stdout=devnull, stderr=devnull)
+            timings.append(time.time() - start)
+    timings.sort()
+    return timings[0], timings[len(timings) // 2]
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    print("fix startup time over {0} runs".format(runs))
+    for args in COMMANDS:
+        best, median = measure(args, runs)
+        print("  {0:<20} best {1:.3f}s  median {2:.3f}s".format(
+            ' '.join(args), best, median))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,7 @@
+"""Dummy LittleChef plugin working on all nodes at once"""
+
+
+def execute_many(nodes, pool, writer):
+    """Working plugin"""
+    names = pool.map(lambda node: node['name'], nodes)
+    print "Worked on {0}!".format(', '.join(names))
@@ -30,3 +30,10 @@ class BaseTest(unittest.TestCase):
         runner.env.key_filename = None
         runner.env.node_work_path = None
         runner.env.encrypted_data_bag_secret = None
+        runner.env.relay = None
+        runner.env.pull = None
+        runner.env.packages_bundle = None
+        runner.env.fleet_size = None
+        runner.env.rollout = None
+        runner.env.berksfile = None
+        runner.env.berksfile_vendored = None
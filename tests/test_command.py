@@ -78,7 +78,27 @@ class TestConfig(BaseTest):
         self.assertTrue(expected in resp)
         commands = resp.split('\nAvailable commands:\n')[-1]
         commands = filter(None, commands.split('\n'))
-        self.assertEquals(len(commands), 21)
+        self.assertEquals(len(commands), 23)
+
+    def test_command_not_found(self):
+        """Should list the available commands when a command is not found"""
+        resp, error = self.execute([fix, 'not_a_command'])
+        self.assertTrue(
+            "Command(s) not found:\n    not_a_command" in error, error)
+        self.assertTrue("Available commands:" in resp, resp)
+
+    def test_threads_without_concurrency(self):
+        """Should refuse --threads without --concurrency"""
+        resp, error = self.execute([fix, '--threads', 'list_nodes'])
+        self.assertTrue("--threads requires --concurrency" in error, error)
+        self.assertEquals(resp, "", resp)
+
+    def test_max_age_without_skip_unchanged(self):
+        """Should refuse --max-age without --skip-unchanged"""
+        resp, error = self.execute([fix, '--max-age', '2', 'list_nodes'])
+        self.assertTrue(
+            "--max-age requires --skip-unchanged" in error, error)
+        self.assertEquals(resp, "", resp)
 
     def test_verbose(self):
         """Should turn on verbose output"""
@@ -138,6 +158,15 @@ class TestRunner(BaseTest):
         expected = "Executing plugin '{0}' on {1}".format("dummy", "testnode1")
         self.assertTrue(expected in resp, resp + error)
 
+    def test_plugin_many(self):
+        """Should execute a plugin once for all nodes when it can"""
+        resp, error = self.execute(
+            [fix, 'node:testnode1,testnode2', 'plugin:dummy_many'])
+        self.assertTrue("Executing plugin 'dummy_many' on 2 nodes" in resp,
+                        resp + error)
+        self.assertEqual(resp.count("Worked on testnode1, testnode2!"), 1,
+                         resp + error)
+
     def test_list_plugins(self):
         """Should print a list of available plugins"""
         resp, error = self.execute([fix, 'list_plugins'])
@@ -13,44 +13,545 @@
 #
 import os
 import json
-
-from fabric.api import env
-from mock import patch
+import shutil
+import socket
+import tarfile
+import tempfile
+import time
+import subprocess
+import threading
+import urllib2
+
+from fabric.api import env, settings, hide
+from fabric.state import output
+from fabric.utils import abort
+from mock import patch, MagicMock
 from nose.tools import raises
+from nose.plugins.skip import SkipTest
 
 import sys
 env_path = "/".join(os.path.dirname(os.path.abspath(__file__)).split('/')[:-1])
 sys.path.insert(0, env_path)
 
-from littlechef import chef, lib, solo, exceptions
+import littlechef
+from littlechef import cache, chef, facts, fleet, lib, metadata, pullserver
+from littlechef import remote
+from littlechef import solo
+from littlechef import exceptions
 from test_base import BaseTest
 
 littlechef_src = os.path.split(os.path.normpath(os.path.abspath(__file__)))[0]
 littlechef_top = os.path.normpath(os.path.join(littlechef_src, '..'))
 
 
+class FakeOutput(str):
+    """Stands for the output of a remote command"""
+    def __new__(cls, value, succeeded=True, return_code=None):
+        output = str.__new__(cls, value)
+        output.succeeded = succeeded
+        output.failed = not succeeded
+        if return_code is None:
+            return_code = 0 if succeeded else 1
+        output.return_code = return_code
+        return output
+
+
+def run_locally(command):
+    """Stands for sudo, running the command on this host instead"""
+    process = subprocess.Popen(['bash', '-c', command],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    return FakeOutput(output, succeeded=process.returncode == 0)
+
+
 class TestSolo(BaseTest):
-    def test_configure_no_sudo_rights(self):
+    @patch('littlechef.remote.put')
+    def test_configure_no_sudo_rights(self, mock_put):
         """Should abort when user has no sudo rights"""
         env.host_string = "extranode"
-        with patch.object(solo, 'exists') as mock_exists:
-            mock_exists.return_value = False
-            with patch.object(solo, 'sudo') as mock_sudo:
-                mock_sudo.failed = True
-                self.assertRaises(SystemExit, solo.configure)
+        with patch.object(remote, 'sudo') as mock_sudo:
+            mock_sudo.return_value = FakeOutput(
+                "littlechef: Could not create None dir. "
+                "Do you have sudo rights?", succeeded=False)
+            self.assertRaises(SystemExit, solo.configure)
+        self.assertEqual(mock_sudo.call_count, 1)
 
     @raises(SystemExit)
-    @patch('littlechef.solo.exists')
-    def test_configure_bad_credentials(self, mock_exists):
+    @patch('littlechef.remote.put')
+    @patch('littlechef.remote.sudo')
+    def test_configure_bad_credentials(self, mock_sudo, mock_put):
         """Should return True when node has been synced"""
-        mock_exists.side_effect = EOFError(
+        mock_sudo.side_effect = EOFError(
             '/usr/lib64/python2.6/getpass.py:83: GetPassWarning: '
             'Can not control echo on the terminal.')
         solo.configure()
 
+    @patch('littlechef.remote.put')
+    @patch('littlechef.remote.sudo')
+    def test_configure(self, mock_sudo, mock_put):
+        """Should upload solo.rb and run all steps in a single remote call
+        when the node is not configured yet
+
+        """
+        env.node_work_path = '/tmp/chef-solo'
+        mock_sudo.return_value = FakeOutput('')
+        solo.configure({'chef_environment': 'production'})
+        # Comparing the fingerprint, then configuring
+        self.assertEqual(mock_sudo.call_count, 2)
+        self.assertEqual(mock_put.call_count, 1)
+        tar = tarfile.open(fileobj=mock_put.call_args[0][0])
+        solo_rb = tar.extractfile('0').read()
+        tar.close()
+        self.assertTrue('environment "production"' in solo_rb)
+        self.assertTrue(
+            'cookbook_path ["/tmp/chef-solo/cookbooks", '
+            '"/tmp/chef-solo/site-cookbooks"]' in solo_rb)
+        self.assertFalse('environment "production"' in
+                         mock_sudo.call_args[0][0])
+
+    @patch('littlechef.remote.put')
+    @patch('littlechef.remote.sudo')
+    def test_configure_unchanged(self, mock_sudo, mock_put):
+        """Should neither upload nor install anything when the fingerprint
+        on the node matches
+
+        """
+        env.node_work_path = '/tmp/chef-solo'
+        mock_sudo.side_effect = lambda script: FakeOutput(
+            script.split('echo ')[-1].split(';')[0] + '\r\n')
+        solo.configure({'chef_environment': 'production'})
+        self.assertEqual(mock_sudo.call_count, 1)
+        self.assertFalse(mock_put.called)
+        self.assertFalse('install' in mock_sudo.call_args[0][0])
+
+    @patch('littlechef.remote.put')
+    @patch('littlechef.remote.sudo')
+    def test_configure_fingerprint(self, mock_sudo, mock_put):
+        """Should only change the fingerprint when solo.rb changes"""
+        env.node_work_path = '/tmp/chef-solo'
+        mock_sudo.return_value = FakeOutput('')
+
+        def get_fingerprint(node):
+            solo.configure(node)
+            script = mock_sudo.call_args[0][0]
+            self.assertTrue(script.endswith('> /tmp/chef-solo/.configured '
+                                            '|| fail \'Could not modify '
+                                            '/tmp/chef-solo dir\''))
+            return script.split('\n')[-1].split()[1]
+        fingerprint = get_fingerprint({'chef_environment': 'production'})
+        self.assertEqual(
+            get_fingerprint({'chef_environment': 'production'}), fingerprint)
+        self.assertNotEqual(
+            get_fingerprint({'chef_environment': 'staging'}), fingerprint)
+
+
+class TestRemoteScript(BaseTest):
+    def test_render(self):
+        """Should install files and run commands in the order given"""
+        script = remote.RemoteScript()
+        script.add('mkdir -p /etc/chef', "Could not create /etc/chef")
+        script.install('/etc/chef/solo.rb', 'file_cache_path "/tmp"',
+                       mode=0644)
+        script.add('rm -f /tmp/old')
+        lines = script.render('/tmp/littlechef-1').splitlines()
+        self.assertEqual(lines[-4:], [
+            "printf '%s' 'file_cache_path \"/tmp\"' > $staging/inline0",
+            "mkdir -p /etc/chef || fail 'Could not create /etc/chef'",
+            "install -m 644 -o root -g $(id -g -n root) $staging/inline0 "
+            "/etc/chef/solo.rb || fail 'Could not install /etc/chef/solo.rb'",
+            "rm -f /tmp/old",
+        ])
+        self.assertTrue('staging=/tmp/littlechef-1' in lines)
+        self.assertFalse(any(line.startswith('tar') for line in lines))
+
+    @patch('littlechef.remote.put')
+    @patch('littlechef.remote.sudo')
+    def test_execute_upload(self, mock_sudo, mock_put):
+        """Should upload big files in a single transfer"""
+        mock_sudo.return_value = FakeOutput('')
+        script = remote.RemoteScript()
+        script.install('/etc/chef/node.json', '{"a": "\\n"}')
+        script.install('/etc/chef/big', 'a' * (remote.INLINE_SIZE + 1))
+        script.install('/etc/chef/solo.rb', 'file_cache_path "/tmp"',
+                       mode=0644)
+        script.execute()
+        self.assertEqual(mock_put.call_count, 1)
+        tar = tarfile.open(fileobj=mock_put.call_args[0][0])
+        self.assertEqual(tar.getnames(), ['0', '1'])
+        self.assertEqual(tar.extractfile('0').read(), '{"a": "\\n"}')
+        tar.close()
+        self.assertTrue('$staging/inline0 /etc/chef/solo.rb' in
+                        mock_sudo.call_args[0][0])
+
+    @patch('littlechef.remote.put')
+    @patch('littlechef.remote.sudo')
+    def test_execute_restricted(self, mock_sudo, mock_put):
+        """Should upload files others may not read instead of writing them
+        from the command line or having them downloaded
+
+        """
+        mock_sudo.return_value = FakeOutput('')
+        server = pullserver.PullServer('127.0.0.1')
+        script = remote.RemoteScript(server)
+        script.install('/etc/chef/encrypted_data_bag_secret', 'secret',
+                       mode=0600)
+        script._run('/tmp/littlechef-1')
+        self.assertFalse('secret' in mock_sudo.call_args[0][0].replace(
+            'encrypted_data_bag_secret', ''))
+        self.assertEqual(script.fetched, [])
+        tar = tarfile.open(fileobj=mock_put.call_args[0][0])
+        self.assertEqual(tar.extractfile('0').read(), 'secret')
+        tar.close()
+
+    def test_render_no_files(self):
+        """Should not unpack anything when there are no files to install"""
+        script = remote.RemoteScript()
+        script.add('rm -f /tmp/old')
+        self.assertFalse('staging' in script.render('/tmp/littlechef-1'))
+
+    @raises(SystemExit)
+    @patch('littlechef.remote.put')
+    @patch('littlechef.remote.sudo')
+    def test_execute_failed(self, mock_sudo, mock_put):
+        """Should abort when a step fails"""
+        mock_sudo.return_value = FakeOutput(
+            "littlechef: Could not create /etc/chef", succeeded=False)
+        script = remote.RemoteScript()
+        script.add('mkdir -p /etc/chef', "Could not create /etc/chef")
+        script.execute()
+
+
+    def test_render_pull(self):
+        """Should download big files from the pull server"""
+        server = pullserver.PullServer('127.0.0.1')
+        script = remote.RemoteScript(server)
+        content = 'a' * (remote.INLINE_SIZE + 1)
+        script.install('/etc/chef/big', content, mode=0644)
+        lines = script.render('/tmp/littlechef-1', 'http://x/t').splitlines()
+        digest = server.publish(content=content)
+        self.assertEqual(script.files, [])
+        self.assertEqual(script.fetched, [digest])
+        self.assertTrue('pull=http://x/t' in lines)
+        self.assertTrue(remote.FETCH_FUNCTION in lines)
+        self.assertEqual(lines[-2:], [
+            'fetch "$pull/{0}" $staging/fetch0 {0} '
+            '|| fail \'Could not download /etc/chef/big\''.format(digest),
+            "install -m 644 -o root -g $(id -g -n root) $staging/fetch0 "
+            "/etc/chef/big || fail 'Could not install /etc/chef/big'",
+        ])
+
+    def _pull(self, digest=None):
+        """Has a local shell download a file from a local pull server"""
+        if subprocess.call('command -v curl || command -v wget', shell=True,
+                           stdout=subprocess.PIPE) != 0:
+            raise SkipTest("Neither curl nor wget are available")
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        filename = os.path.join(path, 'bundle.tar.gz')
+        with open(filename, 'wb') as f:
+            f.write(os.urandom(100000))
+        script = remote.RemoteScript(pullserver.PullServer('127.0.0.1'))
+        script.add(script.download_command(
+            os.path.join(path, 'downloaded'), filename, digest),
+            "Could not download the bundle")
+        with patch.object(remote, 'sudo', side_effect=run_locally):
+            script.execute()
+        with open(filename, 'rb') as f:
+            with open(os.path.join(path, 'downloaded'), 'rb') as downloaded:
+                self.assertEqual(downloaded.read(), f.read())
+
+    def test_execute_pull(self):
+        """Should have the node download and verify files"""
+        self._pull()
+
+    @raises(SystemExit)
+    def test_execute_pull_corrupted(self):
+        """Should abort when a downloaded file does not match its hash"""
+        self._pull('0' * 40)
+
+    @patch('littlechef.remote.sudo')
+    def test_execute_warning(self, mock_sudo):
+        """Should go on when a step with a warning fails"""
+        mock_sudo.return_value = FakeOutput(
+            remote.WARNING_PREFIX + "could not do it")
+        script = remote.RemoteScript()
+        script.add('false', warning="could not do it")
+        self.assertEqual(script.commands,
+                         ["false || echo 'littlechef warning: could not do it'"])
+        script.execute()
+
+
+class TestPullServer(BaseTest):
+    def test_serve(self):
+        """Should only serve published files"""
+        server = pullserver.PullServer('127.0.0.1')
+        digest = server.publish(content='{"run_list": []}')
+        with server.serve() as url:
+            self.assertTrue(url.endswith('/' + server.token))
+            self.assertEqual(urllib2.urlopen(url + '/' + digest).read(),
+                             '{"run_list": []}')
+            for path in [url + '/' + 'f' * 40,
+                         url.replace(server.token, 'other') + '/' + digest]:
+                try:
+                    urllib2.urlopen(path)
+                except urllib2.HTTPError as e:
+                    self.assertEqual(e.code, 404)
+                else:
+                    self.fail("{0} was served".format(path))
+
+    def test_serve_tunnel(self):
+        """Should serve the connections the node forwards over SSH"""
+        env.host_string = 'node1'
+        transport = MagicMock()
+        transport.request_port_forward.return_value = 40000
+        connection = MagicMock()
+        connection.get_transport.return_value = transport
+        server = pullserver.PullServer()
+        digest = server.publish(content='packages')
+        with patch.object(pullserver, 'connections', {'node1': connection}):
+            with server.serve() as url:
+                self.assertEqual(
+                    url, 'http://127.0.0.1:40000/' + server.token)
+                # A socket stands for the SSH channel of the connection
+                handler = transport.request_port_forward.call_args[1][
+                    'handler']
+                channel, node_side = socket.socketpair()
+                handler(channel, ('127.0.0.1', 5000), ('127.0.0.1', 40000))
+                node_side.sendall('GET /{0}/{1} HTTP/1.0\r\n\r\n'.format(
+                    server.token, digest))
+                response = ''
+                for data in iter(lambda: node_side.recv(4096), ''):
+                    response += data
+                node_side.close()
+        self.assertTrue(response.startswith('HTTP/1.0 200'))
+        self.assertTrue(response.endswith('\r\n\r\npackages'))
+        transport.cancel_port_forward.assert_called_once_with(
+            '127.0.0.1', 40000)
+
+
+class TestFleet(BaseTest):
+    def test_execute(self):
+        """Should run the task on every host, each in its own thread"""
+        def task(suffix):
+            env.user = env.host + suffix
+            return env.host_string, env.user, fleet.in_worker()
+        env.user = 'testuser'
+        results = fleet.execute(
+            task, ['testnode1', 'admin@testnode2', 'testnode3'], 2, '-x')
+        self.assertEqual(results, {
+            'testnode1': ('testnode1', 'testnode1-x', True),
+            'admin@testnode2': ('admin@testnode2', 'testnode2-x', True),
+            'testnode3': ('testnode3', 'testnode3-x', True),
+        })
+        self.assertEqual(env.user, 'testuser')
+        self.assertFalse(fleet.in_worker())
+
+    def test_execute_isolated(self):
+        """Should keep the settings of each thread apart"""
+        entered = threading.Event()
+        checked = threading.Event()
+        seen = {}
+
+        def task():
+            if env.host_string == 'testnode1':
+                with settings(hide('stdout'), node_work_path='/srv/chef'):
+                    entered.set()
+                    checked.wait(5)
+                    seen['testnode1'] = env.node_work_path, output.stdout
+            else:
+                entered.wait(5)
+                seen['testnode2'] = env.node_work_path, output.stdout
+                checked.set()
+        env.node_work_path = '/tmp/chef-solo'
+        fleet.execute(task, ['testnode1', 'testnode2'], 2)
+        self.assertEqual(seen, {'testnode1': ('/srv/chef', False),
+                                'testnode2': ('/tmp/chef-solo', True)})
+        self.assertEqual(env.node_work_path, '/tmp/chef-solo')
+        self.assertTrue(output.stdout)
+
+    def test_execute_io_threads(self):
+        """Should give Fabric's I/O threads the settings of their host"""
+        from fabric import operations
+
+        def task():
+            seen = []
+            handler = operations.ThreadHandler(
+                'out', lambda: seen.append(env.host_string))
+            handler.thread.join()
+            return seen
+        self.assertEqual(fleet.execute(task, ['testnode1'], 1),
+                         {'testnode1': ['testnode1']})
+
+    def _get_controller(self, load=0.5):
+        self.now = 0
+        return fleet.AdaptiveConcurrency(
+            initial=4, clock=lambda: self.now, load=lambda: load)
+
+    def _complete(self, controller, seconds, latency=1, succeeded=True,
+                  phases=None):
+        """Has as many hosts as are in flight done in the given time"""
+        count = controller.limit
+        for i in range(count):
+            self.now += float(seconds) / count
+            controller.record(succeeded, phases or
+                              {'configure': latency, 'cook': 10})
+
+    def test_adaptive_grow(self):
+        """Should double the hosts in flight while they get done faster"""
+        controller = self._get_controller()
+        self._complete(controller, 10)
+        self.assertEqual(controller.limit, 8)
+        self._complete(controller, 10)
+        self.assertEqual(controller.limit, 16)
+        # No improvement
+        self._complete(controller, 20)
+        self.assertEqual(controller.limit, 16)
+
+    def test_adaptive_latency(self):
+        """Should back off when local phases get much slower"""
+        controller = self._get_controller()
+        self._complete(controller, 10)
+        self._complete(controller, 10, latency=5)
+        self.assertEqual(controller.limit, 6)
+        # It then grows a step at a time
+        self._complete(controller, 5, latency=1)
+        self.assertEqual(controller.limit, 7)
+
+    def test_adaptive_congested(self):
+        """Should back off when hosts fail before cooking, or when this
+        host is overloaded
+
+        """
+        controller = self._get_controller()
+        self._complete(controller, 10, succeeded=False,
+                       phases={'configure': 1})
+        self.assertEqual(controller.limit, 3)
+        # Failing while cooking is not a matter of concurrency
+        self._complete(controller, 5, succeeded=False)
+        self.assertEqual(controller.limit, 4)
+        controller = self._get_controller(load=1.5)
+        self._complete(controller, 10)
+        self.assertEqual(controller.limit, 3)
+
+    def test_execute_auto(self):
+        """Should run all hosts with an adaptive concurrency"""
+        results = fleet.execute(lambda: env.host_string,
+                                ['testnode1', 'testnode2'], 'auto')
+        self.assertEqual(results, {'testnode1': 'testnode1',
+                                   'testnode2': 'testnode2'})
+
+    @raises(SystemExit)
+    def test_execute_failed(self):
+        """Should abort once all hosts are done when any of them failed"""
+        done = []
+
+        def task():
+            if env.host_string == 'testnode1':
+                abort("Could not configure")
+            done.append(env.host_string)
+        try:
+            fleet.execute(task, ['testnode1', 'testnode2'], 1)
+        finally:
+            self.assertEqual(done, ['testnode2'])
+
+    def test_rollout_waves(self):
+        """Should split hosts into a canary wave and growing waves"""
+        rollout = fleet.Rollout(canary=1, growth=2)
+        hosts = ['node{0}'.format(i) for i in range(10)]
+        self.assertEqual([len(wave) for wave in rollout.waves(hosts)],
+                         [1, 2, 4, 3])
+        rollout = fleet.Rollout(canary=2, growth=1)
+        self.assertEqual([len(wave) for wave in rollout.waves(hosts)],
+                         [2, 3, 4, 1])
+
+    def test_roll_out_role_limits(self):
+        """Should not run more hosts with a role at once than its limit"""
+        lock = threading.Lock()
+        in_flight = {'db': 0, 'web': 0}
+        most = {'db': 0, 'web': 0}
+        roles = {'db1': ['db'], 'db2': ['db'], 'db3': ['db'],
+                 'web1': ['web'], 'web2': ['web'], 'web3': ['web']}
+
+        def task():
+            role = roles[env.host_string][0]
+            with lock:
+                in_flight[role] += 1
+                most[role] = max(most[role], in_flight[role])
+            time.sleep(0.05)
+            with lock:
+                in_flight[role] -= 1
+        rollout = fleet.Rollout(canary=6, role_limits={'db': 1, 'web': 2},
+                                roles=roles)
+        results = fleet.roll_out(task, sorted(roles), 6, rollout)
+        self.assertEqual(sorted(results), sorted(roles))
+        self.assertEqual(most, {'db': 1, 'web': 2})
+
+    @raises(SystemExit)
+    def test_roll_out_stopped(self):
+        """Should stop starting waves when too many hosts failed"""
+        done = []
+
+        def task():
+            done.append(env.host_string)
+            if env.host_string == 'testnode2':
+                abort("Could not configure")
+        hosts = ['testnode{0}'.format(i) for i in range(1, 8)]
+        rollout = fleet.Rollout(canary=1, growth=2, max_failures=0.2)
+        try:
+            fleet.roll_out(task, hosts, 4, rollout)
+        finally:
+            # The second wave failed, so the last two are never started
+            self.assertEqual(sorted(done), hosts[:3])
+            self.assertEqual((rollout.done, rollout.failed), (3, 1))
+
+
+class TestFacts(BaseTest):
+    def setUp(self):
+        super(TestFacts, self).setUp()
+        env.host_string = 'testnode1'
+        self.addCleanup(facts.forget, 'testnode1')
+
+    def test_get_facts(self):
+        """Should read facts from the store until they expire"""
+        with patch.object(facts, 'sudo') as mock_sudo:
+            mock_sudo.return_value = (
+                '{"ipaddress": "10.0.0.1", "platform": "debian", '
+                '"uptime": "5 days"}\n' + facts.SEPARATOR + '\nChef: 11.4.0')
+            gathered = facts.get_facts()
+            self.assertEqual(facts.get_facts(), gathered)
+            self.assertEqual(mock_sudo.call_count, 1)
+            with patch.object(facts.time, 'time',
+                              return_value=time.time() + 25 * 3600):
+                facts.get_facts()
+            self.assertEqual(mock_sudo.call_count, 2)
+        self.assertEqual(gathered['ipaddress'], '10.0.0.1')
+        self.assertEqual(gathered['chef_solo'], 'Chef: 11.4.0')
+        self.assertEqual(gathered['virtualization'], None)
+        self.assertFalse('uptime' in gathered)
+
+    def test_get_facts_no_chef(self):
+        """Should have no ohai facts and no chef-solo without Chef"""
+        with patch.object(facts, 'sudo') as mock_sudo:
+            mock_sudo.return_value = '\n' + facts.SEPARATOR + '\n'
+            gathered = facts.get_facts()
+        self.assertEqual(gathered['ipaddress'], None)
+        self.assertEqual(gathered['chef_solo'], None)
+
 
 class TestLib(BaseTest):
 
+    def test_group_outputs(self):
+        """Should group nodes with the same output, biggest groups first"""
+        groups = lib.group_outputs({
+            'node1': 'ok\n', 'node2': 'error', 'node3': 'ok', 'node4': 'ok',
+            'node5': 'other', 'node6': 'other'})
+        self.assertEqual(groups, [
+            (['node1', 'node3', 'node4'], 'ok'),
+            (['node5', 'node6'], 'other'),
+            (['node2'], 'error'),
+        ])
+
     def test_get_node_not_found(self):
         """Should get empty template when node is not found"""
         name = 'Idon"texist'
@@ -89,6 +590,32 @@ class TestLib(BaseTest):
         self.assertEqual(len(lib.get_nodes("production")), 3)
         self.assertEqual(len(lib.get_nodes("staging")), 1)
 
+    def test_get_node_fields(self):
+        """Should only read the rest of a lazy node when it is needed"""
+        with patch.object(lib, 'get_node', wraps=lib.get_node) as mock_get:
+            node = lib.get_node('testnode2', fields=['run_list', 'tags'])
+            self.assertTrue(isinstance(node, lib.LazyNode))
+            self.assertEqual(node['name'], 'testnode2')
+            self.assertEqual(node['chef_environment'], 'staging')
+            self.assertTrue('role[all_you_can_eat]' in node['run_list'])
+            self.assertFalse('tags' in node)
+            self.assertEqual(mock_get.call_count, 1)
+            # Any other field reads the whole node file
+            node['run_list'] = []
+            self.assertEqual(node['subversion']['user'], 'node_user')
+            self.assertEqual(mock_get.call_count, 2)
+        expected = lib.get_node('testnode2')
+        expected['run_list'] = []
+        self.assertEqual(dict(node), expected)
+
+    def test_get_nodes_in_env_fields(self):
+        """Should not read all fields of nodes filtered out by environment"""
+        with patch.object(lib, 'LazyNode', wraps=lib.LazyNode) as mock_lazy:
+            nodes = lib.get_nodes("staging")
+        self.assertEqual(mock_lazy.call_count, len(self.nodes))
+        self.assertEqual([node['name'] for node in nodes], ['testnode2'])
+        self.assertTrue(type(nodes[0]) is dict)
+
     def test_nodes_with_role(self):
         """Should return nodes when role is present in the explicit run_list"""
         nodes = list(lib.get_nodes_with_role('all_you_can_eat'))
@@ -112,6 +639,38 @@ class TestLib(BaseTest):
             self.assertEqual(len(nodes), 1)
             self.assertTrue(nodes[0]['name'], 'nestedroles1')
 
+    def test_expand_run_list(self):
+        """Should fully expand nested roles in Chef's run_list order"""
+        node = lib.get_node('nestedroles1')
+        roles, recipes = lib.expand_run_list(node)
+        self.assertEqual(
+            roles, ['top_level_role', 'sub_role', 'sub_sub_role', 'base'])
+        self.assertEqual(recipes, ['subversion'])
+
+        node = {'run_list': ['recipe[vim]', 'role[all_you_can_eat]',
+                             'recipe[subversion]', 'role[base]']}
+        roles, recipes = lib.expand_run_list(node)
+        self.assertEqual(roles, ['all_you_can_eat', 'base'])
+        self.assertEqual(recipes, ['vim', 'man', 'subversion'])
+
+    def test_expand_run_list_bare_entries(self):
+        """Should ignore run_list entries which are not a role or a recipe"""
+        node = {'run_list': ['vim', 'recipe[subversion]', 'role', '']}
+        self.assertEqual(lib.expand_run_list(node), ([], ['subversion']))
+
+    @raises(SystemExit)
+    def test_expand_run_list_role_cycle(self):
+        """Should abort when a role ends up including itself"""
+        run_lists = {
+            'cycle_a': ['role[cycle_b]'],
+            'cycle_b': ['recipe[vim]', 'role[cycle_a]'],
+        }
+        with patch.object(lib, '_get_role') as mock_get_role:
+            mock_get_role.side_effect = lambda name: {
+                'run_list': run_lists[name]}
+            with patch.dict(lib._role_expansions, clear=True):
+                lib.expand_run_list({'run_list': ['role[cycle_a]']})
+
     def test_nodes_with_role_wildcard(self):
         """Should return node when wildcard is given and role is asigned"""
         nodes = list(lib.get_nodes_with_role('all_*'))
@@ -136,6 +695,79 @@ class TestLib(BaseTest):
         nodes = list(lib.get_nodes_with_role('all_you_can_eat', 'production'))
         self.assertFalse(len(nodes))
 
+    def test_node_index_prefix_search(self):
+        """Should only match the indexed names starting with the prefix"""
+        index = lib.NodeIndex([
+            {'name': 'n1', 'run_list': ['recipe[web]'], 'tags': ['a']},
+            {'name': 'n2', 'run_list': ['recipe[webapp]', 'recipe[db]']},
+            {'name': 'n3', 'run_list': ['recipe[wea]', 'recipe[wec]'],
+             'chef_environment': 'staging', 'tags': ['a']},
+        ])
+        self.assertEqual([n['name'] for n in index.with_recipe('web*')],
+                         ['n1', 'n2'])
+        self.assertEqual([n['name'] for n in index.with_recipe('we*')],
+                         ['n1', 'n2', 'n3'])
+        self.assertEqual(index.with_recipe('we'), [])
+        self.assertEqual([n['name'] for n in index.with_tag('a', 'staging')],
+                         ['n3'])
+
+    def test_node_index_new_node(self):
+        """Should index nodes added after the index was built"""
+        self.assertEqual(len(list(lib.get_nodes_with_role('base'))), 2)
+        env.host_string = 'extranode'
+        chef.save_config({"run_list": ["role[base]"]})
+        nodes = list(lib.get_nodes_with_role('base'))
+        self.assertEqual([n['name'] for n in nodes],
+                         ['extranode', 'nestedroles1', 'testnode2'])
+
+    def test_node_index_persisted(self):
+        """Should read the node index stored by an earlier run, and build it
+        again when a role changes
+
+        """
+        signature = lib._get_nodes_signature()
+        index = lib.NodeIndex(lib.get_nodes(fields=lib.NodeIndex.FIELDS))
+        with patch.object(lib, 'RACY_INTERVAL', -1):
+            lib._save_node_index(signature, index)
+        self.addCleanup(os.remove, lib.NODE_INDEX_PATH)
+        with patch.object(lib, '_node_index', None):
+            with patch.object(lib, 'get_nodes') as mock_get_nodes:
+                nodes = list(lib.get_nodes_with_role('base'))
+            self.assertFalse(mock_get_nodes.called)
+            self.assertEqual([n['name'] for n in nodes],
+                             ['nestedroles1', 'testnode2'])
+            # Fields which were not indexed are still read
+            self.assertEqual(nodes[1]['chef_environment'], 'staging')
+        role_path = os.path.join('roles', 'base.json')
+        stat = os.stat(role_path)
+        os.utime(role_path, (stat.st_atime, stat.st_mtime + 1))
+        self.addCleanup(os.utime, role_path, (stat.st_atime, stat.st_mtime))
+        with patch.object(lib, '_node_index', None):
+            with patch.object(lib, 'get_nodes') as mock_get_nodes:
+                mock_get_nodes.return_value = []
+                self.assertEqual(list(lib.get_nodes_with_role('base')), [])
+            self.assertTrue(mock_get_nodes.called)
+
+    def test_node_index_role_subdirectory(self):
+        """Should build the node index again when a role in a subdirectory
+        of roles/ changes
+
+        """
+        role_dir = os.path.join('roles', 'sub')
+        os.mkdir(role_dir)
+        self.addCleanup(shutil.rmtree, role_dir)
+        role_path = os.path.join(role_dir, 'web.json')
+        with open(role_path, 'w') as f:
+            f.write('{"name": "web", "run_list": []}')
+        lib.get_node_index()
+        with open(role_path, 'w') as f:
+            f.write('{"name": "web", "run_list": ["recipe[vim]"]}')
+        self.addCleanup(setattr, lib, '_node_index', None)
+        with patch.object(lib, 'get_nodes') as mock_get_nodes:
+            mock_get_nodes.return_value = []
+            lib.get_node_index()
+        self.assertTrue(mock_get_nodes.called)
+
     def test_nodes_with_recipe(self):
         """Should return node when recipe is in the explicit run_list"""
         nodes = list(lib.get_nodes_with_recipe('vim'))
@@ -187,6 +819,16 @@ class TestLib(BaseTest):
         nodes = list(lib.get_nodes_with_tag('top', '_default'))
         self.assertEqual(len(nodes), 1)
 
+    def test_get_cookbook_closure(self):
+        """Should return the cookbooks of the recipes and their dependencies"""
+        self.assertEqual(
+            lib.get_cookbook_closure(['vim', 'subversion::client', 'vim']),
+            ['subversion', 'vim'])
+        dependencies = {'subversion': ['apache2'], 'apache2': ['man']}
+        with patch.dict(lib._cookbook_dependencies, dependencies):
+            self.assertEqual(lib.get_cookbook_closure(['subversion']),
+                             ['apache2', 'man', 'subversion'])
+
     def test_list_recipes(self):
         recipes = lib.get_recipes()
         self.assertEqual(len(recipes), 6)
@@ -208,11 +850,25 @@ class TestLib(BaseTest):
         # Should fail to import a bad plugin module
         self.assertRaises(SystemExit, lib.import_plugin, "bad")
 
+    def test_import_plugin_compiled(self):
+        """Should compile a plugin once and keep its compiled code"""
+        self.addCleanup(shutil.rmtree,
+                        os.path.join(littlechef.CACHE_DIR, 'plugins'), True)
+        plugin = lib.import_plugin("dummy")
+        with patch.object(lib, 'compile') as mock_compile:
+            plugin = lib.import_plugin("dummy")
+        self.assertFalse(mock_compile.called)
+        self.assertEqual(plugin.__doc__, "Dummy LittleChef plugin")
+        self.assertTrue(callable(plugin.execute))
+
     def test_get_plugins(self):
         """Should get a list of available plugins"""
-        plugins = [p for p in lib.get_plugins()]
-        self.assertEqual(len(plugins), 2)
+        with patch.object(lib, 'import_plugin') as mock_import:
+            plugins = [p for p in lib.get_plugins()]
+        self.assertFalse(mock_import.called)
+        self.assertEqual(len(plugins), 3)
         self.assertEqual(plugins[0]['bad'], "Plugin has a syntax error")
+        self.assertEqual(plugins[1]['dummy'], "Dummy LittleChef plugin")
 
     def test_get_environments(self):
         """Should get a list of all environments"""
@@ -244,6 +900,172 @@ class TestLib(BaseTest):
         lib.get_environment('not-exists')
 
 
+class TestKitchenIndex(BaseTest):
+    def setUp(self):
+        super(TestKitchenIndex, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.tmpdir, 'cache', 'index')
+        self.filename = os.path.join(self.tmpdir, 'node.json')
+        self.write_file({'run_list': []})
+        self.parsed = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TestKitchenIndex, self).tearDown()
+
+    def write_file(self, data):
+        with open(self.filename, 'w') as f:
+            f.write(json.dumps(data))
+        # Files modified right now are considered racy and never stored
+        old = os.stat(self.filename).st_mtime - 60
+        os.utime(self.filename, (old, old))
+
+    def parse(self, path):
+        self.parsed += 1
+        return lib._read_json(path)
+
+    def test_get_unchanged_file(self):
+        """Should parse an unchanged file only once"""
+        index = cache.KitchenIndex(self.index_path)
+        self.assertEqual(index.get(self.filename, self.parse), {'run_list': []})
+        data = index.get(self.filename, self.parse)
+        self.assertEqual(data, {'run_list': []})
+        self.assertEqual(self.parsed, 1)
+        # Returned objects can be modified without affecting the index
+        data['run_list'].append('recipe[vim]')
+        self.assertEqual(index.get(self.filename, self.parse), {'run_list': []})
+
+    def test_get_changed_file(self):
+        """Should parse a file again when it has changed"""
+        index = cache.KitchenIndex(self.index_path)
+        index.get(self.filename, self.parse)
+        self.write_file({'run_list': ['recipe[vim]']})
+        self.assertEqual(index.get(self.filename, self.parse),
+                         {'run_list': ['recipe[vim]']})
+        self.assertEqual(self.parsed, 2)
+
+    def test_get_fields(self):
+        """Should only return the given top-level fields"""
+        self.write_file({'run_list': [], 'tags': ['a'], 'attr': {'a': 1}})
+        index = cache.KitchenIndex(self.index_path)
+        self.assertEqual(index.get(self.filename, self.parse, ['tags', 'x']),
+                         {'tags': ['a']})
+        self.assertEqual(index.get(self.filename, self.parse, ['run_list']),
+                         {'run_list': []})
+        self.assertEqual(self.parsed, 1)
+
+    def test_save(self):
+        """Should reuse a saved index in a new process"""
+        index = cache.KitchenIndex(self.index_path)
+        index.get(self.filename, self.parse)
+        index.save()
+        self.assertTrue(os.path.exists(self.index_path))
+        index = cache.KitchenIndex(self.index_path)
+        self.assertEqual(index.get(self.filename, self.parse), {'run_list': []})
+        self.assertEqual(self.parsed, 1)
+
+
+class TestMetadata(BaseTest):
+    def setUp(self):
+        super(TestMetadata, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.cookbook_path = os.path.join(self.tmpdir, 'man')
+        shutil.copytree(os.path.join('cookbooks', 'man'), self.cookbook_path)
+        os.remove(os.path.join(self.cookbook_path, 'metadata.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TestMetadata, self).tearDown()
+
+    def test_evaluate(self):
+        """Should generate the same metadata as knife"""
+        for path in [os.path.join('cookbooks', 'subversion'),
+                     os.path.join('cookbooks', 'vim'),
+                     os.path.join('site-cookbooks', 'subversion')]:
+            rb_path = os.path.join(path, 'metadata.rb')
+            with open(rb_path, 'r') as f:
+                data = metadata.evaluate(
+                    f.read(), os.path.basename(path), rb_path)
+            with open(os.path.join(path, 'metadata.json'), 'r') as f:
+                self.assertEqual(data, json.loads(f.read()))
+
+    def test_evaluate_options(self):
+        """Should evaluate parenthesized calls, Ruby 1.9 hashes and arrays"""
+        source = """
+            name 'apache'  # a comment
+            depends('apt', '>= 1.0')
+            ['debian', 'ubuntu'].each { |os| supports os, '>= 8' }
+            attribute 'apache/ports', display_name: "Ports", type: 'array',
+              default: ["80", "443"]
+        """
+        data = metadata.evaluate(source, 'apache2', 'metadata.rb')
+        self.assertEqual(data['name'], 'apache')
+        self.assertEqual(data['dependencies'], {'apt': '>= 1.0'})
+        self.assertEqual(data['platforms'],
+                         {'debian': '>= 8', 'ubuntu': '>= 8'})
+        self.assertEqual(data['attributes']['apache/ports']['default'],
+                         ['80', '443'])
+        self.assertEqual(data['attributes']['apache/ports']['type'], 'array')
+
+    def test_evaluate_unsupported(self):
+        """Should raise MetadataError when Ruby code is not supported"""
+        for source in ['version "#{major}.0"',
+                       'if true\n  depends "apt"\nend',
+                       'long_description <<-EOH\nText\nEOH',
+                       'depends "apt" unless windows?']:
+            self.assertRaises(exceptions.MetadataError,
+                              metadata.evaluate, source, 'x', 'metadata.rb')
+
+    def test_generate(self):
+        """Should write metadata.json, evaluating each metadata.rb once"""
+        self.assertTrue(metadata.generate(self.cookbook_path, 'man'))
+        json_path = os.path.join(self.cookbook_path, 'metadata.json')
+        with open(json_path, 'r') as f:
+            data = json.loads(f.read())
+        self.assertEqual(data['recipes'], {'man': 'Installs man package'})
+        os.remove(json_path)
+        with patch.object(metadata, 'evaluate') as mock_evaluate:
+            self.assertTrue(metadata.generate(self.cookbook_path, 'man'))
+            self.assertFalse(mock_evaluate.called)
+        self.assertTrue(os.path.exists(json_path))
+
+    def test_generate_reads_files(self):
+        """Should evaluate metadata.rb again when it reads other files"""
+        with open(os.path.join(self.cookbook_path, 'metadata.rb'), 'a') as f:
+            f.write("\nlong_description IO.read(File.join("
+                    "File.dirname(__FILE__), 'README.md'))\n")
+        json_path = os.path.join(self.cookbook_path, 'metadata.json')
+        for readme in ['First', 'Second']:
+            with open(os.path.join(self.cookbook_path, 'README.md'),
+                      'w') as f:
+                f.write(readme)
+            self.assertTrue(metadata.generate(self.cookbook_path, 'man'))
+            with open(json_path, 'r') as f:
+                self.assertEqual(json.loads(f.read())['long_description'],
+                                 readme)
+
+    def test_generate_unsupported(self):
+        """Should fall back to knife when metadata.rb can't be evaluated"""
+        with open(os.path.join(self.cookbook_path, 'metadata.rb'), 'a') as f:
+            f.write('\nsupports "redhat" if ENV["REDHAT"]\n')
+        self.assertFalse(metadata.generate(self.cookbook_path, 'man'))
+        with patch.object(lib, '_generate_metadata_with_knife') as mock_knife:
+            lib._generate_metadata(self.cookbook_path, self.tmpdir, 'man')
+            mock_knife.assert_called_once_with(
+                self.cookbook_path, self.tmpdir, 'man')
+
+    def test_generate_all_unsupported_once(self):
+        """Should only hand a cookbook to knife once per process"""
+        with open(os.path.join(self.cookbook_path, 'metadata.rb'), 'a') as f:
+            f.write('\nsupports "redhat" if ENV["REDHAT"]\n')
+        with patch.object(lib, '_generate_metadata_with_knife') as mock_knife:
+            with patch.object(lib, 'cookbook_paths', [self.tmpdir]):
+                lib.generate_all_metadata(['man'])
+                lib._generate_metadata(self.cookbook_path, self.tmpdir, 'man')
+            mock_knife.assert_called_once_with(
+                self.cookbook_path, self.tmpdir, 'man')
+
+
 class TestChef(BaseTest):
     def tearDown(self):
         chef.remove_local_node_data_bag()
@@ -273,45 +1095,89 @@ class TestChef(BaseTest):
             # It should *NOT* have "base" assigned
             self.assertEqual(data['run_list'], ["recipe[subversion]"])
 
-    def test_get_ipaddress(self):
-        """Should add ipaddress attribute when ohai returns correct IP address
-        """
+    def _mock_facts_output(self, ohai_output, chef_output='Chef: 11.4.0'):
+        """Mocks the output of gathering facts from the node"""
         class MockSudoReturnValue(str):
             succeeded = True
 
+        env.host_string = 'extranode'
+        self.addCleanup(facts.forget, 'extranode')
+        return MockSudoReturnValue('{0}\r\n{1}\r\n{2}\r\n'.format(
+            ohai_output, facts.SEPARATOR, chef_output))
+
+    def test_node_file_writer(self):
+        """Should save the node files of all added nodes at once"""
+        writer = chef.NodeFileWriter()
+        writer.save({'name': 'extranode', 'run_list': ['role[base]']})
+        node = {'name': 'extranode', 'run_list': ['recipe[vim]']}
+        writer.save(node)
+        node['run_list'].append('recipe[man]')
+        self.assertFalse(os.path.exists(os.path.join('nodes',
+                                                     'extranode.json')))
+        self.assertEqual(writer.flush(), ['extranode'])
+        self.assertEqual(lib.get_node('extranode')['run_list'],
+                         ['recipe[vim]'])
+        self.assertEqual(writer.flush(), [])
+
+    def test_node_file_writer_same_as_save_config(self):
+        """Should write the same node files as save_config, with the same
+        mode
+
+        """
+        node = {'name': 'extranode', 'run_list': ['role[base]']}
+        env.host_string = 'extranode'
+        chef.save_config(node)
+        path = os.path.join('nodes', 'extranode.json')
+        with open(path, 'r') as f:
+            saved = f.read()
+        mode = os.stat(path).st_mode
+        os.remove(path)
+        writer = chef.NodeFileWriter()
+        writer.save(node)
+        writer.flush()
+        with open(path, 'r') as f:
+            self.assertEqual(f.read(), saved)
+        self.assertEqual(os.stat(path).st_mode, mode)
+
+    def test_get_ipaddress(self):
+        """Should add ipaddress attribute when ohai returns correct IP address
+        """
         node = {}
         fake_ip = "1.1.1.2"
-        with patch.object(chef, 'sudo') as mock_method:
-            mocked_ohai_response = '["{0}"]'.format(fake_ip)
-            mock_method.return_value = MockSudoReturnValue(mocked_ohai_response)
+        with patch.object(facts, 'sudo') as mock_method:
+            mock_method.return_value = self._mock_facts_output(
+                '{{"ipaddress": "{0}"}}'.format(fake_ip))
             response = chef._get_ipaddress(node)
         self.assertTrue(response)
         self.assertEqual(node['ipaddress'], fake_ip)
 
     def test_get_ipaddress_attribute_exists(self):
         """Should not save ipaddress when attribute exists"""
-        class MockSudoReturnValue(str):
-            succeeded = True
-
         node = {'ipaddress': '1.1.1.1'}
-        with patch.object(chef, 'sudo') as mock_method:
-            mocked_ohai_response = '["{0}"]'.format("1.1.1.2")
-            mock_method.return_value = MockSudoReturnValue(mocked_ohai_response)
+        with patch.object(facts, 'sudo') as mock_method:
+            mock_method.return_value = self._mock_facts_output(
+                '{"ipaddress": "1.1.1.2"}')
             response = chef._get_ipaddress(node)
         self.assertFalse(response)
         self.assertEqual(node['ipaddress'], '1.1.1.1')
+        self.assertFalse(mock_method.called)
 
     def test_get_ipaddress_bad_ohai_output(self):
         """Should abort when ohai's output cannot be parsed"""
-        class MockSudoReturnValue(str):
-            succeeded = True
-
-        with patch.object(chef, 'sudo') as mock_method:
-            mocked_ohai_response = ('Invalid gemspec '
-                                    '["{0}"]'.format("1.1.1.2"))
-            mock_method.return_value = MockSudoReturnValue(mocked_ohai_response)
+        with patch.object(facts, 'sudo') as mock_method:
+            mock_method.return_value = self._mock_facts_output(
+                'Invalid gemspec {"ipaddress": "1.1.1.2"}')
             self.assertRaises(SystemExit, chef._get_ipaddress, {})
 
+    def test_chef_test(self):
+        """Should tell whether chef-solo is installed from the facts"""
+        with patch.object(facts, 'sudo') as mock_method:
+            mock_method.return_value = self._mock_facts_output('', '')
+            self.assertFalse(chef.chef_test())
+            facts.forget()
+            mock_method.return_value = self._mock_facts_output('{}')
+            self.assertTrue(chef.chef_test())
+
     def test_build_node_data_bag(self):
         """Should create a node data bag with one item per node"""
         chef.build_node_data_bag()
@@ -330,11 +1196,111 @@ class TestChef(BaseTest):
         with open(item_path, 'r') as f:
             data = json.loads(f.read())
         self.assertTrue('id' in data and data['id'] == 'testnode2')
+        # Roles and recipes follow Chef's run_list expansion order
         self.assertTrue('recipes' in data)
-        self.assertEqual(data['recipes'], [u'subversion', u'man'])
+        self.assertEqual(data['recipes'], [u'man', u'subversion'])
         self.assertTrue('recipes' in data)
         self.assertEqual(data['role'], [u'all_you_can_eat'])
-        self.assertEqual(data['roles'], [u'base', u'all_you_can_eat'])
+        self.assertEqual(data['roles'], [u'all_you_can_eat', u'base'])
+
+    def test_build_node_data_bag_incremental(self):
+        """Should only rebuild the items whose inputs have changed"""
+        chef.build_node_data_bag()
+        paths = dict((name, os.path.join('data_bags', 'node', name + '.json'))
+                     for name in ['testnode1', 'testnode2'])
+        # Whole seconds, which the filesystem stores exactly
+        old = int(os.stat(paths['testnode1']).st_mtime) - 60
+        for path in paths.values():
+            os.utime(path, (old, old))
+        node_path = os.path.join('nodes', 'testnode2.json')
+        with open(node_path, 'r') as f:
+            original = f.read()
+        env.host_string = 'testnode2'
+        chef.save_config({"run_list": ["recipe[vim]"]}, force=True)
+        try:
+            chef.build_node_data_bag()
+        finally:
+            with open(node_path, 'w') as f:
+                f.write(original)
+        self.assertEqual(os.stat(paths['testnode1']).st_mtime, old)
+        self.assertNotEqual(os.stat(paths['testnode2']).st_mtime, old)
+        with open(paths['testnode2'], 'r') as f:
+            self.assertEqual(json.loads(f.read())['recipes'], ['vim'])
+
+    def _build_node_data_bag_contents(self, workers):
+        """Builds the whole node data bag and returns its items' contents"""
+        store_path = os.path.join(littlechef.CACHE_DIR, 'data_bags', 'node')
+        if os.path.exists(store_path):
+            shutil.rmtree(store_path)
+        env.build_workers = workers
+        try:
+            chef.build_node_data_bag()
+        finally:
+            env.build_workers = 1
+        contents = {}
+        for filename in os.listdir(os.path.join('data_bags', 'node')):
+            with open(os.path.join('data_bags', 'node', filename)) as f:
+                contents[filename] = f.read()
+        return contents
+
+    def test_get_input_hashes(self):
+        """Should only change the input hash of nodes whose inputs changed"""
+        def get_hashes():
+            chef.build_node_data_bag()
+            return chef.get_input_hashes(
+                [node for node in lib.get_nodes(fields=['run_list'])
+                 if node['name'] in ['testnode1', 'testnode2']])
+        hashes = get_hashes()
+        self.assertEqual(sorted(hashes), ['testnode1', 'testnode2'])
+        self.assertNotEqual(hashes['testnode1'], hashes['testnode2'])
+        self.assertEqual(get_hashes(), hashes)
+        # Items of other nodes are not inputs
+        env.host_string = 'extranode'
+        chef.save_config({"run_list": ["recipe[vim]"]})
+        self.assertEqual(get_hashes(), hashes)
+        node_path = os.path.join('nodes', 'testnode2.json')
+        with open(node_path, 'r') as f:
+            original = f.read()
+        env.host_string = 'testnode2'
+        chef.save_config({"run_list": ["recipe[vim]"]}, force=True)
+        try:
+            changed = get_hashes()
+        finally:
+            with open(node_path, 'w') as f:
+                f.write(original)
+        self.assertEqual(changed['testnode1'], hashes['testnode1'])
+        self.assertNotEqual(changed['testnode2'], hashes['testnode2'])
+
+    def test_is_unchanged(self):
+        """Should tell whether the last successful run had the same inputs"""
+        self.addCleanup(chef.forget_converged, 'testnode1')
+        env.input_hashes = {'testnode1': 'abcd'}
+        self.addCleanup(env.pop, 'input_hashes')
+        self.assertFalse(chef.is_unchanged('testnode1'))
+        chef.save_converged('testnode1')
+        self.assertTrue(chef.is_unchanged('testnode1'))
+        self.assertTrue(chef.is_unchanged('testnode1', max_age=1))
+        with patch.object(chef.time, 'time', return_value=time.time() + 7200):
+            self.assertFalse(chef.is_unchanged('testnode1', max_age=1))
+            self.assertTrue(chef.is_unchanged('testnode1', max_age=3))
+        env.input_hashes['testnode1'] = 'efgh'
+        self.assertFalse(chef.is_unchanged('testnode1'))
+        chef.save_converged('testnode1')
+        chef.forget_converged('testnode1')
+        self.assertFalse(chef.is_unchanged('testnode1'))
+
+    def test_build_node_data_bag_parallel(self):
+        """Should build the same items with several worker processes"""
+        serial = self._build_node_data_bag_contents(1)
+        self.assertEqual(len(serial), len(self.nodes))
+        self.assertEqual(self._build_node_data_bag_contents(3), serial)
+
+    def test_build_node_data_bag_parallel_error(self):
+        """Should abort when an item cannot be built by a worker process"""
+        env.host_string = 'extranode'
+        chef.save_config({"run_list": ["recipe[phantom_cookbook]"]})
+        self.assertRaises(
+            SystemExit, self._build_node_data_bag_contents, 2)
 
     def test_build_node_data_bag_nonalphanumeric(self):
         """Should create a node data bag when node name contains invalid chars
@@ -485,6 +1451,314 @@ class TestChef(BaseTest):
         }
         self.assertTrue(data['other_attr']['deep_dict'], expected)
 
+    def test_attribute_merger_reuse(self):
+        """Should build cookbook defaults once and not share them with nodes
+        """
+        merger = chef.AttributeMerger(lib.get_recipes(), lib.get_roles())
+
+        def merge(name):
+            node = lib.get_node(name)
+            node['roles'], node['recipes'] = lib.expand_run_list(node)
+            merger.merge(node)
+            return node
+
+        nodes = [merge('testnode1')]
+        # Once built, cookbook defaults are not built again
+        with patch.object(chef, 'build_dct') as mock_build_dct:
+            mock_build_dct.side_effect = AssertionError
+            nodes.append(merge('testnode1'))
+        nodes[0]['subversion']['repo_dir'] = 'changed'
+        self.assertEqual(nodes[1]['subversion']['repo_dir'], '/srv/svn2')
+        self.assertTrue((('subversion', 'repo_dir'), '/srv/svn2') in
+                        merger.cookbook_defaults('subversion'))
+
+    def test_attribute_merger_hash_reset(self):
+        """Should let a hash attribute replace what earlier recipes set, and
+        not share values between nodes
+
+        """
+        recipes = [
+            {'name': 'a', 'attributes': {
+                'web/ports': {'default': [80]},
+                'web/user': {'default': 'www'}}},
+            {'name': 'b', 'attributes': {'web': {'type': 'hash'}}},
+            {'name': 'c', 'attributes': {'web/ports': {'default': [80]}}},
+        ]
+        merger = chef.AttributeMerger(recipes, [])
+        node = {'name': 'n1', 'recipes': ['a', 'b'], 'roles': [],
+                'chef_environment': '_default'}
+        merger.merge(node)
+        self.assertEqual(node['web'], {})
+        nodes = [{'name': name, 'recipes': ['c'], 'roles': [],
+                  'chef_environment': '_default'} for name in ['n1', 'n2']]
+        for node in nodes:
+            merger.merge(node)
+        nodes[0]['web']['ports'].append(443)
+        self.assertEqual(nodes[1]['web']['ports'], [80])
+
+    def test_attribute_merger_shared_layers(self):
+        """Should merge role and environment attributes once per run_list"""
+        merger = chef.AttributeMerger(lib.get_recipes(), lib.get_roles())
+        nodes = []
+        for user in ['user1', 'user2']:
+            node = {'name': user, 'chef_environment': 'staging',
+                    'run_list': ['role[all_you_can_eat]'],
+                    'subversion': {'user': user}}
+            node['roles'], node['recipes'] = lib.expand_run_list(node)
+            nodes.append(node)
+        self.assertTrue(merger.layers(nodes[0]) is merger.layers(nodes[1]))
+        for node in nodes:
+            merger.merge(node)
+        self.assertEqual(nodes[0]['subversion']['user'], 'user1')
+        self.assertEqual(nodes[1]['subversion']['user'], 'user2')
+        self.assertEqual(nodes[1]['subversion']['password'],
+                         'role_override_pass')
+        self.assertEqual(nodes[1]['subversion']['repo_server'],
+                         'role_default_repo_server')
+
+    def _build_kitchen_bundle(self, cookbooks):
+        env.berksfile = None
+        path, digest = chef.build_kitchen_bundle(cookbooks)
+        self.addCleanup(shutil.rmtree, os.path.dirname(path), True)
+        return path, digest
+
+    def test_build_kitchen_bundle(self):
+        """Should pack all synced kitchen directories into one bundle"""
+        path, digest = self._build_kitchen_bundle(['subversion', 'vim'])
+        self.assertEqual(os.path.basename(path), digest + '.tar.gz')
+        tar = tarfile.open(path)
+        names = tar.getnames()
+        tar.close()
+        for name in ['data_bags', 'roles/base.json', 'environments',
+                     'cookbooks/vim/metadata.json', 'cookbooks/subversion',
+                     'site-cookbooks/subversion']:
+            self.assertTrue(name in names)
+        self.assertFalse('cookbooks/man' in names)
+        self.assertFalse(any(name.startswith('nodes') for name in names))
+
+    def test_build_kitchen_bundle_reproducible(self):
+        """Should build the same bundle out of the same kitchen"""
+        path, digest = self._build_kitchen_bundle(['vim'])
+        # Modification times do not change the contents
+        os.utime(os.path.join('roles', 'base.json'), None)
+        self.assertEqual(self._build_kitchen_bundle(['vim']), (path, digest))
+        self.assertNotEqual(self._build_kitchen_bundle(['man'])[1], digest)
+
+    def test_build_kitchen_bundles(self):
+        """Should build one bundle per set of cookbooks and remove old ones"""
+        old_path = self._build_kitchen_bundle(['vim'])[0]
+        nodes = [lib.get_node(name) for name in self.nodes]
+        chef.build_kitchen_bundles(nodes)
+        self.assertEqual(
+            sorted(env.kitchen_bundles),
+            [('man',), ('man', 'subversion'), ('subversion',),
+             ('subversion', 'vim')])
+        self.assertEqual(
+            sorted(os.listdir(os.path.dirname(old_path))),
+            sorted(os.path.basename(path)
+                   for path, digest in env.kitchen_bundles.values()))
+        self.assertFalse(os.path.exists(old_path))
+
+    def test_get_cookbook_filters(self):
+        """Should only let the given cookbooks through every cookbook path"""
+        env.berksfile = None
+        self.assertEqual(
+            chef._get_cookbook_filters(['vim']),
+            '--include="/site-cookbooks/vim" --exclude="/site-cookbooks/*" '
+            '--include="/cookbooks/vim" --exclude="/cookbooks/*"')
+
+    @patch('littlechef.chef.put')
+    @patch('littlechef.chef.sudo')
+    def test_upload_kitchen_bundle(self, mock_sudo, mock_put):
+        """Should upload and unpack a bundle the node does not have"""
+        env.node_work_path = '/tmp/chef-solo'
+        mock_sudo.return_value = FakeOutput('0123', succeeded=False)
+        script = remote.RemoteScript()
+        chef._upload_kitchen_bundle(('bundle.tar.gz', 'abcd'), script)
+        mock_put.assert_called_once_with(
+            'bundle.tar.gz', '/tmp/littlechef-kitchen-abcd.tar.gz',
+            mode=0600)
+        self.assertTrue(script.commands[-1].startswith(
+            'rm -rf /tmp/chef-solo/.kitchen_abcd'))
+        self.assertTrue('echo abcd > /tmp/chef-solo/.kitchen_bundle' in
+                        script.commands[-1])
+
+    @patch('littlechef.chef.put')
+    @patch('littlechef.chef.sudo')
+    def test_upload_kitchen_bundle_unchanged(self, mock_sudo, mock_put):
+        """Should not upload a bundle the node already has"""
+        env.node_work_path = '/tmp/chef-solo'
+        mock_sudo.return_value = FakeOutput('abcd\n')
+        script = remote.RemoteScript()
+        chef._upload_kitchen_bundle(('bundle.tar.gz', 'abcd'), script)
+        self.assertEqual(mock_sudo.call_count, 1)
+        self.assertFalse(mock_put.called)
+        self.assertEqual(script.commands, [])
+
+    @patch('littlechef.chef.put')
+    @patch('littlechef.chef.run')
+    def test_upload_kitchen_bundles(self, mock_run, mock_put):
+        """Should only upload to the relay the bundles it does not have"""
+        env.relay = 'relay.example.com'
+        mock_run.return_value = FakeOutput('abcd.tar.gz\nold.tar.gz\n')
+        chef.upload_kitchen_bundles(
+            [('a.tar.gz', 'abcd'), ('e.tar.gz', 'ef01')])
+        mock_put.assert_called_once_with(
+            'e.tar.gz', '/tmp/littlechef-relay/ef01.tar.gz', mode=0600)
+        mock_run.assert_called_with(
+            'cd /tmp/littlechef-relay && rm -f old.tar.gz')
+
+    @patch('littlechef.chef.put')
+    @patch('littlechef.chef.sudo')
+    def test_upload_kitchen_bundle_pull(self, mock_sudo, mock_put):
+        """Should have the node download the bundle from the pull server"""
+        env.node_work_path = '/tmp/chef-solo'
+        mock_sudo.return_value = FakeOutput('', succeeded=False)
+        server = pullserver.PullServer()
+        script = remote.RemoteScript(server)
+        chef._upload_kitchen_bundle(('bundle.tar.gz', 'abcd'), script)
+        self.assertFalse(mock_put.called)
+        self.assertEqual(server.files.values(), [('bundle.tar.gz', None)])
+        self.assertEqual(
+            script.commands[0],
+            'fetch "$pull/abcd" /tmp/littlechef-kitchen-abcd.tar.gz abcd '
+            '|| fail \'Could not download the kitchen bundle\'')
+
+    def test_build_packages_bundle(self):
+        """Should pack the packages and have the node replace its copy"""
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.addCleanup(shutil.rmtree,
+                        os.path.join(littlechef.CACHE_DIR, 'packages'), True)
+        os.mkdir(os.path.join(path, 'debs'))
+        for name in ['debs/a.deb', 'b.rpm', '.git']:
+            with open(os.path.join(path, name), 'w') as f:
+                f.write(name)
+        env.sync_packages_local_dir = path
+        env.sync_packages_dest_dir = '/srv/packages'
+        env.user = 'deploy'
+        old_path = chef.build_packages_bundle()[0]
+        with open(os.path.join(path, 'b.rpm'), 'w') as f:
+            f.write('changed')
+        bundle_path, digest = chef.build_packages_bundle()
+        self.assertFalse(os.path.exists(old_path))
+        tar = tarfile.open(bundle_path)
+        self.assertEqual(tar.getnames(), ['b.rpm', 'debs', 'debs/a.deb'])
+        tar.close()
+        script = remote.RemoteScript(pullserver.PullServer())
+        chef._download_packages_bundle((bundle_path, digest), script)
+        remote_bundle = '/tmp/littlechef-packages-{0}.tar.gz'.format(digest)
+        self.assertEqual(script.commands, [
+            '(fetch "$pull/{0}" {1} {0} && mkdir -p /srv/packages && '
+            'cd /srv/packages && rm -rf b.rpm debs && '
+            'tar -xzf {1} --no-same-owner && chown -R deploy b.rpm debs) '
+            '|| echo \'littlechef warning: package upload failed. Continuing '
+            'cooking...\''.format(digest, remote_bundle),
+            'rm -f ' + remote_bundle,
+        ])
+
+    @patch('littlechef.chef.put')
+    @patch('littlechef.chef.run')
+    @patch('littlechef.chef.sudo')
+    def test_upload_kitchen_bundle_relay(self, mock_sudo, mock_run, mock_put):
+        """Should have the relay copy the bundle to the node"""
+        env.relay = 'relay.example.com'
+        env.host_string = 'deploy@node1.example.com'
+        env.key_filename = '/home/me/.ssh/id_nodes'
+        env.node_work_path = '/tmp/chef-solo'
+        mock_sudo.return_value = FakeOutput('', succeeded=False)
+        mock_run.side_effect = [
+            FakeOutput('', succeeded=False, return_code=100), FakeOutput('')]
+        script = remote.RemoteScript()
+        chef._upload_kitchen_bundle(('bundle.tar.gz', 'abcd'), script)
+        # The relay did not have the bundle yet
+        mock_put.assert_called_once_with(
+            'bundle.tar.gz', '/tmp/littlechef-relay/abcd.tar.gz', mode=0600)
+        self.assertEqual(mock_run.call_count, 2)
+        self.assertTrue(mock_run.call_args[0][0].endswith(
+            'scp -q -o StrictHostKeyChecking=no -i .ssh/id_nodes -P 22 '
+            '/tmp/littlechef-relay/abcd.tar.gz '
+            'deploy@node1.example.com:/tmp/littlechef-kitchen-abcd.tar.gz'))
+
+    def test_get_kitchen_files(self):
+        """Should list the synced files of the given cookbooks"""
+        env.berksfile = None
+        files = chef._get_kitchen_files(['vim'])
+        self.assertEqual(files['cookbooks/vim/metadata.json'],
+                         os.path.join('./cookbooks', 'vim', 'metadata.json'))
+        self.assertTrue('roles/base.json' in files)
+        self.assertTrue('data_bags/README' in files)
+        self.assertFalse('cookbooks/README' in files)
+        self.assertFalse(any(name.startswith('cookbooks/man/')
+                             or name.startswith('site-cookbooks/')
+                             for name in files))
+
+    def test_get_removed_paths(self):
+        """Should remove whole directories left without files"""
+        old_manifest = dict.fromkeys([
+            'cookbooks/java/metadata.json', 'cookbooks/java/recipes/a.rb',
+            'roles/base.json', 'roles/old.json'])
+        manifest = dict.fromkeys(['roles/base.json'])
+        self.assertEqual(chef._get_removed_paths(old_manifest, manifest),
+                         ['cookbooks', 'roles/old.json'])
+
+    def _upload_kitchen_delta(self, old_manifest):
+        """Returns the names and owners of the uploaded files and the script
+        commands
+
+        """
+        env.berksfile = None
+        env.node_work_path = '/tmp/chef-solo'
+        env.user = 'testuser'
+        names, owners = [], []
+
+        def put(local_path, remote_path, mode):
+            tar = tarfile.open(local_path)
+            names.extend(tar.getnames())
+            owners.extend(member.uname for member in tar.getmembers())
+            tar.close()
+        script = remote.RemoteScript()
+        with patch.object(chef, 'sudo') as mock_sudo:
+            if old_manifest is None:
+                mock_sudo.return_value = FakeOutput('', succeeded=False)
+            else:
+                mock_sudo.return_value = FakeOutput(json.dumps(old_manifest))
+            with patch.object(chef, 'put', side_effect=put):
+                chef._upload_kitchen_delta(['vim'], script)
+        return names, owners, script.commands
+
+    def test_upload_kitchen_delta_first_sync(self):
+        """Should upload all files when the node has no manifest"""
+        names, owners, commands = self._upload_kitchen_delta(None)
+        self.assertEqual(sorted(names),
+                         sorted(chef._get_kitchen_files(['vim'])))
+        self.assertTrue(commands[1].startswith(
+            "rm -rf /tmp/chef-solo/cookbooks /tmp/chef-solo/data_bags"))
+
+    def test_upload_kitchen_delta_unchanged(self):
+        """Should not upload anything when the kitchen has not changed"""
+        manifest = chef._get_manifest(chef._get_kitchen_files(['vim']))
+        names, owners, commands = self._upload_kitchen_delta(manifest)
+        self.assertEqual(names, [])
+        self.assertEqual(commands[0], 'rm -f /tmp/chef-solo/.manifest '
+                         "|| fail 'Could not modify /tmp/chef-solo dir'")
+        self.assertTrue(commands[1].startswith('install'))
+        self.assertEqual(len(commands), 2)
+
+    def test_upload_kitchen_delta_changed(self):
+        """Should only upload changed files and remove deleted ones"""
+        manifest = chef._get_manifest(chef._get_kitchen_files(['vim']))
+        manifest['roles/base.json'][0] = 'changed'
+        manifest['roles/old.json'] = ['removed', 0644]
+        names, owners, commands = self._upload_kitchen_delta(manifest)
+        self.assertEqual(names, ['roles/base.json'])
+        self.assertTrue(
+            "rm -rf /tmp/chef-solo/roles/old.json || fail" in commands[1])
+        # The directories of the files are owned by the user too
+        self.assertTrue(
+            "chown testuser /tmp/chef-solo/roles && " in commands[2])
+        self.assertEqual(owners, ['testuser'])
+
     def test_sync_node_dummy_attr(self):
         """Should return False when node has a dummy tag or dummy=true"""
         self.assertFalse(chef.sync_node({'name': 'extranode', 'dummy': True}))
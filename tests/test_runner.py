@@ -1,9 +1,15 @@
+import os
+import sys
+import json
+import socket
+import tempfile
 from ConfigParser import SafeConfigParser
+from StringIO import StringIO
 
 from mock import patch
 from nose.tools import raises
 
-from littlechef import runner
+from littlechef import commands, runner
 from test_base import BaseTest
 
 
@@ -23,6 +29,42 @@ class TestConfig(BaseTest):
         self.assertEqual(runner.env.sync_packages_dest_dir, "/srv/repos")
         self.assertEqual(runner.env.sync_packages_local_dir, "./repos")
 
+    def test_read_rollout(self):
+        """Should read the rollout section of the config file"""
+        config = SafeConfigParser()
+        config.readfp(StringIO("[rollout]\ncanary = 2\nmax_failures = 10%\n"
+                               "role_limits = db:1, web:5\n"))
+        self.assertEqual(runner._read_rollout(config), {
+            'canary': 2, 'growth': 2, 'max_failures': 0.1,
+            'role_limits': {'db': 1, 'web': 5}})
+
+    @raises(SystemExit)
+    def test_read_rollout_wrong_role_limit(self):
+        """Should abort when a role limit is not a number"""
+        config = SafeConfigParser()
+        config.add_section('rollout')
+        config.set('rollout', 'role_limits', 'db:one')
+        runner._read_rollout(config)
+
+    def test_lazy_ssh_config(self):
+        """Should only read the ssh config file when a host is looked up"""
+        with tempfile.NamedTemporaryFile() as f:
+            f.write("Host testnode1\n    HostName 10.0.0.1\n")
+            f.flush()
+            ssh_config = runner._LazySSHConfig(f.name)
+            self.assertEqual(ssh_config._config, [])
+            self.assertEqual(ssh_config.lookup('testnode1')['hostname'],
+                             '10.0.0.1')
+
+    @raises(SystemExit)
+    def test_lazy_ssh_config_missing(self):
+        """Should abort when the ssh config file is first looked up and it
+        doesn't exist
+
+        """
+        ssh_config = runner._LazySSHConfig('/nonexistent/ssh_config')
+        ssh_config.lookup('testnode1')
+
     def test_not_a_kitchen(self):
         """Should abort when no config file found"""
         with patch.object(SafeConfigParser, 'read') as mock_method:
@@ -55,6 +97,41 @@ class TestNode(BaseTest):
         self.assertEqual(runner.env.hosts, ['testnode2'])
 
 
+    def test_node_skip_unchanged(self):
+        """Should skip nodes whose last run had the same inputs"""
+        runner.env.skip_unchanged = True
+        self.addCleanup(setattr, runner.env, 'skip_unchanged', False)
+        runner.node('testnode1', 'testnode2')
+        runner.chef.save_converged('testnode1')
+        self.addCleanup(runner.chef.forget_converged, 'testnode1')
+        runner.env.hosts = []
+        with patch.object(runner.lib, 'print_header') as mock_print_header:
+            runner.node('testnode1', 'testnode2')
+        mock_print_header.assert_called_once_with(
+            'Skipping unchanged: testnode1')
+
+    def test_node_no_input_hashes(self):
+        """Should only hash the inputs of nodes when skipping unchanged ones
+        """
+        with patch.object(runner.chef, 'get_input_hashes') as mock_hashes:
+            runner.node('testnode1')
+        self.assertFalse(mock_hashes.called)
+        self.assertEqual(runner.env.input_hashes, {})
+
+    def test_role_forgets_converged(self):
+        """Should forget the last run of a node when applying a role to it"""
+        runner.env.input_hashes = {'testnode1': 'abc'}
+        runner.chef.save_converged('testnode1')
+        self.addCleanup(runner.chef.forget_converged, 'testnode1')
+        runner.env.host_string = 'testnode1'
+        with patch.object(runner, '__testing__', False):
+            with patch.object(runner.chef, 'chef_test'):
+                with patch.object(runner.chef, 'sync_node'):
+                    runner.role('base')
+        self.assertFalse(runner.chef.is_unchanged('testnode1'))
+        self.assertFalse(os.path.exists(
+            runner.chef._get_converged_path('testnode1')))
+
 class TestNodesWithRole(BaseTest):
 
     def test_nodes_with_role(self):
@@ -119,3 +196,173 @@ class TestNodesWithTag(BaseTest):
         """
         runner.env.chef_environment = "production"
         runner.nodes_with_role('top')
+
+
+class TestFleetTask(BaseTest):
+
+    def test_role_threads(self):
+        """Should run role on all nodes at once when using threads"""
+        runner.env.fleet_size = 2
+        runner.env.hosts = ['testnode1', 'testnode2']
+        with patch.object(runner.fleet, 'execute') as mock_execute:
+            for host in runner.env.hosts:
+                runner.env.host_string = host
+                runner.role('base')
+        self.assertEqual(mock_execute.call_count, 1)
+        self.assertEqual(mock_execute.call_args[0][1:],
+                         (['testnode1', 'testnode2'], 2, 'base'))
+
+    def test_role_rollout(self):
+        """Should run role on all nodes in waves when a rollout is set"""
+        runner.env.fleet_size = 2
+        runner.env.rollout = {'canary': 1, 'growth': 2, 'max_failures': 0,
+                              'role_limits': {'base': 1}}
+        runner.env.hosts = ['testnode1', 'testnode2']
+        with patch.object(runner.fleet, 'roll_out') as mock_roll_out:
+            for host in runner.env.hosts:
+                runner.env.host_string = host
+                runner.role('base')
+        self.assertEqual(mock_roll_out.call_count, 1)
+        rollout = mock_roll_out.call_args[0][3]
+        self.assertEqual(rollout.role_limits, {'base': 1})
+        self.assertEqual(rollout.roles['testnode2'],
+                         ['all_you_can_eat', 'base'])
+
+
+class TestGatherFacts(BaseTest):
+
+    def test_gather_facts(self):
+        """Should gather the facts of all nodes into the facts store at once"""
+        facts = runner.facts
+        runner.env.hosts = ['testnode1', 'testnode2']
+        for host in runner.env.hosts:
+            self.addCleanup(facts.forget, host)
+        with patch.object(facts, 'sudo') as mock_sudo:
+            mock_sudo.side_effect = lambda command: (
+                '{{"ipaddress": "{0}"}}\n{1}\nChef: 11.4.0'.format(
+                    runner.env.host_string, facts.SEPARATOR))
+            runner.gather_facts()
+            self.assertEqual(mock_sudo.call_count, 2)
+            for host in runner.env.hosts:
+                runner.env.host_string = host
+                self.assertEqual(facts.get_facts()['ipaddress'], host)
+        self.assertEqual(mock_sudo.call_count, 2)
+
+
+class TestDeployChef(BaseTest):
+
+    def _deploy_chef(self, **kwargs):
+        runner.env.host_string = 'extranode'
+        with patch.object(runner, '__testing__', False):
+            with patch.object(runner, 'solo'):
+                with patch.object(runner.facts, 'gather') as mock_gather:
+                    mock_gather.return_value = {'ipaddress': None}
+                    runner.deploy_chef(ask="no", **kwargs)
+        with open(os.path.join('nodes', 'extranode.json'), 'r') as f:
+            return mock_gather, json.loads(f.read())
+
+    def test_deploy_chef(self):
+        """Should save the node file even when no facts were gathered"""
+        mock_gather, node = self._deploy_chef()
+        self.assertTrue(mock_gather.called)
+        self.assertEqual(node, {'run_list': []})
+
+    def test_deploy_chef_no_ohai(self):
+        """Should save the node file without gathering facts"""
+        mock_gather, node = self._deploy_chef(ohai="no")
+        self.assertFalse(mock_gather.called)
+        self.assertEqual(node, {'run_list': []})
+
+class TestSSHAll(BaseTest):
+
+    @raises(SystemExit)
+    def test_ssh_all(self):
+        """Should print nodes with the same output together and abort when
+        the command failed on any of them
+
+        """
+        class MockOutput(str):
+            pass
+
+        def run(command):
+            output = MockOutput('Linux\r\n' if runner.env.host_string
+                                != 'testnode2' else 'not found\r\n')
+            output.return_code = 0 if output.startswith('Linux') else 127
+            return output
+        runner.env.hosts = ['testnode1', 'testnode2', 'testnode4']
+        stdout = StringIO()
+        with patch.object(runner, 'run', side_effect=run):
+            with patch.object(sys, 'stdout', stdout):
+                try:
+                    runner.ssh_all('uname')
+                finally:
+                    printed = stdout.getvalue()
+                    self.assertTrue(
+                        "testnode1, testnode4 (2)\n" in printed, printed)
+                    self.assertTrue("testnode2 (1)\n" in printed, printed)
+                    self.assertTrue("  0: 2 nodes\n" in printed, printed)
+                    self.assertTrue(
+                        "  127: 1 node (testnode2)\n" in printed, printed)
+
+    @raises(SystemExit)
+    def test_ssh_all_connection_errors(self):
+        """Should report why each node could not be reached and still print
+        the output of the others
+
+        """
+        class MockOutput(str):
+            return_code = 0
+
+        def run(command):
+            if runner.env.host_string == 'testnode2':
+                raise socket.error('Connection refused')
+            elif runner.env.host_string == 'testnode4':
+                raise SystemExit(1)
+            return MockOutput('Linux\r\n')
+        runner.env.hosts = ['testnode1', 'testnode2', 'testnode4']
+        stdout = StringIO()
+        with patch.object(runner, 'run', side_effect=run):
+            with patch.object(sys, 'stdout', stdout):
+                try:
+                    runner.ssh_all('uname')
+                finally:
+                    printed = stdout.getvalue()
+                    self.assertTrue("testnode1 (1)\n" in printed, printed)
+                    self.assertTrue("\nLinux\n" in printed, printed)
+                    self.assertTrue(
+                        "Could not run the command: Connection refused"
+                        in printed, printed)
+                    self.assertTrue(
+                        "Could not run the command: SystemExit" in printed,
+                        printed)
+                    self.assertTrue(
+                        "  unreachable: 2 nodes (testnode2, testnode4)\n"
+                        in printed, printed)
+
+    def test_ssh_all_no_nodes(self):
+        """Should abort when no nodes are selected"""
+        runner.env.hosts = []
+        with patch.object(runner, 'run') as mock_run:
+            with self.assertRaises(SystemExit) as cm:
+                runner.ssh_all('uname')
+        self.assertTrue("No nodes selected" in cm.exception.message)
+        self.assertFalse(mock_run.called)
+
+
+class TestCommands(BaseTest):
+
+    def test_get_commands(self):
+        """Should find the same commands as Fabric does"""
+        from fabric.main import load_fabfile
+        docstring, callables, default = load_fabfile(runner.__file__)
+        self.assertEqual(sorted(commands.get_commands()), sorted(callables))
+
+    def test_needs_cookbooks(self):
+        """Should vendor the Berksfile cookbooks once, when first needed"""
+        runner.env.berksfile = 'Berksfile'
+        runner.env.berksfile_vendored = False
+        with patch.object(runner.chef,
+                          'ensure_berksfile_cookbooks_are_installed') as mock:
+            runner.list_recipes()
+            runner.list_recipes()
+        self.assertEqual(mock.call_count, 1)